@@ -0,0 +1,90 @@
+import bisect
+import json
+
+import numpy as np
+
+# Constants
+DURATION_BUCKETS_US = (50, 100, 250, 500, 1000, 2000, 5000, 10000, 20000, 50000)  # Upper edges of the histogram buckets
+
+
+class AudioMetrics:
+    def __init__(self, sample_rate, buckets_us=DURATION_BUCKETS_US):
+        # How close each audio callback comes to its deadline. Only the audio thread writes (fixed-size counters,
+        # so recording never allocates arrays or takes a lock); other threads read a snapshot that may be one
+        # callback behind, which is fine for a debug panel or a dashboard.
+        self.sample_rate = sample_rate
+        self.buckets_us = tuple(buckets_us)
+        self.edges = tuple(edge * 1e-6 for edge in self.buckets_us)  # Bucket edges in seconds
+        self.reset()
+
+    def reset(self):
+        # Zero every counter (e.g. before a new measurement)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)  # Callbacks per duration bucket (last = longer)
+        self.callbacks = 0  # Callbacks recorded
+        self.total_seconds = 0.0  # Time spent inside callbacks
+        self.block_seconds = 0.0  # Audio delivered by those callbacks
+        self.max_seconds = 0.0  # Longest callback
+        self.last_load = 0.0  # Callback time / block duration of the last callback
+        self.peak_load = 0.0  # Highest load seen
+        self.late = 0  # Callbacks that took longer than the block they produced
+        self.underflows = 0  # Blocks the device reported as output_underflow (it ran dry)
+        self.overflows = 0  # Blocks the device reported as output_overflow
+        self.dropped = 0  # Blocks partly filled with silence because the mixer fell behind
+
+    def record(self, seconds, frames, status=None, dropped=False):
+        # (Audio thread) Account for one callback that took seconds to produce frames
+        self.counts[bisect.bisect_left(self.edges, seconds)] += 1
+        self.callbacks += 1
+        self.total_seconds += seconds
+        block = frames / self.sample_rate
+        self.block_seconds += block
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        load = seconds / block if block else 0.0
+        self.last_load = load
+        if load > self.peak_load:
+            self.peak_load = load
+        if load > 1.0:
+            self.late += 1
+        if status:
+            if status.output_underflow:
+                self.underflows += 1
+            if status.output_overflow:
+                self.overflows += 1
+        if dropped:
+            self.dropped += 1
+
+    @property
+    def mean_load(self):
+        # Average callback time / block duration
+        return self.total_seconds / self.block_seconds if self.block_seconds else 0.0
+
+    def histogram(self):
+        # [(bucket label, callbacks)] from the shortest bucket to the overflow one
+        labels = [f"<={edge}us" for edge in self.buckets_us] + [f">{self.buckets_us[-1]}us"]
+        return list(zip(labels, self.counts.tolist()))
+
+    def snapshot(self):
+        # Plain dictionary of every metric, for the debug panel and JSON dumps
+        return {
+            "callbacks": self.callbacks,
+            "mean_callback_us": round(self.total_seconds / self.callbacks * 1e6, 1) if self.callbacks else 0.0,
+            "max_callback_us": round(self.max_seconds * 1e6, 1),
+            "last_load": round(self.last_load, 4),
+            "mean_load": round(self.mean_load, 4),
+            "peak_load": round(self.peak_load, 4),
+            "late_callbacks": self.late,
+            "output_underflows": self.underflows,
+            "output_overflows": self.overflows,
+            "dropped_blocks": self.dropped,
+            "histogram_us": dict(self.histogram()),
+        }
+
+    def to_json(self, **kwargs):
+        # The snapshot as a JSON string
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def dump(self, filepath):
+        # Write the snapshot to a JSON file
+        with open(filepath, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
@@ -0,0 +1,195 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from beat_grid import BeatGrid, save_beat_grid
+from mixer import sample_scale
+from song_loader import compile_song, song_files
+from stem_format import load_stem
+
+# Configure logging for debugging purposes
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+# Constants
+SONG_DIR = "MusicJSONs"  # Library analysed when no songs are given
+FRAME_SIZE = 2048  # Samples per spectrum of the onset detector
+HOP_SIZE = 512  # Samples between spectra (onset envelope resolution)
+ONSET_LATENCY = HOP_SIZE  # Samples the flux of an onset peaks before it (log spectra jump as it enters a window)
+FFT_BATCH = 2048  # Spectra computed per batch, which bounds the memory used on long songs
+READ_CHUNK = 1 << 20  # Frames of a stem mixed down at a time
+COMPRESSION = 100.0  # Log compression of spectral magnitudes before the flux
+TREND_SECONDS = 1.0  # Window of the moving average removed from the onset envelope
+TEMPO_TOLERANCE = 0.08  # Measured tempo must lie within this fraction of the declared bpm
+PEAK_WINDOW = 0.15  # Fraction of a beat searched for an onset around each predicted beat
+PHASE_STEP = 0.25  # Resolution of the phase search, in hops
+MIN_FIT_BEATS = 16  # Fewer clear onsets than this and the declared grid is kept
+
+
+def mixdown(spec):
+    # Mono float32 sum of every stem of the song's longest segment (its layers are time-aligned)
+    segment = max(spec.segments, key=lambda segment: max(layer.metadata.frames for layer in segment.layers))
+    mono = np.zeros(max(layer.metadata.frames for layer in segment.layers), dtype=np.float32)
+    for layer in segment.layers:
+        data = load_stem(layer.file_name, layer.info, spec.sample_rate)
+        scale = np.float32(sample_scale(data.dtype) / data.shape[1])
+        for start in range(0, len(data), READ_CHUNK):
+            block = data[start:start + READ_CHUNK]
+            target = mono[start:start + len(block)]
+            target += block.sum(axis=1, dtype=np.float32) * scale
+    return mono
+
+
+def onset_strength(mono, sample_rate):
+    # Spectral flux onset envelope: one value per hop, for the spectrum centred on sample hop * i. With the log
+    # compression an onset already stands out at the tapered edge of a window, so its flux peaks about
+    # ONSET_LATENCY samples before the onset itself.
+    padded = np.pad(mono, (FRAME_SIZE // 2, FRAME_SIZE // 2))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, FRAME_SIZE)[::HOP_SIZE]
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    flux = np.zeros(len(windows), dtype=np.float64)
+    previous = None
+    for start in range(0, len(windows), FFT_BATCH):
+        spectra = np.log1p(COMPRESSION * np.abs(np.fft.rfft(windows[start:start + FFT_BATCH] * window, axis=1)))
+        first = spectra[:1] if previous is None else previous[np.newaxis]
+        rises = np.diff(spectra, axis=0, prepend=first)
+        flux[start:start + len(spectra)] = np.maximum(rises, 0.0).sum(axis=1)
+        previous = spectra[-1]
+
+    # Keep what stands out from the local loudness, so quiet and loud passages weigh the same
+    trend_hops = max(1, int(TREND_SECONDS * sample_rate / HOP_SIZE))
+    trend = np.convolve(flux, np.ones(trend_hops) / trend_hops, mode="same")
+    return np.maximum(flux - trend, 0.0)
+
+
+def estimate_period(envelope, declared_period):
+    # Beat period in hops near declared_period: the lag whose multiples (1 to 4 beats) the autocorrelation of
+    # the envelope favours most, refined between lags by a parabola through its neighbours
+    count = len(envelope)
+    centred = envelope - envelope.mean()
+    autocorrelation = np.fft.irfft(np.abs(np.fft.rfft(centred, 2 * count)) ** 2)[:count]
+    low = max(2, int(declared_period * (1 - TEMPO_TOLERANCE)))
+    high = min(count // 4 - 1, int(np.ceil(declared_period * (1 + TEMPO_TOLERANCE))))
+    if high <= low:
+        return declared_period  # Too short to measure
+    lags = np.arange(low, high + 1)
+    score = sum(autocorrelation[lags * multiple] for multiple in range(1, 5))
+    lag = int(lags[np.argmax(score)])
+    before, peak, after = autocorrelation[lag - 1:lag + 2]
+    curvature = before - 2 * peak + after
+    return lag + (0.5 * (before - after) / curvature if curvature < 0 else 0.0)
+
+
+def estimate_phase(envelope, period):
+    # Offset in hops (0 <= phase < period) of the beat comb that collects the most onset strength
+    phases = np.arange(0.0, period, PHASE_STEP)
+    beats = np.arange(int((len(envelope) - 1) // period))
+    positions = phases[:, np.newaxis] + beats[np.newaxis, :] * period
+    score = np.interp(positions, np.arange(len(envelope)), envelope).sum(axis=1)
+    return float(phases[np.argmax(score)])
+
+
+def refine_grid(envelope, phase, period):
+    # Fit offset + k * period (in hops) through the strongest onset near every predicted beat, weighted by
+    # strength. Returns (offset, period, beats fitted); the estimate is returned unchanged if too few beats stand out.
+    reach = max(1, int(PEAK_WINDOW * period))
+    beats = np.arange(int((len(envelope) - 1 - phase) // period) + 1)
+    if len(beats) < MIN_FIT_BEATS:
+        return phase, period, 0
+    predicted = np.rint(phase + beats * period).astype(np.int64)
+    candidates = np.clip(predicted[:, np.newaxis] + np.arange(-reach, reach + 1)[np.newaxis, :], 1, len(envelope) - 2)
+    values = envelope[candidates]
+    peaks = candidates[np.arange(len(beats)), np.argmax(values, axis=1)]
+    strength = envelope[peaks]
+
+    # Sub-hop peak positions from a parabola through each peak and its neighbours
+    before, after = envelope[peaks - 1], envelope[peaks + 1]
+    curvature = before - 2 * strength + after
+    shift = np.divide(0.5 * (before - after), curvature, out=np.zeros_like(strength), where=curvature < 0)
+    positions = peaks + np.clip(shift, -0.5, 0.5)
+
+    keep = strength > max(np.median(strength), 0.0)
+    if keep.sum() < MIN_FIT_BEATS:
+        return phase, period, 0
+    slope, intercept = np.polyfit(beats[keep], positions[keep], 1, w=strength[keep])
+    return float(intercept), float(slope), int(keep.sum())
+
+
+def analyze_song(filepath):
+    # Measure a song's beat grid from its stems and compare it with the bpm its JSON declares. Returns a report
+    # dictionary; its "grid" is the refined BeatGrid, or None if the song has no clear enough beat.
+    spec = compile_song(filepath)  # Declared grid, whatever an earlier analysis stored
+    sample_rate = spec.sample_rate
+    mono = mixdown(spec)
+    envelope = onset_strength(mono, sample_rate)
+    declared = BeatGrid.from_bpm(spec.bpm, sample_rate)
+
+    period = estimate_period(envelope, declared.period / HOP_SIZE)
+    phase = estimate_phase(envelope, period)
+    offset, period, fitted = refine_grid(envelope, phase, period)
+    grid = BeatGrid((offset * HOP_SIZE + ONSET_LATENCY) % (period * HOP_SIZE), period * HOP_SIZE)
+    if fitted == 0 or abs(grid.period / declared.period - 1) > TEMPO_TOLERANCE:
+        grid = None
+
+    measured = grid or declared
+    last_beat = max(0, measured.beat_index(len(mono)))
+    truncated = int((60 / spec.bpm) * sample_rate)  # Frames per beat before beat grids (rounded down every beat)
+    return {
+        "song": filepath,
+        "sample_rate": sample_rate,
+        "declared_bpm": spec.bpm,
+        "measured_bpm": measured.bpm(sample_rate),
+        "first_beat_ms": measured.offset / sample_rate * 1000,
+        "beats": last_beat,
+        "fitted_beats": fitted,
+        "declared_drift_ms": (declared.frame(last_beat) - measured.frame(last_beat)) / sample_rate * 1000,
+        "truncation_drift_ms": (last_beat * truncated - measured.frame(last_beat)) / sample_rate * 1000,
+        "grid": grid,
+        "dependencies": [filepath] + song_files(spec),
+    }
+
+
+def analyze_and_store(filepath, write=True):
+    # Analyse a song and (unless write is False) store its refined grid in the sidecar the engine loads
+    report = analyze_song(filepath)
+    if write and report["grid"] is not None:
+        save_beat_grid(filepath, report["dependencies"], report["grid"])
+    return report
+
+
+def describe(report):
+    # One log line summarising an analysis report
+    if report["grid"] is None:
+        return f"{report['song']}: no clear beat found, keeping the declared {report['declared_bpm']} bpm"
+    return (f"{report['song']}: {report['declared_bpm']} bpm declared, {report['measured_bpm']:.3f} measured, "
+            f"first beat at {report['first_beat_ms']:.1f} ms ({report['fitted_beats']} of {report['beats']} beats fitted). "
+            f"Drift by the last beat: {report['declared_drift_ms']:+.1f} ms with the declared bpm, "
+            f"{report['truncation_drift_ms']:+.1f} ms with whole samples per beat")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the beat grid of song JSONs and store it for playback.")
+    parser.add_argument("songs", nargs="*", help=f"Song JSON files (default: every song in {SONG_DIR}/)")
+    parser.add_argument("--workers", type=int, default=None, help="Analysis processes (default: one per CPU)")
+    parser.add_argument("--dry-run", action="store_true", help="Report drift without storing the refined grids")
+    args = parser.parse_args(argv)
+
+    songs = args.songs or sorted(glob.glob(os.path.join(SONG_DIR, "*.json")))
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(analyze_and_store, song, not args.dry_run): song for song in songs}
+        for future in as_completed(futures):
+            try:
+                logging.info(describe(future.result()))
+            except Exception as e:
+                logging.error(f"Error analysing {futures[future]}: {e}")
+                failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+
+from disk_cache import load_cached, save_cached
+
+# Constants
+GRID_SUFFIX = ".beatgrid.pickle"  # Sidecar holding a song's refined BeatGrid (written by beat_analysis.py)
+GRID_VERSION = 1  # Bump whenever BeatGrid changes shape
+
+
+class BeatGrid:
+    __slots__ = ("offset", "period")
+
+    def __init__(self, offset, period):
+        # Beat k of a song is heard at frame offset + k * period. Both are fractional, so frames are rounded per
+        # beat rather than the period per song, and the grid never drifts however many beats a song has.
+        self.offset = float(offset)  # Frame of the first beat (0 <= offset < period)
+        self.period = float(period)  # Exact frames per beat
+
+    @classmethod
+    def from_bpm(cls, bpm, sample_rate):
+        # Grid of a declared bpm with the first beat on the first frame
+        return cls(0.0, 60.0 * sample_rate / bpm)
+
+    def __eq__(self, other):
+        return isinstance(other, BeatGrid) and (self.offset, self.period) == (other.offset, other.period)
+
+    def __hash__(self):
+        return hash((self.offset, self.period))
+
+    def __repr__(self):
+        return f"BeatGrid(offset={self.offset:.3f}, period={self.period:.4f})"
+
+    def bpm(self, sample_rate):
+        # Tempo of the grid in beats per minute
+        return 60.0 * sample_rate / self.period
+
+    def frame(self, beat):
+        # Frame of beat number beat (negative beats lie before the first one)
+        return math.floor(self.offset + beat * self.period + 0.5)
+
+    def frames_of(self, beats):
+        # Frames of an array of beat numbers (int64)
+        return np.floor(self.offset + np.asarray(beats, dtype=np.float64) * self.period + 0.5).astype(np.int64)
+
+    def frames(self, beats):
+        # Length of a duration in beats, in frames
+        return math.floor(beats * self.period + 0.5)
+
+    def beat_index(self, frame):
+        # Number of the last beat at or before frame (-1 before the first beat)
+        return math.ceil((frame + 0.5 - self.offset) / self.period) - 1
+
+    def next_beat(self, frame, every=1):
+        # (frame, beat number) of the first beat at or after frame whose number is a multiple of every
+        # (every=BEATS_PER_BAR finds the next downbeat)
+        beat = self.beat_index(frame - 1) + 1
+        beat = -(-beat // every) * every
+        return self.frame(beat), beat
+
+
+def load_beat_grid(filepath):
+    # Refined BeatGrid of a song JSON, or None if it has not been analysed (or its JSON or stems changed since)
+    return load_cached(filepath, GRID_SUFFIX, GRID_VERSION)
+
+
+def save_beat_grid(filepath, dependencies, grid):
+    # Store a refined BeatGrid next to a song JSON, valid until any of the dependency files changes
+    save_cached(filepath, GRID_SUFFIX, GRID_VERSION, dependencies, grid)
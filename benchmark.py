@@ -0,0 +1,427 @@
+import argparse
+import gc
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import wave
+from datetime import datetime, timezone
+
+import numpy as np
+
+from disk_cache import sidecar_path
+from engine import PlaybackEngine, DEFAULT_BLOCK_SIZE
+from mixer import Layer, LayerLoop, LayerMixer
+from offline_render import render_song
+from playlist import OUTPUT_CHANNELS, Playlist, prepare_track
+from ring_buffer import MixWorker
+from scheduler import PLAY_SEGMENT
+from song_loader import PLAN_SUFFIX, load_song, load_segments
+from stem_cache import stem_cache
+from transitions import CURVE_EQUAL_POWER
+
+# Configure logging for debugging purposes
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+# Constants
+WORK_DIR = "Benchmarks"  # Where the synthetic stems and song JSONs are generated (and reused on later runs)
+OUTPUT_FILE = "benchmark.json"  # Results of the last run
+BASELINE_FILE = "benchmark_baseline.json"  # Results the last run is compared against
+RESULTS_VERSION = 2  # Bump whenever a metric changes meaning, so older baselines are not compared against
+SEED = 1234  # Seed of the synthetic audio, so every run measures the same samples
+BPM = 120  # Tempo of the synthetic songs
+BLOCK_SIZES = (64, 256, 1024, 4096)  # Device block sizes the callback cost is measured at
+MIX_LAYER_COUNTS = (1, 4, 16, 32)  # Layer counts the mixing throughput is measured at
+CALLBACK_BLOCKS = 2000  # Blocks timed per block size
+LIBRARY_SONGS = 20  # Songs in the library the startup benchmark scans
+LOOP_BEATS = 4  # Length of the loops in the seam benchmark
+LOOP_FADE_BEATS = 1  # Crossfade at each of those seams
+TOLERANCE = 0.15  # Relative change beyond which a metric counts as a regression
+STARTUP_TARGET_SECONDS = 0.5  # Longest acceptable time from starting the player to a playable first song
+STARTUP_MODULES = ("playlist", "song_loader", "stem_cache", "waveform", "wav_reader", "audio_metrics")  # What player.py imports besides Tk
+BENCHMARKS = ("load", "startup", "memory", "callback", "mixing", "loop_seam", "render")
+HIGHER_IS_BETTER = ("_x_realtime",)  # Metric suffixes where a drop is a regression; for every other metric a rise is
+REPORT_ONLY = ("_max_us", "_rss_bytes")  # Metric suffixes too noisy to flag (reported and stored, never compared)
+
+
+def write_stem(path, frames, sample_rate, seed):
+    # Write a 16-bit stereo WAV of a few detuned partials over quiet noise, the same for the same seed
+    rng = np.random.default_rng(seed)
+    t = np.arange(frames, dtype=np.float64) / sample_rate
+    data = rng.normal(0.0, 0.02, (frames, 2))
+    for frequency in rng.uniform(55.0, 1760.0, 3):
+        phase = rng.uniform(0.0, 2 * np.pi, 2)
+        data += 0.1 * np.sin(2 * np.pi * frequency * t[:, np.newaxis] + phase)
+    with wave.open(path, 'wb') as wf:
+        wf.setnchannels(2)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes((np.clip(data, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+
+
+def generate_song(work_dir, layers, seconds, sample_rate):
+    # Song JSON with one segment of layers synthetic stems of the given length, all playing once from the start.
+    # Stems are named after everything that shapes them, so a later run with the same settings reuses them.
+    os.makedirs(work_dir, exist_ok=True)
+    frames = int(seconds * sample_rate)
+    layer_infos = []
+    for index in range(layers):
+        path = os.path.abspath(os.path.join(work_dir, f"stem{index}_{seconds:g}s_{sample_rate}hz_{SEED}.wav"))
+        if not os.path.exists(path):
+            write_stem(path, frames, sample_rate, SEED + index)
+        layer_infos.append({"layerName": f"Layer {index}", "fileName": path, "playMode": "once",
+                            "transitionInType": "fade", "transitionOutType": "fade", "transitionDuration": 1.0})
+    song = {"title": "Benchmark", "bpm": BPM, "songType": "linear",
+            "segments": [{"segmentName": "MAIN", "layers": layer_infos}],
+            "linearPlaybackTimeline": [{"action": PLAY_SEGMENT, "segment": "MAIN",
+                                        "layers": [info["layerName"] for info in layer_infos]}]}
+    json_path = os.path.join(work_dir, f"bench_{layers}x{seconds:g}s_{sample_rate}hz.json")
+    with open(json_path, 'w') as f:
+        json.dump(song, f, indent=4)
+    return json_path
+
+
+def generate_library(work_dir, songs, layers, seconds, sample_rate):
+    # Directory of songs song JSONs like generate_song()'s (sharing its stems), standing in for the player's
+    # song library. Returns the directory.
+    with open(generate_song(work_dir, layers, seconds, sample_rate), 'r') as f:
+        song = json.load(f)
+    library = os.path.join(work_dir, f"library_{songs}x{layers}x{seconds:g}s_{sample_rate}hz")
+    os.makedirs(library, exist_ok=True)
+    for index in range(songs):
+        song["title"] = f"Benchmark {index + 1}"
+        with open(os.path.join(library, f"song{index + 1:03d}.json"), 'w') as f:
+            json.dump(song, f, indent=4)
+    return library
+
+
+def clear_stem_cache():
+    # Drop every stem held in memory, so the next load reads from disk
+    budget = stem_cache.budget_bytes
+    stem_cache.set_budget(0)
+    stem_cache.set_budget(budget)
+
+
+def timed(function, *args):
+    # Seconds one call takes, with the garbage collector kept out of the measurement
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - started
+    finally:
+        gc.enable()
+
+
+def median_time(repeats, function, *args):
+    # Median seconds of several calls
+    return float(np.median([timed(function, *args) for _ in range(repeats)]))
+
+
+def duration_stats(prefix, samples_ns):
+    # Median, 99th percentile and maximum of per-block times, in microseconds
+    samples = np.asarray(samples_ns, dtype=np.float64) * 1e-3
+    return {f"{prefix}_median_us": float(np.median(samples)), f"{prefix}_p99_us": float(np.percentile(samples, 99)),
+            f"{prefix}_max_us": float(samples.max())}
+
+
+def playing_layers(segment, loop=False):
+    # Enabled copies of a segment's layers, optionally looping over their whole file so they never run out
+    return [Layer(layer.name, layer.data, metadata=layer.metadata, loop=LayerLoop(0, layer.frames) if loop else None)
+            for layer in segment]
+
+
+def bench_load(json_path, repeats):
+    # Compiling the song JSON, loading its cached plan, and reading its stems from disk and from the stem cache
+    def cold_stems():
+        clear_stem_cache()
+        load_segments(load_song(json_path))
+
+    song = load_song(json_path)
+    return {"compile_seconds": median_time(repeats, load_song, json_path, False),
+            "plan_seconds": median_time(repeats, load_song, json_path),
+            "stems_cold_seconds": median_time(repeats, cold_stems),
+            "stems_warm_seconds": median_time(repeats, load_segments, song)}
+
+
+def bench_startup(library, repeats, target):
+    # What stands between starting the player and Play being enabled, from a cold library (no compiled plans,
+    # nothing in the stem cache): importing its modules (in a fresh interpreter) and quickly preparing the first
+    # song, compiling its plan included. Preparing it with every stem read into memory, as before the player
+    # loaded songs in the background, is measured for comparison, and so is the cold scan of the whole library
+    # that the loader thread runs once the first song is playable.
+    command = [sys.executable, "-c", "import time; started = time.perf_counter(); "
+                                     f"import {', '.join(STARTUP_MODULES)}; print(time.perf_counter() - started)"]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    imports = [float(subprocess.run(command, cwd=directory, capture_output=True, text=True, check=True).stdout)
+               for _ in range(repeats)]
+    paths = sorted(glob.glob(os.path.join(library, "*.json")))
+
+    def clear_plans():
+        for path in paths:
+            try:
+                os.remove(sidecar_path(path, PLAN_SUFFIX))
+            except FileNotFoundError:
+                pass
+
+    def prepare_seconds(quick):
+        clear_plans()
+        clear_stem_cache()
+        seconds = timed(prepare_track, paths[0], OUTPUT_CHANNELS, quick)
+        load_segments(load_song(paths[0]), OUTPUT_CHANNELS)  # Wait for the background copies before the next run
+        return seconds
+
+    def scan_seconds():
+        clear_plans()
+        return timed(Playlist.from_directory, library)
+
+    results = {"import_seconds": float(np.median(imports)),
+               "ready_seconds": float(np.median([prepare_seconds(True) for _ in range(repeats)])),
+               "full_load_seconds": float(np.median([prepare_seconds(False) for _ in range(repeats)])),
+               "library_scan_seconds": float(np.median([scan_seconds() for _ in range(repeats)])),
+               "target_seconds": target}
+    results["time_to_play_seconds"] = results["import_seconds"] + results["ready_seconds"]
+    return results
+
+
+def bench_memory(json_path, render_path):
+    # Peak memory Python and NumPy allocate while a song loads its stems and renders from start to end
+    clear_stem_cache()
+    tracemalloc.start()
+    try:
+        load_segments(load_song(json_path))
+        render_song(json_path, render_path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    results = {"peak_traced_bytes": peak}
+    try:
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KiB elsewhere
+        results["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        pass  # No resource module on Windows
+    return results
+
+
+def bench_callback(song, segment, block_sizes, blocks):
+    # Per block, at each device block size: the mix worker rendering the engine (every layer playing) and the
+    # audio callback copying the block out of the ring buffer, which is all the real callback does
+    results = {}
+    for block_size in block_sizes:
+        engine = PlaybackEngine(song.sample_rate, channels=2, bpm=song.bpm, grid=song.beat_grid)
+        engine.load_segment(playing_layers(segment, loop=True))
+        worker = MixWorker(engine, song.sample_rate, 2, max(2 * block_size, DEFAULT_BLOCK_SIZE), block_size)
+        block = np.zeros((block_size, 2), dtype=np.float32)
+        outdata = np.zeros((block_size, 2), dtype=np.float32)
+        for _ in range(8):  # Warm up: first fades, page faults and buffer allocations
+            engine.render(block, block_size)
+        render_ns, callback_ns = np.zeros(blocks, dtype=np.int64), np.zeros(blocks, dtype=np.int64)
+        gc.collect()
+        gc.disable()
+        try:
+            for index in range(blocks):
+                started = time.perf_counter_ns()
+                engine.render(block, block_size)
+                render_ns[index] = time.perf_counter_ns() - started
+                worker.ring.write(block)
+                started = time.perf_counter_ns()
+                worker.render(outdata, block_size)
+                callback_ns[index] = time.perf_counter_ns() - started
+        finally:
+            gc.enable()
+        block_us = block_size / song.sample_rate * 1e6
+        stats = duration_stats("render", render_ns)
+        stats.update(duration_stats("callback", callback_ns))
+        stats["render_p99_load"] = stats["render_p99_us"] / block_us  # Share of the block's duration
+        results[str(block_size)] = stats
+    return results
+
+
+def bench_mixing(song, segment, layer_counts, seconds, repeats):
+    # Mixer throughput with 1, 4, ... layers playing at once (stems reused when there are more layers than stems)
+    results = {}
+    frames = min(int(seconds * song.sample_rate), min(layer.frames for layer in segment))
+    for count in layer_counts:
+        mixer = LayerMixer(2)
+        mixer.set_layers(playing_layers([segment[index % len(segment)] for index in range(count)]))
+        block = np.zeros((DEFAULT_BLOCK_SIZE, 2), dtype=np.float32)
+
+        def mix():
+            for position in range(0, frames - DEFAULT_BLOCK_SIZE + 1, DEFAULT_BLOCK_SIZE):
+                mixer.mix(block, position, DEFAULT_BLOCK_SIZE)
+
+        mix()  # Warm up
+        elapsed = median_time(repeats, mix)
+        results[str(count)] = {"mix_x_realtime": frames / song.sample_rate / elapsed,
+                               "mix_seconds_per_layer_minute": elapsed / count / (frames / song.sample_rate) * 60}
+    return results
+
+
+def bench_loop_seam(song, segment, seconds):
+    # Cost of blocks that wrap a loop or fall in its seam crossfade, against blocks that do neither, with every
+    # layer looping LOOP_BEATS beats with a LOOP_FADE_BEATS crossfade
+    period = song.beat_grid.period
+    start = int(period * LOOP_BEATS)
+    length = int(period * LOOP_BEATS)
+    fade = int(period * LOOP_FADE_BEATS)
+    layers = [Layer(layer.name, layer.data, metadata=layer.metadata,
+                    loop=LayerLoop(start, min(layer.frames - fade, start + length), CURVE_EQUAL_POWER, fade))
+              for layer in segment]
+    loop = layers[0].loop
+    mixer = LayerMixer(2)
+    mixer.set_layers(layers)
+    block = np.zeros((DEFAULT_BLOCK_SIZE, 2), dtype=np.float32)
+    seam_ns, plain_ns = [], []
+    gc.collect()
+    gc.disable()
+    try:
+        for position in range(0, int(seconds * song.sample_rate), DEFAULT_BLOCK_SIZE):
+            first, last = loop.source_frame(position), loop.source_frame(position + DEFAULT_BLOCK_SIZE - 1)
+            seam = last < first or (position >= loop.end and first - loop.start < loop.fade_frames)
+            started = time.perf_counter_ns()
+            mixer.mix(block, position, DEFAULT_BLOCK_SIZE)
+            (seam_ns if seam else plain_ns).append(time.perf_counter_ns() - started)
+    finally:
+        gc.enable()
+    results = duration_stats("seam", seam_ns)
+    results.update(duration_stats("plain", plain_ns))
+    results["seam_overhead_ratio"] = results["seam_median_us"] / results["plain_median_us"]
+    return results
+
+
+def bench_render(json_path, render_path, repeats):
+    # Offline render of the whole song to a WAV file, as offline_render.py does it
+    durations = []
+    elapsed = median_time(repeats, lambda: durations.append(render_song(json_path, render_path)))
+    return {"render_seconds": elapsed, "render_x_realtime": durations[0] / elapsed}
+
+
+def run_benchmarks(args):
+    # Generate the synthetic song and run the selected benchmarks on it; returns {benchmark: {metric: value}}
+    json_path = generate_song(args.work_dir, args.layers, args.seconds, args.sample_rate)
+    render_path = os.path.join(args.work_dir, "render.wav")
+    song = load_song(json_path)
+    segment = load_segments(song, 2)["MAIN"]
+    results = {}
+    for name in args.only or BENCHMARKS:
+        logging.info(f"Running {name}")
+        if name == "load":
+            results[name] = bench_load(json_path, args.repeats)
+        elif name == "startup":
+            library = generate_library(args.work_dir, args.library_songs, args.layers, args.seconds, args.sample_rate)
+            results[name] = bench_startup(library, args.repeats, args.startup_target)
+        elif name == "memory":
+            results[name] = bench_memory(json_path, render_path)
+        elif name == "callback":
+            results[name] = bench_callback(song, segment, args.block_sizes, args.callback_blocks)
+        elif name == "mixing":
+            results[name] = bench_mixing(song, segment, args.mix_layers, args.seconds, args.repeats)
+        elif name == "loop_seam":
+            results[name] = bench_loop_seam(song, segment, args.seconds)
+        elif name == "render":
+            results[name] = bench_render(json_path, render_path, args.repeats)
+    return results
+
+
+def flatten(results, prefix=""):
+    # {"callback": {"256": {"render_p99_us": ...}}} -> {"callback.256.render_p99_us": ...}
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    # {metric: {"value", "baseline", "change", "regression"}} for every metric both runs have; change is relative
+    # to the baseline, and a regression is a change beyond tolerance in the wrong direction
+    current, previous = flatten(results), flatten(baseline)
+    comparison = {}
+    for name, value in current.items():
+        base = previous.get(name)
+        if base is None or name.endswith(REPORT_ONLY):
+            continue
+        change = (value - base) / base if base else 0.0
+        worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+        comparison[name] = {"value": value, "baseline": base, "change": change, "regression": worse > tolerance}
+    return comparison
+
+
+def environment():
+    # What the numbers were measured on, since they only compare within one machine
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark loading, mixing, the audio callback and offline rendering "
+                                                 "on synthetic songs, and compare against a stored baseline.")
+    parser.add_argument("--layers", type=int, default=8, help="Stems in the synthetic song")
+    parser.add_argument("--seconds", type=float, default=60.0, help="Length of the synthetic song")
+    parser.add_argument("--library-songs", type=int, default=LIBRARY_SONGS, help="Songs in the library the startup benchmark scans")
+    parser.add_argument("--sample-rate", type=int, default=44100, help="Sample rate of the synthetic stems")
+    parser.add_argument("--block-sizes", type=int, nargs="+", default=BLOCK_SIZES, help="Block sizes of the callback benchmark")
+    parser.add_argument("--callback-blocks", type=int, default=CALLBACK_BLOCKS, help="Blocks timed per block size")
+    parser.add_argument("--mix-layers", type=int, nargs="+", default=MIX_LAYER_COUNTS, help="Layer counts of the mixing benchmark")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of each timed step (the median is kept)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="Run only these benchmarks")
+    parser.add_argument("--work-dir", default=WORK_DIR, help="Directory for the synthetic stems and songs")
+    parser.add_argument("-o", "--output", default=OUTPUT_FILE, help="JSON file the results are written to")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Results to compare against (skipped if missing)")
+    parser.add_argument("--save-baseline", action="store_true", help="Also store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Relative change that counts as a regression")
+    parser.add_argument("--startup-target", type=float, default=STARTUP_TARGET_SECONDS,
+                        help="Longest acceptable startup time to a playable song, in seconds")
+    args = parser.parse_args(argv)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "save_baseline")}
+    config["block_sizes"], config["mix_layers"] = list(args.block_sizes), list(args.mix_layers)
+    report = {"version": RESULTS_VERSION, "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+              "environment": environment(), "config": config, "results": run_benchmarks(args)}
+
+    regressions = 0
+    try:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = None
+        logging.info(f"No baseline at {args.baseline}; not comparing")
+    if baseline is not None and baseline.get("version") != RESULTS_VERSION:
+        logging.warning(f"{args.baseline} is from another results version; not comparing")
+    elif baseline is not None:
+        if baseline.get("config") != config or baseline.get("environment") != report["environment"]:
+            logging.warning(f"{args.baseline} was measured with other settings or on another machine")
+        report["comparison"] = compare(report["results"], baseline["results"], args.tolerance)
+        for name, entry in report["comparison"].items():
+            if entry["regression"]:
+                regressions += 1
+                logging.warning(f"Regression: {name} {entry['baseline']:.4g} -> {entry['value']:.4g} ({entry['change']:+.1%})")
+        logging.info(f"{len(report['comparison'])} metrics compared, {regressions} regressed beyond {args.tolerance:.0%}")
+
+    startup = report["results"].get("startup")
+    if startup is not None and startup["time_to_play_seconds"] > startup["target_seconds"]:
+        regressions += 1
+        logging.warning(f"Startup took {startup['time_to_play_seconds']:.3f}s, over the {startup['target_seconds']:.3f}s target")
+
+    for name, value in flatten(report["results"]).items():
+        logging.info(f"{name}: {value:.6g}")
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Stored the results as the baseline in {args.baseline}")
+    return 1 if regressions else 0  # A missed startup target fails the run like a regression
+
+
+if __name__ == "__main__":
+    sys.exit(main())
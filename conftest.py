@@ -0,0 +1 @@
+# Lets pytest import the player's modules from the repository root (tests live in tests/)
@@ -0,0 +1,53 @@
+import logging
+import os
+import pickle
+
+# Constants
+CACHE_DIR = ".dmpcache"  # Sidecar directory created next to the files it caches
+
+
+def sidecar_path(source_path, suffix):
+    # Path of the cache file for source_path, e.g. MusicJSONs/.dmpcache/Song.json.plan.pickle
+    directory, name = os.path.split(os.path.abspath(source_path))
+    return os.path.join(directory, CACHE_DIR, name + suffix)
+
+
+def file_stamps(paths):
+    # (path, mtime in ns, size) of each file, used to tell whether a cache entry is still fresh
+    stamps = []
+    for path in paths:
+        stat = os.stat(path)
+        stamps.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(stamps)
+
+
+def load_cached(source_path, suffix, version):
+    # Value cached for source_path, or None if there is none, it was written by another cache version,
+    # or any file it was built from has changed since
+    path = sidecar_path(source_path, suffix)
+    try:
+        with open(path, 'rb') as f:
+            cached_version, stamps, value = pickle.load(f)
+        if cached_version != version or file_stamps(path for path, _, _ in stamps) != stamps:
+            return None
+        return value
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable cache {path}: {e}")
+        return None
+
+
+def save_cached(source_path, suffix, version, dependencies, value):
+    # Cache value for source_path, valid until any of the dependency files changes. Failing to write
+    # the cache (e.g. a read-only library) only costs the next load its speed.
+    path = sidecar_path(source_path, suffix)
+    try:
+        stamps = file_stamps(dependencies)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            pickle.dump((version, stamps, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)  # Readers never see a half-written file
+    except OSError as e:
+        logging.warning(f"Could not write cache {path}: {e}")
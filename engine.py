@@ -0,0 +1,457 @@
+import collections
+import logging
+import numpy as np
+
+from beat_grid import BeatGrid
+from event_trace import tracer, TRACING
+from mixer import LayerMixer, DEFAULT_BLOCK_SIZE, touch_frames
+from resampler import resample, resampled_length
+from transitions import CURVE_CUT, CURVE_LINEAR, CURVE_EQUAL_POWER, curve_values
+from transport import TransportClock, BEATS_PER_BAR
+
+# Constants
+DECLICK_SECONDS = 0.01  # Shortest gain change, so cutting a layer in or out never clicks
+SEEK_CROSSFADE_SECONDS = 0.02  # Crossfade from the old to the new position of a seek made while playing
+PREFETCH_SECONDS = 2.0  # Audio of a variant paged in past the switch boundary before it becomes audible
+TRACE_SEGMENT = tracer.event("load_segment")  # arg: number of layers
+
+
+class LayerMetadata:
+    __slots__ = ("frames", "sample_rate", "channels", "sample_width", "duration", "total_beats", "total_bars")
+
+    def __init__(self, frames, sample_rate, channels, sample_width, grid):
+        # Facts about a layer's audio, computed once at load time so nothing has to reopen the file
+        self.frames = frames  # Number of audio frames
+        self.sample_rate = sample_rate  # Frames per second
+        self.channels = channels  # Number of channels
+        self.sample_width = sample_width  # Bytes per sample
+        self.duration = frames / float(sample_rate)  # Length in seconds
+        self.total_beats = (frames - grid.offset) / grid.period  # Beats of the BeatGrid up to the end (fractional)
+        self.total_bars = self.total_beats / BEATS_PER_BAR  # Length in bars (fractional)
+
+    @classmethod
+    def from_wav_info(cls, info, grid, sample_rate=None):
+        # Build the metadata from a parsed WAV header, for the file as played at sample_rate (default its own)
+        # on the song's BeatGrid
+        sample_rate = sample_rate or info.sample_rate
+        frames = resampled_length(info.frames, info.sample_rate, sample_rate)
+        return cls(frames, sample_rate, info.channels, info.sample_width, grid)
+
+
+class EngineState:
+    __slots__ = ("position", "song_position", "bar", "beat", "samples_to_next_beat", "active_layers", "playing")
+
+    def __init__(self, position, song_position, bar, beat, samples_to_next_beat, active_layers, playing):
+        # What the engine is playing at one moment. Built in one go and never modified, so a reader (e.g. the GUI
+        # refresh tick) sees one consistent set of values rather than fields the audio thread changes between reads.
+        self.position = position  # Audible playback position in frames
+        self.song_position = song_position  # Frame of the song files heard (mapped back into the file when it loops)
+        self.bar = bar  # 1-based bar number
+        self.beat = beat  # 1-based beat within the bar
+        self.samples_to_next_beat = samples_to_next_beat
+        self.active_layers = active_layers  # Names of the enabled layers (a tuple)
+        self.playing = playing  # True while the audio thread is advancing the clock
+
+
+class PlaybackEngine:
+    def __init__(self, sample_rate, channels=2, bpm=128, grid=None):
+        # Mixes song layers into output blocks. Live playback and offline rendering both call render(),
+        # so whatever is heard through the speakers is exactly what gets written to disk.
+        # grid is the song's BeatGrid (refined by beat_analysis.py); without one, beats follow bpm exactly.
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bpm = bpm
+        self.grid = grid or BeatGrid.from_bpm(bpm, sample_rate)  # Frame of every beat, without rounding drift
+        self.mixer = LayerMixer(channels)  # Sums the layers of the segment currently playing
+        self.declick_frames = max(1, int(DECLICK_SECONDS * sample_rate))
+        self.position = 0  # Current playback position in frames
+        self.end_position = None  # Frame at which playback stops (None = when every layer runs out)
+        self.fade_start = None  # Frame at which the master fade-out starts
+        self.fade_length = 0  # Length of the master fade-out in frames
+        self.fade_in_start = None  # Frame at which the master fade-in starts (None = no fade-in)
+        self.fade_in_length = 0  # Length of the master fade-in in frames
+        self.clock = TransportClock(sample_rate, self.grid)  # Beat/bar/elapsed time, advanced by render()
+        self.clicks_enabled = False  # Mix metronome clicks into the output
+        self.bar_click = None  # Click for the first beat of a bar, float32 (frames, 1) at the engine's rate
+        self.beat_click = None  # Click for every other beat
+        self.click_sound = None  # Click currently sounding (it may continue from the previous block)
+        self.click_offset = 0  # Frames of click_sound already played
+        self.exclusive = False  # Only one layer (variant) of the segment is audible at a time
+        self.scheduler = None  # TimelineScheduler running the song's linearPlaybackTimeline, if any
+        self.commands = collections.deque()  # (function, args) posted by other threads, run by render() before a block
+        self.seek_at = None  # Playback position at which a quantized seek jumps (None = no seek pending)
+        self.seek_target = 0  # Where that seek jumps to
+        self.seek_from = None  # Position the audio from before a seek continues at while it crossfades out (None = none)
+        self.seek_fade_offset = 0  # Frames of the seek crossfade already rendered
+        # Equal-power crossfade tables, (frames, channels) so applying them never broadcasts
+        rising, falling = curve_values(CURVE_EQUAL_POWER, max(self.declick_frames, int(SEEK_CROSSFADE_SECONDS * sample_rate)))
+        self.seek_rising = np.repeat(rising[:, np.newaxis], channels, axis=1).astype(np.float32)
+        self.seek_falling = np.repeat(falling[:, np.newaxis], channels, axis=1).astype(np.float32)
+        self.allocate_buffers(DEFAULT_BLOCK_SIZE)
+
+    def allocate_buffers(self, block_size):
+        # Preallocate the scratch buffers used by render() so the audio callback never allocates.
+        # Only called again if the device asks for a larger block than any seen before.
+        self.block_capacity = block_size
+        # Buffers are full (frames, channels) shape: broadcasting inside an in-place ufunc makes NumPy allocate
+        self.gains = np.zeros((block_size, self.channels), dtype=np.float32)  # Per-frame master gain
+        self.ramp = np.repeat(np.arange(block_size, dtype=np.float32)[:, np.newaxis], self.channels, axis=1)  # 0, 1, 2, ...
+        self.seek_buffer = np.zeros((block_size, self.channels), dtype=np.float32)  # Audio from before a seek
+
+    def load_segment(self, layers, position=0, exclusive=False):
+        # Replace the playing layers (e.g. when the timeline moves to another segment). In an exclusive segment
+        # the layers are time-aligned variants of the same music and only one of them is heard at a time.
+        self.mixer.set_layers(layers)
+        self.position = position
+        self.exclusive = exclusive
+        self.clock.reset(position)
+        self.seek_at = self.seek_from = None  # Positions of the previous segment mean nothing in this one
+        if TRACING:
+            tracer.instant(TRACE_SEGMENT, len(self.layers))  # The timeline loads segments from the audio thread
+
+    def post(self, function, *args):
+        # Run function(*args) on the audio thread just before the next block is rendered. A fade is several
+        # array writes, so changing one from another thread mid-block could let a block hear half of the change.
+        self.commands.append((function, args))
+
+    def run_commands(self):
+        # Apply every posted command (deque appends and pops are atomic, so no lock is needed)
+        while self.commands:
+            function, args = self.commands.popleft()
+            function(*args)
+
+    def set_click_sounds(self, bar_data, bar_rate, beat_data, beat_rate):
+        # Convert the metronome clicks (float samples, frames x channels, e.g. from decode_wav()) to the engine's
+        # rate and channel count, once, so the audio callback can add them without converting or broadcasting
+        def prepare(data, rate):
+            mono = data.reshape(len(data), -1).astype(np.float32).mean(axis=1, keepdims=True)
+            mono = resample(mono, rate, self.sample_rate)
+            return np.repeat(mono, self.channels, axis=1).astype(np.float32)
+
+        self.bar_click = prepare(bar_data, bar_rate)
+        self.beat_click = prepare(beat_data, beat_rate)
+
+    @property
+    def layers(self):
+        # Layers of the segment currently playing
+        return self.mixer.layers
+
+    def get_layer(self, name):
+        # Find a layer of the current segment by name
+        index = self.mixer.index(name)
+        return None if index is None else self.layers[index]
+
+    def set_layer_enabled(self, name, enabled, immediate=False):
+        # Enable or disable a layer of the current segment by name, with a short de-click ramp
+        # (or instantly, when immediate is set, e.g. before playback starts)
+        if self.get_layer(name) is None:
+            logging.warning(f"Unknown layer: {name}")
+            return
+        length, curve = (0, CURVE_CUT) if immediate else (self.declick_frames, CURVE_LINEAR)
+        self.mixer.curves.get(curve, length)  # Register the curve here rather than on the audio thread
+        self.post(self.apply_layer_fade, name, enabled, None, length, curve)
+
+    def set_layer_gain(self, name, gain):
+        # Change the gain of a layer of the current segment by name
+        layer = self.get_layer(name)
+        if layer is None:
+            logging.warning(f"Unknown layer: {name}")
+            return
+        self.post(self.apply_layer_fade, name, layer.enabled, gain, self.declick_frames, CURVE_LINEAR)
+
+    def apply_layer_fade(self, name, enabled, gain, length, curve):
+        # (Audio thread) Enable or disable a layer, optionally changing its gain, with a fade starting now
+        index = self.mixer.index(name)
+        if index is None:
+            return  # The segment changed since the command was posted
+        layer = self.layers[index]
+        layer.enabled = enabled
+        if gain is not None:
+            layer.gain = gain
+        self.mixer.fade(index, layer.gain if enabled else 0.0, self.mixer.frame, length, curve)
+
+    def set_active_layers(self, names, immediate=False):
+        # Enable exactly the given layers and disable every other one
+        for layer in self.layers:
+            self.set_layer_enabled(layer.name, layer.name in names, immediate)
+        for name in names:
+            if self.get_layer(name) is None:
+                logging.warning(f"Unknown layer: {name}")
+
+    def next_boundary(self, quantize=None):
+        # Mixer frame of the next beat ("beat") or bar ("bar") of the song, or of the next block (None)
+        if quantize is None:
+            return self.mixer.frame
+        boundary, _ = self.grid.next_beat(self.position, BEATS_PER_BAR if quantize == "bar" else 1)
+        return self.mixer.frame + (boundary - self.position)
+
+    def transition_layer(self, name, enabled, quantize=None, at_frame=None):
+        # Fade a layer in or out with the transition from its song JSON. The fade starts on an exact mixer frame:
+        # at_frame if given, otherwise now or on the next beat/bar. Fade-ins start leadInDuration beats early.
+        layer = self.get_layer(name)
+        if layer is None:
+            logging.warning(f"Unknown layer: {name}")
+            return
+        curve, length = self.transition_fade(layer, enabled)
+        self.mixer.curves.get(curve, length)  # Register the curve here rather than on the audio thread
+        self.post(self.apply_transition, name, enabled, quantize, at_frame)
+
+    def transition_fade(self, layer, enabled):
+        # (curve, length in frames) of a layer's fade in or out
+        transition = layer.transition
+        curve = transition.in_curve if enabled else transition.out_curve
+        length = self.beats_to_frames(transition.duration)
+        if curve == CURVE_CUT or length < self.declick_frames:
+            curve, length = CURVE_LINEAR, self.declick_frames  # Cuts still get a de-click ramp
+        return curve, length
+
+    def apply_transition(self, name, enabled, quantize, at_frame):
+        # (Audio thread) Start a layer's transition. The boundary is computed here, from the position of the
+        # block about to be rendered, so a switch requested just before a beat still lands exactly on it.
+        index = self.mixer.index(name)
+        if index is None:
+            return  # The segment changed since the command was posted
+        layer = self.layers[index]
+        if layer.enabled == enabled:
+            return
+        layer.enabled = enabled
+        curve, length = self.transition_fade(layer, enabled)
+        start = self.next_boundary(quantize) if at_frame is None else at_frame
+        if enabled:
+            start = max(self.mixer.frame, start - self.beats_to_frames(layer.transition.lead_in))
+        self.mixer.fade(index, layer.gain if enabled else 0.0, start, length, curve)
+
+    def transition_active_layers(self, names, quantize=None, at_frame=None):
+        # Transition to exactly the given layers: fade those in and every other layer out
+        for layer in self.layers:
+            self.transition_layer(layer.name, layer.name in names, quantize, at_frame)
+        for name in names:
+            if self.get_layer(name) is None:
+                logging.warning(f"Unknown layer: {name}")
+
+    def switch_variant(self, name, quantize="bar"):
+        # Make one variant of an exclusive segment the audible one, crossfading from the current variant with
+        # their transitions on the next beat or bar. Every variant shares the segment's playback position, so a
+        # switch is only a pair of fades: nothing is seeked or reopened.
+        if not self.exclusive:
+            logging.warning(f"Cannot switch to variant {name}: the segment is not exclusive")
+            return
+        layer = self.get_layer(name)
+        if layer is None:
+            logging.warning(f"Unknown variant: {name}")
+            return
+        # Silent variants are skipped by the mixer, so page the new one in here instead of on the audio thread
+        lead = self.next_boundary(quantize) - self.mixer.frame
+        touch_frames(layer, self.position, lead + int(PREFETCH_SECONDS * self.sample_rate))
+        self.transition_active_layers([name], quantize)
+
+    @property
+    def variant(self):
+        # Name of the audible variant of an exclusive segment (the first enabled layer), or None
+        for layer in self.layers:
+            if layer.enabled:
+                return layer.name
+        return None
+
+    def set_timeline(self, scheduler):
+        # Run a TimelineScheduler from the audio thread (None stops running one)
+        self.scheduler = scheduler
+
+    def seek(self, position):
+        # Move the playback position (in frames) at once. Only call this while nothing is rendering (stopped,
+        # paused, or from the audio thread); crossfade_seek() is the way to seek while playing.
+        self.seek_at = self.seek_from = None
+        self.position = max(0, int(position))
+        self.clock.reset(self.position)
+        self.click_sound = None
+        if self.fade_start is not None and self.position < self.fade_start:
+            # Back before the fade-out: the song plays on (the timeline fades it out again when it gets there)
+            self.fade_start = self.end_position = None
+        self.fade_in_start = None  # The seek's own crossfade takes over from a fade-in
+        if self.scheduler is not None:
+            self.scheduler.seek(self.scheduler.origin + self.position)
+
+    def crossfade_seek(self, position, quantize=None):
+        # Seek while playing, without stopping the stream: the audio thread jumps on the next block, or on the next
+        # beat ("beat") or bar ("bar") to the beat or bar nearest position, and crossfades from the old position
+        self.post(self.apply_seek, position, quantize)
+
+    def apply_seek(self, position, quantize):
+        # (Audio thread) Jump now, or arm a quantized jump that render() makes on the exact boundary
+        if quantize is None:
+            self.start_seek(position)
+            return
+        every = BEATS_PER_BAR if quantize == "bar" else 1
+        beat = round((position - self.grid.offset) / self.grid.period / every) * every
+        self.seek_at = self.grid.next_beat(self.position, every)[0]
+        self.seek_target = max(0, self.grid.frame(beat))
+
+    def start_seek(self, position):
+        # (Audio thread) Jump to position, fading the audio that would have followed out over the next few frames
+        previous = self.position
+        self.seek(position)
+        self.seek_from = previous
+        self.seek_fade_offset = 0
+
+    def mix_seek_crossfade(self, outdata, frames):
+        # Crossfade the block just mixed at the new position with the audio from the old one. The old position is
+        # mixed on the same mixer frames, so layer fades and transitions sound the same on both sides.
+        length = min(frames, len(self.seek_rising) - self.seek_fade_offset)
+        previous = self.seek_buffer[:length]
+        mixer_frame = self.mixer.frame
+        self.mixer.frame -= frames
+        self.mixer.mix(previous, self.seek_from, length)
+        self.mixer.frame = mixer_frame
+
+        offset = self.seek_fade_offset
+        target = outdata[:length]
+        np.multiply(target, self.seek_rising[offset:offset + length], out=target)
+        np.multiply(previous, self.seek_falling[offset:offset + length], out=previous)
+        np.add(target, previous, out=target)
+        self.seek_fade_offset += length
+        self.seek_from += length
+        if self.seek_fade_offset >= len(self.seek_rising):
+            self.seek_from = None
+
+    def beats_to_frames(self, beats):
+        # Convert a duration in beats to a number of frames
+        return self.grid.frames(beats)
+
+    def fade_out(self, frames, start=None):
+        # Fade the master output to silence over the given number of frames, from start (a playback position,
+        # default now), and stop there
+        if self.finished:
+            return  # Nothing left to fade
+        self.fade_start = self.position if start is None else max(self.position, int(start))
+        self.fade_length = max(1, int(frames))
+        self.end_position = self.fade_start + self.fade_length
+
+    def fade_in(self, frames, start=None):
+        # Fade the master output in from silence over the given number of frames, from start (a playback position,
+        # default now); nothing before start is heard
+        self.fade_in_start = self.position if start is None else max(self.position, int(start))
+        self.fade_in_length = max(1, int(frames))
+
+    @property
+    def total_frames(self):
+        # Playback position at which the current segment ends (the longest layer), or None if a layer loops forever
+        ends = [layer.end_position for layer in self.layers]
+        if None in ends:
+            return None
+        return max(ends, default=0)
+
+    @property
+    def finished(self):
+        # True once the playback position has reached the end of the song
+        end = self.total_frames if self.end_position is None else self.end_position
+        return end is not None and self.position >= end
+
+    def song_position(self, position=None):
+        # Frame of the song files heard at a playback position (which keeps counting up while layers loop)
+        position = self.position if position is None else position
+        if not self.layers or self.layers[0].loop is None:
+            return position
+        return self.layers[0].loop.source_frame(position)
+
+    def snapshot(self):
+        # EngineState of the audible position (interpolated by the transport clock) and the enabled layers
+        position = self.clock.position()
+        bar, beat, samples_to_next_beat = self.clock.beat_position(position)
+        active_layers = tuple(layer.name for layer in self.layers if layer.enabled)
+        return EngineState(position, self.song_position(position), bar, beat, samples_to_next_beat, active_layers,
+                           self.clock.running)
+
+    def render(self, outdata, frames, output_latency=0.0):
+        # Fill outdata (frames x channels, float) with the next block of audio. output_latency is the time until
+        # the block reaches the DAC, used by the transport clock. Returns the number of frames of the song in the
+        # block: frames, fewer if the song ended inside it (the rest is silence), or 0 if it had already ended.
+        # The block is split wherever a timeline event is due, so each event is applied on its exact sample.
+        self.run_commands()
+        offset = 0
+        while offset < frames:
+            size = frames - offset
+            if self.seek_at is not None:
+                if self.position >= self.seek_at:
+                    self.seek_at = None
+                    self.start_seek(self.seek_target)
+                else:
+                    size = min(size, self.seek_at - self.position)  # Split the block on the seek boundary
+            if self.scheduler is not None:
+                size = self.scheduler.run(self, size)
+            produced = self.render_block(outdata[offset:offset + size], size, output_latency + offset / self.sample_rate)
+            offset += produced
+            if produced < size:
+                outdata[offset:frames] = 0
+                break
+        return offset
+
+    def render_block(self, outdata, frames, output_latency):
+        # Render frames without any timeline event in between; returns how many of them belong to the song.
+        # Everything below writes into outdata or the preallocated scratch buffers with out= arguments,
+        # so a block costs no array allocations on the real-time thread.
+        if self.finished:
+            outdata.fill(0)
+            return 0
+        if frames > self.block_capacity:
+            self.allocate_buffers(frames)
+
+        start = self.position
+        self.clock.advance(start, frames, output_latency)
+        self.mixer.mix(outdata, start, frames)
+        if self.seek_from is not None:
+            self.mix_seek_crossfade(outdata, frames)
+
+        if self.fade_start is not None:
+            # Linear master fade-out towards end_position: gain = 1 - (start + i - fade_start) / fade_length
+            gains = self.gains[:frames]
+            np.multiply(self.ramp[:frames], -1.0 / self.fade_length, out=gains)
+            np.add(gains, 1.0 - (start - self.fade_start) / self.fade_length, out=gains)
+            np.maximum(gains, 0.0, out=gains)
+            np.minimum(gains, 1.0, out=gains)
+            np.multiply(outdata, gains, out=outdata)
+
+        if self.fade_in_start is not None:
+            # Linear master fade-in from fade_in_start: gain = (start + i - fade_in_start) / fade_in_length
+            gains = self.gains[:frames]
+            np.multiply(self.ramp[:frames], 1.0 / self.fade_in_length, out=gains)
+            np.add(gains, (start - self.fade_in_start) / self.fade_in_length, out=gains)
+            np.maximum(gains, 0.0, out=gains)
+            np.minimum(gains, 1.0, out=gains)
+            np.multiply(outdata, gains, out=outdata)
+            if start + frames >= self.fade_in_start + self.fade_in_length:
+                self.fade_in_start = None  # Fully in
+
+        if self.clicks_enabled and self.beat_click is not None:
+            self.mix_clicks(outdata, start, frames)
+
+        end = self.total_frames if self.end_position is None else self.end_position
+        produced = frames
+        if end is not None and start + frames > end:
+            produced = max(0, end - start)
+            outdata[produced:] = 0  # Silence anything past the end of the song
+
+        self.position += frames
+        return produced
+
+    def mix_clicks(self, outdata, start, frames):
+        # Mix metronome clicks into the block, each one starting on the exact frame of its beat
+        offset = 0
+        beat_frame, beat_index = self.grid.next_beat(start)
+        next_beat = beat_frame - start  # Offset of the first beat boundary in this block
+        while offset < frames:
+            if self.click_sound is not None:
+                # Play the current click up to the next beat (where a new click takes over) or the end of the block
+                length = min(len(self.click_sound) - self.click_offset, min(next_beat, frames) - offset)
+                if length > 0:
+                    target = outdata[offset:offset + length]
+                    np.add(target, self.click_sound[self.click_offset:self.click_offset + length], out=target)
+                    self.click_offset += length
+                if self.click_offset >= len(self.click_sound):
+                    self.click_sound = None
+            if next_beat >= frames:
+                break
+            self.click_sound = self.bar_click if beat_index % BEATS_PER_BAR == 0 else self.beat_click
+            self.click_offset = 0
+            offset = next_beat
+            beat_index += 1
+            next_beat = self.grid.frame(beat_index) - start
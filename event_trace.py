@@ -0,0 +1,112 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Constants
+TRACING = os.environ.get("DMP_TRACE", "") not in ("", "0")  # Trace points are skipped entirely unless DMP_TRACE is set
+TRACE_CAPACITY = 1 << 16  # Records kept; once full, the oldest are overwritten
+TRACE_FILE = os.environ.get("DMP_TRACE_FILE", "trace.json")  # Where the player exports the trace on exit
+
+PHASE_INSTANT = 0  # A moment in time ("i" in the Chrome format)
+PHASE_COMPLETE = 1  # A span with a duration ("X")
+PHASE_COUNTER = 2  # A value plotted over time ("C")
+CHROME_PHASES = ("i", "X", "C")
+
+
+class TraceRecorder:
+    def __init__(self, capacity=TRACE_CAPACITY):
+        # Binary event trace: a preallocated ring of (timestamp, duration, event id, phase, thread, arg) records.
+        # Recording is a handful of array stores with no formatting or I/O, so trace points can sit in the audio
+        # callback. Any thread may record: next() on the shared counter hands every record its own slot.
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)  # perf_counter_ns() at the start of the event
+        self.durations = np.zeros(capacity, dtype=np.int64)  # Nanoseconds (complete events only)
+        self.event_ids = np.zeros(capacity, dtype=np.int32)
+        self.phases = np.zeros(capacity, dtype=np.int8)
+        self.threads = np.zeros(capacity, dtype=np.int64)  # threading.get_ident() of the recording thread
+        self.args = np.zeros(capacity, dtype=np.float64)
+        self.names = []  # Event name by id
+        self.ids = {}  # Event id by name
+        self.lock = threading.Lock()  # Only guards registering event names, never recording
+        self.clear()
+
+    def clear(self):
+        # Forget every record
+        self.counter = itertools.count()
+        self.recorded = 0
+
+    def event(self, name):
+        # Id of an event name, registered on first use. Look ids up once (e.g. at import time), not per record.
+        with self.lock:
+            if name not in self.ids:
+                self.ids[name] = len(self.names)
+                self.names.append(name)
+            return self.ids[name]
+
+    def record(self, event_id, phase, timestamp, duration=0, arg=0.0):
+        # Store one record in the next slot of the ring
+        slot = next(self.counter)
+        index = slot % self.capacity
+        self.timestamps[index] = timestamp
+        self.durations[index] = duration
+        self.event_ids[index] = event_id
+        self.phases[index] = phase
+        self.threads[index] = threading.get_ident()
+        self.args[index] = arg
+        if slot >= self.recorded:
+            self.recorded = slot + 1
+
+    def instant(self, event_id, arg=0.0):
+        # Record that something happened now
+        self.record(event_id, PHASE_INSTANT, time.perf_counter_ns(), 0, arg)
+
+    def complete(self, event_id, start, arg=0.0):
+        # Record a span from start (a perf_counter_ns() value) until now
+        now = time.perf_counter_ns()
+        self.record(event_id, PHASE_COMPLETE, start, now - start, arg)
+
+    def counter_value(self, event_id, value):
+        # Record the current value of a counter
+        self.record(event_id, PHASE_COUNTER, time.perf_counter_ns(), 0, value)
+
+    def records(self):
+        # Indices of the records still in the ring, oldest first
+        end = self.recorded
+        start = max(0, end - self.capacity)
+        return [slot % self.capacity for slot in range(start, end)]
+
+    def chrome_events(self):
+        # The trace as a list of Chrome trace_event dictionaries (timestamps in microseconds)
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        tids = {}
+        pid = os.getpid()
+        events = []
+        for index in self.records():
+            ident = int(self.threads[index])
+            tid = tids.setdefault(ident, len(tids) + 1)
+            phase = int(self.phases[index])
+            name = self.names[int(self.event_ids[index])]
+            event = {"name": name, "ph": CHROME_PHASES[phase], "ts": self.timestamps[index] / 1000.0,
+                     "pid": pid, "tid": tid}
+            if phase == PHASE_COMPLETE:
+                event["dur"] = self.durations[index] / 1000.0
+            if phase == PHASE_INSTANT:
+                event["s"] = "t"  # Scoped to its thread
+            event["args"] = {name if phase == PHASE_COUNTER else "arg": float(self.args[index])}
+            events.append(event)
+        for ident, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                           "args": {"name": thread_names.get(ident, f"thread {ident}")}})
+        return events
+
+    def export_chrome(self, filepath):
+        # Write the trace as Chrome trace_event JSON (open it in chrome://tracing or ui.perfetto.dev)
+        with open(filepath, 'w') as f:
+            json.dump({"traceEvents": self.chrome_events(), "displayTimeUnit": "ms"}, f)
+
+
+tracer = TraceRecorder()  # Shared by every thread of the process
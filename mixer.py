@@ -0,0 +1,301 @@
+import logging
+import mmap
+import numpy as np
+
+from transitions import CurveBank, LayerTransition, CURVE_CUT, curve_values
+
+# Constants
+DEFAULT_BLOCK_SIZE = 1024  # Frames per block when no audio device dictates the block size
+MAX_MIX_FRAMES = 4096  # Longer blocks are mixed in pieces of this size (also the padding of every gain curve)
+
+
+def sample_scale(dtype):
+    # Factor that converts samples of the given dtype to the -1.0..1.0 float range
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return 1.0
+    return 1.0 / (1 << (8 * dtype.itemsize - 1))
+
+
+class LayerLoop:
+    __slots__ = ("start", "end", "curve", "fade_frames", "preroll")
+
+    def __init__(self, start, end, curve=CURVE_CUT, fade_frames=0, preroll=False):
+        # Seamless loop of a layer: once playback passes end it continues from start, forever. The seam is
+        # crossfaded with audio from outside the loop, so the loop keeps its length: normally the audio past end
+        # fades out while start fades in after each wrap; with preroll, the last frames before end fade out
+        # while the audio leading up to start fades in, so the wrap itself lands on a clean start.
+        self.start = start  # First frame of the looped region
+        self.end = end  # Frame after the looped region
+        self.curve = curve  # Crossfade curve at the seam
+        self.fade_frames = min(fade_frames, end - start)  # Crossfade length at the seam (0 for a hard splice)
+        self.preroll = preroll  # Crossfade before end with the audio before start (the file has no tail past end)
+
+    @classmethod
+    def from_beats(cls, start_beat, end_beat, curve, fade_beats, frames, period):
+        # Build the loop of a layer from its song JSON fields in beats (period: frames per beat). An end beat of
+        # 0 loops the whole file. The seam fades with the audio past end if the file has enough of it, else with
+        # the audio before start; a fade longer than both is shortened to the longer one (a whole-file loop
+        # gets a hard splice), since fading from silence would leave a hole at every wrap.
+        start = int(round(start_beat * period))
+        end = int(round(end_beat * period)) or frames
+        if not 0 <= start < end:
+            raise ValueError(f"Empty loop ({start} to {end})")
+        fade = min(int(round(fade_beats * period)), end - start)
+        tail = max(0, frames - end)
+        if fade <= tail:
+            return cls(start, end, curve, fade)
+        if fade <= start:
+            return cls(start, end, curve, fade, preroll=True)
+        logging.warning(f"Loop {start} to {end} has {max(tail, start)} frames around it for a {fade} frame crossfade; "
+                        f"shortening the crossfade")
+        return cls(start, end, curve, max(tail, start), preroll=start > tail)
+
+    @property
+    def seam(self):
+        # First frame a pass through the loop reads differently from the file (a preroll fade starts before end)
+        return self.end - self.fade_frames if self.preroll else self.end
+
+    def source_frame(self, position):
+        # Frame of the file heard at a playback position; positions keep counting up while the loop repeats
+        if position < self.end:
+            return position
+        return self.start + (position - self.start) % (self.end - self.start)
+
+
+class Layer:
+    def __init__(self, name, data, enabled=True, gain=1.0, metadata=None, button=None, transition=None, loop=None):
+        # A single stem of a song, summed into the output while enabled
+        self.name = name
+        self.data = data  # PCM samples shaped (frames, channels)
+        self.scale = sample_scale(data.dtype)  # Converts data to float samples
+        self.enabled = enabled
+        self.gain = gain
+        self.metadata = metadata  # LayerMetadata of the file the data came from
+        self.button = button  # Name of the layer control button that toggles this layer, if any
+        self.transition = transition or LayerTransition()  # How the layer fades in and out
+        self.loop = loop  # LayerLoop if the layer repeats forever, None if it plays once
+
+    @property
+    def frames(self):
+        # Number of audio frames in this layer
+        return len(self.data)
+
+    @property
+    def end_position(self):
+        # Playback position at which the layer runs out (None if it loops forever)
+        return None if self.loop is not None else self.frames
+
+
+def touch_frames(layer, position, frames):
+    # Read one sample per memory page of a layer from a playback position onwards, so the OS has paged the
+    # audio in before the audio thread needs it (e.g. a silent variant about to be switched to). Streamed stems
+    # start decoding ahead from there instead.
+    start = layer.loop.source_frame(position) if layer.loop is not None else position
+    prefetch = getattr(layer.data, "prefetch", None)
+    if prefetch is not None:
+        prefetch(start)
+        return
+    end = min(layer.frames, start + frames)
+    if start >= end:
+        return
+    stride = max(1, mmap.PAGESIZE // max(1, layer.data.strides[0]))
+    np.add.reduce(layer.data[start:end:stride, 0])
+
+
+def copy_frames(row, data, source, frames):
+    # Copy frames of data starting at source into row as float, with silence past the end of the data
+    available = max(0, min(frames, len(data) - source))
+    if available:
+        np.copyto(row[:available], data[source:source + available], casting='unsafe')  # Mono fills every channel
+    if available < frames:
+        row[available:frames] = 0
+
+
+class LayerMixer:
+    def __init__(self, channels):
+        # Plays every layer of a segment in sync and sums them block by block with per-layer gain.
+        # Each layer's gain follows a fade (from gain, to gain, start frame, precomputed curve); a layer that is
+        # not fading just sits at the end of an instant cut. Every block evaluates all fades at once with two
+        # lookups and a matrix product, so many overlapping fades cost about the same as one.
+        self.channels = channels
+        self.curves = CurveBank(MAX_MIX_FRAMES)  # Precomputed fade curves shared by every layer
+        self.frame = 0  # Frames mixed so far; fades are scheduled on this clock, which never jumps or loops
+        self.layers = []
+        self.set_layers([])
+
+    def set_layers(self, layers):
+        # Replace the mixed layers; each starts at its full or zero gain without a fade
+        self.layers = list(layers)
+        count = len(self.layers)
+        self.fade_from = np.zeros(count, dtype=np.float32)  # Gain before each layer's fade
+        self.fade_to = np.array([layer.gain if layer.enabled else 0.0 for layer in self.layers], dtype=np.float32)
+        self.fade_start = np.zeros(count, dtype=np.int64)  # Mixer frame at which each fade starts
+        self.fade_length = np.zeros(count, dtype=np.int64)  # Length of each fade in frames
+        self.fade_base = np.full(count, self.curves.get(CURVE_CUT, 0), dtype=np.int64)  # Curve offset in the arenas
+        self.loop_curves = {}  # (curve, fade frames) -> (rising, falling) loop crossfade tables, (frames, channels)
+        for layer in self.layers:
+            loop = layer.loop
+            if loop is not None and loop.fade_frames and (loop.curve, loop.fade_frames) not in self.loop_curves:
+                rising, falling = curve_values(loop.curve, loop.fade_frames)
+                self.loop_curves[(loop.curve, loop.fade_frames)] = (
+                    np.repeat(rising[:, np.newaxis], self.channels, axis=1).astype(np.float32),
+                    np.repeat(falling[:, np.newaxis], self.channels, axis=1).astype(np.float32))
+        self.allocate(DEFAULT_BLOCK_SIZE)
+
+    def allocate(self, block_size):
+        # Preallocate the (layers x frames x channels) stack and the gain buffers used by mix_block()
+        count = max(1, len(self.layers))
+        size = count * block_size * self.channels
+        self.block_capacity = block_size
+        self.stack = np.zeros(size, dtype=np.float32)  # Gathered layer audio
+        self.tail = np.zeros((block_size, self.channels), dtype=np.float32)  # Audio past a loop end, for crossfades
+        self.gain_buffer = np.zeros(size, dtype=np.float32)  # Per-sample layer gains
+        self.curve_buffer = np.zeros(2 * size, dtype=np.float32)  # Looked-up fade-out and fade-in curve values
+        self.index_buffer = np.zeros(size, dtype=np.float64)  # Curve arena indices, computed as a matrix product
+        self.index_ints = np.zeros(size, dtype=np.intp)
+        self.index_coeffs = np.zeros((count, 2), dtype=np.float64)  # (first index, 1) of each gathered layer
+        self.weights = np.zeros(2 * count * count, dtype=np.float32)  # Fade-from/fade-to weights of each row
+        self.row_from = np.zeros(count, dtype=np.float32)
+        self.row_to = np.zeros(count, dtype=np.float32)
+        self.basis_frames = 0
+        self.basis = None
+
+    def build_basis(self, frames):
+        # Rows [1, 1, ...] and [0, 1, 2, ..., frames - 1] (repeated per channel): index_coeffs @ basis gives the
+        # curve index of every sample of every gathered layer in a single matrix product
+        offsets = np.repeat(np.arange(frames, dtype=np.float64), self.channels)
+        self.basis = np.stack([np.ones_like(offsets), offsets])
+        self.basis_frames = frames
+
+    def index(self, name):
+        # Index of a layer by name, or None
+        for index, layer in enumerate(self.layers):
+            if layer.name == name:
+                return index
+        return None
+
+    def gain_at(self, index, frame):
+        # Gain of a layer at a mixer frame, according to its current fade
+        offset = min(max(frame - int(self.fade_start[index]), -self.curves.pad), int(self.fade_length[index]))
+        position = int(self.fade_base[index]) + offset
+        return float(self.fade_from[index] * self.curves.curve_out[position] + self.fade_to[index] * self.curves.curve_in[position])
+
+    def fade(self, index, gain, start_frame, length, curve):
+        # Fade a layer to gain over length frames along curve, starting exactly at start_frame (which may be in
+        # the future, or mid-block). A fade replaces any fade already running on the layer.
+        start_frame = int(start_frame)
+        base = self.curves.get(curve, length)
+        length = 0 if base == self.curves.get(CURVE_CUT, 0) else int(length)
+        self.fade_from[index] = self.gain_at(index, start_frame)
+        self.fade_base[index] = base
+        self.fade_length[index] = length
+        self.fade_to[index] = gain
+        self.fade_start[index] = start_frame
+
+    def mix(self, outdata, position, frames):
+        # Overwrite outdata with every audible layer read from the given position, in pieces the curves can cover
+        offset = 0
+        while offset < frames:
+            size = min(frames - offset, MAX_MIX_FRAMES)
+            self.mix_block(outdata[offset:offset + size], position + offset, size)
+            offset += size
+
+    def mix_block(self, outdata, position, frames):
+        # Gather the audible layers into the stack, evaluate every layer's fade for every sample, then scale and
+        # sum the stack with one vectorized multiply and one reduction. Nothing here allocates arrays.
+        if frames > self.block_capacity:
+            self.allocate(frames)
+        if frames != self.basis_frames:
+            self.build_basis(frames)
+
+        size = frames * self.channels
+        pad = self.curves.pad
+        rows = 0
+        for index, layer in enumerate(self.layers):
+            offset = self.frame - self.fade_start[index]
+            length = self.fade_length[index]
+            if self.fade_to[index] == 0 and (offset >= length or self.fade_from[index] == 0):
+                continue  # Silent for the whole block
+            if layer.loop is None and position >= layer.frames:
+                continue  # Finished
+            row = self.stack[rows * size:(rows + 1) * size].reshape(frames, self.channels)
+            if layer.loop is None or position + frames <= layer.loop.seam:
+                copy_frames(row, layer.data, position, frames)
+            else:
+                self.read_loop(row, layer, position, frames)
+            self.index_coeffs[rows, 0] = self.fade_base[index] + min(max(offset, -pad), length)
+            self.index_coeffs[rows, 1] = 1.0
+            self.row_from[rows] = self.fade_from[index] * layer.scale
+            self.row_to[rows] = self.fade_to[index] * layer.scale
+            rows += 1
+        self.frame += frames
+
+        if rows == 0:
+            outdata.fill(0)
+            return
+
+        # Curve values for every sample: the fade-out curve in the first `rows` rows, the fade-in curve below
+        indices = self.index_buffer[:rows * size].reshape(rows, size)
+        np.matmul(self.index_coeffs[:rows], self.basis, out=indices)
+        index_ints = self.index_ints[:rows * size].reshape(rows, size)
+        np.copyto(index_ints, indices, casting='unsafe')
+        curves = self.curve_buffer[:2 * rows * size].reshape(2 * rows, size)
+        np.take(self.curves.curve_out, index_ints, out=curves[:rows], mode='clip')
+        np.take(self.curves.curve_in, index_ints, out=curves[rows:], mode='clip')
+
+        # gain = from * curve_out + to * curve_in for every row, as one (rows x 2 rows) @ (2 rows x samples) product
+        weights = self.weights[:2 * rows * rows].reshape(rows, 2 * rows)
+        weights.fill(0)
+        for row in range(rows):
+            weights[row, row] = self.row_from[row]
+            weights[row, rows + row] = self.row_to[row]
+        gains = self.gain_buffer[:rows * size].reshape(rows, size)
+        np.matmul(weights, curves, out=gains)
+
+        stack = self.stack[:rows * size].reshape(rows, frames, self.channels)
+        np.multiply(stack, gains.reshape(rows, frames, self.channels), out=stack)
+        np.add.reduce(stack, axis=0, out=outdata)
+
+    def read_loop(self, row, layer, position, frames):
+        # Fill row with a block of a looping layer. The block may straddle the loop end (even several times for
+        # very short loops); the read position wraps there with no gap. For loopTransitionDuration frames after
+        # each wrap, the audio that follows the loop end fades out while the loop start fades in; a preroll loop
+        # instead fades its last loopTransitionDuration frames out into the audio leading up to the loop start.
+        loop = layer.loop
+        offset = 0
+        while offset < frames:
+            source = loop.source_frame(position + offset)
+            run = min(frames - offset, loop.end - source)
+            copy_frames(row[offset:offset + run], layer.data, source, run)
+
+            if loop.preroll:
+                # Crossfade the frames before the loop end with those before the loop start, on every pass
+                into_fade = source - (loop.end - loop.fade_frames)
+                skip = max(0, -into_fade)
+                if skip < run:
+                    into_fade += skip
+                    fade = run - skip
+                    rising, falling = self.loop_curves[(loop.curve, loop.fade_frames)]
+                    head = row[offset + skip:offset + run]
+                    tail = self.tail[:fade]
+                    copy_frames(tail, layer.data, loop.start - loop.fade_frames + into_fade, fade)
+                    np.multiply(head, falling[into_fade:into_fade + fade], out=head)
+                    np.multiply(tail, rising[into_fade:into_fade + fade], out=tail)
+                    np.add(head, tail, out=head)
+                offset += run
+                continue
+
+            wrapped = position + offset >= loop.end
+            into_fade = source - loop.start
+            if wrapped and into_fade < loop.fade_frames:
+                # Crossfade with the tail past the loop end
+                fade = min(run, loop.fade_frames - into_fade)
+                rising, falling = self.loop_curves[(loop.curve, loop.fade_frames)]
+                head = row[offset:offset + fade]
+                tail = self.tail[:fade]
+                copy_frames(tail, layer.data, loop.end + into_fade, fade)
+                np.multiply(head, rising[into_fade:into_fade + fade], out=head)
+                np.multiply(tail, falling[into_fade:into_fade + fade], out=tail)
+                np.add(head, tail, out=head)
+            offset += run
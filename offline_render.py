@@ -0,0 +1,88 @@
+import argparse
+import logging
+import os
+import sys
+import time
+import wave
+import numpy as np
+
+from engine import DEFAULT_BLOCK_SIZE
+from playlist import OUTPUT_CHANNELS, build_engine
+from song_loader import load_song, load_segments
+from stem_cache import stem_cache
+
+# Configure logging for debugging purposes
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+# Constants
+OUTPUT_DIR = "Renders"  # Default directory for rendered WAV files
+MAX_RENDER_SECONDS = 600  # Safety limit for songs that would otherwise loop forever
+
+
+def render_frames(engine, frames, block):
+    # Render the given number of frames (None = until the song ends) in blocks, yielding each filled block
+    while frames is None or frames > 0:
+        size = len(block) if frames is None else min(frames, len(block))
+        produced = engine.render(block[:size], size)
+        if not produced:
+            return
+        yield block[:produced]
+        if frames is not None:
+            frames -= size
+
+
+def render_song(json_path, output_path, block_size=DEFAULT_BLOCK_SIZE, max_seconds=MAX_RENDER_SECONDS):
+    # Render a song JSON to a 16-bit WAV file as fast as possible, from the same engine setup live playback
+    # uses (build_engine()). Returns the rendered duration in seconds.
+    song = load_song(json_path)
+    channels = OUTPUT_CHANNELS  # The live output's layout, so the file holds exactly what plays
+    engine = build_engine(song, load_segments(song, channels), channels)
+
+    block = np.zeros((block_size, channels), dtype=np.float32)
+    max_frames = int(max_seconds * song.sample_rate)
+    rendered = 0
+    with wave.open(output_path, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(2)
+        wf.setframerate(song.sample_rate)
+        for chunk in render_frames(engine, None, block):
+            chunk = chunk[:max_frames - rendered]
+            wf.writeframes((np.clip(chunk, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+            rendered += len(chunk)
+            if rendered >= max_frames:
+                logging.warning(f"{json_path} reached the {max_seconds}s render limit")
+                break
+    if engine.scheduler is not None:
+        for event, frames_late in engine.scheduler.late:
+            logging.warning(f"Timeline instruction {event.index} ({event.action}) was applied {frames_late} frames late")
+    return rendered / song.sample_rate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render song JSONs to WAV files without playing them.")
+    parser.add_argument("songs", nargs="+", help="Song JSON files (e.g. MusicJSONs/TheHandThatFeeds_DynVocals.json)")
+    parser.add_argument("-o", "--output-dir", default=OUTPUT_DIR, help="Directory for the rendered WAV files")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE, help="Frames rendered per block")
+    parser.add_argument("--max-seconds", type=float, default=MAX_RENDER_SECONDS, help="Stop rendering after this many seconds")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    failures = 0
+    for json_path in args.songs:
+        output_path = os.path.join(args.output_dir, os.path.splitext(os.path.basename(json_path))[0] + ".wav")
+        started = time.perf_counter()
+        try:
+            duration = render_song(json_path, output_path, args.block_size, args.max_seconds)
+        except Exception as e:
+            logging.error(f"Error rendering {json_path}: {e}")
+            failures += 1
+            continue
+        elapsed = time.perf_counter() - started
+        speed = duration / elapsed if elapsed > 0 else float("inf")
+        logging.info(f"Rendered {json_path} -> {output_path} ({duration:.1f}s of audio in {elapsed:.2f}s, {speed:.0f}x real time)")
+    logging.info(f"Stem cache: {stem_cache.stats()}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,51 @@
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 import tkinter as tk
+import os
 import time
-import sounddevice as sd
-import wave
+from time import perf_counter_ns
 import numpy as np
-from PIL import Image, ImageTk
-import contextlib
 import threading
 import logging
 
+from audio_metrics import AudioMetrics
+from event_trace import tracer, TRACING, TRACE_FILE
+from playlist import Playlist, PlaylistOutput, prepare_track, SONG_DIR, OUTPUT_CHANNELS
+from ring_buffer import MixWorker
+from song_loader import prefetch_songs
+from stem_cache import stem_cache
+from transport import BEATS_PER_BAR
+from wav_reader import decode_wav, read_wav_header
+from waveform import load_pyramid, song_envelope
+
 # Configure logging for debugging purposes
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)s] %(message)s')
 
 # Constants
-SONG_FILE = "MusicFiles/The Hand That Feeds/The Hand That Feeds (OG).wav"  # Path to the song file
-ALBUM_ART_FILE = "MusicFiles/The Hand That Feeds/withteeth.jpeg"  # Path to the album art file
-BPM = 128  # Beats per minute for the song
+SONG_JSON = "MusicJSONs/TheHandThatFeeds_DynVocals.json"  # Path to the song description
+PREFETCH_SONGS = 2  # Songs after the current one whose stems are read into memory in the background
+STEM_CACHE_BYTES = 1024 * 1024 * 1024  # Memory budget for stems kept across songs
+BPM = 128  # Beats per minute until a song is loaded
 BAR_SOUND_FILE = "bar.wav"  # Path to the bar sound file for metronome
 BEAT_SOUND_FILE = "beat.wav"  # Path to the beat sound file for metronome
+REFRESH_INTERVAL_MS = 33  # Milliseconds between GUI refresh ticks (about the display rate)
+VARIANT_QUANTIZE = "bar"  # Variant switches of exclusive songs land on the next "bar" or "beat"
+SKIP_QUANTIZE = "beat"  # Next/previous take over on the next "beat" or "bar" of the playing song (None = at once)
+SKIP_CROSSFADE_BEATS = 0.0  # Crossfade on next/previous in beats (0 = a gapless cut with only a de-click ramp)
+SEEK_QUANTIZE = None  # Seeks made while playing land on the next "beat" or "bar", on the nearest one (None = at once)
+MIX_BUFFER_FRAMES = 8192  # Frames mixed ahead of the audio callback; raise it if the log reports underruns
+AUDIO_METRICS_JSON = "audio_metrics.json"  # Where the debug panel dumps the audio callback metrics
+WAVEFORM_HEIGHT = 80  # Height of the waveform above the playbar in pixels
+WAVEFORM_ZOOM_STEP = 1.25  # Visible span factor per mouse wheel notch
+WAVEFORM_MIN_SECONDS = 0.5  # Narrowest span the waveform zooms in to
+MARKER_SPACING = 8  # Fewest pixels between drawn beat (or bar) markers
+
+# Trace points (recorded only when DMP_TRACE is set; exported to TRACE_FILE on exit)
+TRACE_CALLBACK = tracer.event("audio_callback")  # arg: frames
+TRACE_PLAYLIST_END = tracer.event("playlist_end")
+TRACE_TRACK_CHANGE = tracer.event("track_change")
+TRACE_REFRESH = tracer.event("refresh_ui")  # arg: widgets changed
+TRACE_DRAG = tracer.event("scrub_drag")  # arg: position in seconds
 
 
 class MusicPlayerApp(ttk.Window):
@@ -29,26 +56,46 @@ class MusicPlayerApp(ttk.Window):
 
         # Initialize state variables
         self.song_loaded = self.metronome_running = False  # Flags to track song and metronome status
-        self.current_beat = 0  # Track the current beat
         self.paused_position = 0.0  # Position where the song was paused
-        self.song_start_time = None  # Track the start time of the song
         self.bpm = BPM  # Default BPM value
         self.metronome_clicks_enabled = False  # Track if metronome clicks are enabled
         self.display_metronome_enabled = False  # Ensure metronome display is off at launch
-        self.audio_data = None  # Loaded audio data
+        self.display_metrics_enabled = False  # Audio callback metrics panel is off at launch
+        self.audio_metrics = None  # AudioMetrics of the audio callback, kept across streams at the same sample rate
+        self.song = None  # SongSpec of the loaded song (title, artist, segments, layers, ...)
         self.sample_rate = None  # Audio sample rate
         self.stream = None  # Audio stream for playback
-        self.current_position = 0  # Track current playback position
-        self.samples_per_beat = None  # Number of samples per beat (calculated based on BPM)
-        self.metronome_id = None  # Track metronome ID for scheduling cancellation
+        self.engine = None  # Playback engine that mixes the loaded song
+        self.song_metadata = None  # LayerMetadata of the loaded song (length, rate, beats), computed once at load
         self.is_scrubbing = False  # Track if user is scrubbing the progress bar
-        self.stop_threads = False  # Control thread termination
-        self.was_playing_before_scrub = False  # Track if song was playing before scrubbing started
+        self.playlist_ended = False  # Set by the audio thread when the playlist runs out; handled by the refresh tick
+        self.displayed = {}  # Last value shown by each widget the refresh tick updates, by widget key
+        self.waveform_pyramids = {}  # WaveformPyramid of each layer of the shown song's first segment, by layer name
+        self.waveform_pending = None  # (track, pyramids) loaded in the background, adopted by the refresh tick
+        self.waveform_view = (0, 0)  # Frames of the song shown across the waveform (zoomed in when narrower)
+        self.waveform_drawn = None  # What the waveform was last drawn for, so it is only redrawn when that changes
+        self.layer_button_vars = {}  # Displayed position of each layer control button, by button name
+        self.variant_var = None  # Selected variant of an exclusive song
+        self.current_song_path = None  # Song JSON currently loaded
+        self.playlist = Playlist([])  # Songs next/previous step through: the library, once the loader has scanned it
+        self.library_pending = None  # Playlist of the scanned library, adopted by the refresh tick
+        self.library_scanned = False  # Next/previous and preparing the upcoming songs wait for the library
+        self.output = None  # PlaylistOutput the audio stream plays; tracks change inside it without reopening the stream
+        self.track = None  # Track (song and engine) shown in the UI
+        self.mix_worker = None  # MixWorker rendering the output ahead of the audio callback while the stream runs
+        self.bar_sound_data = self.beat_sound_data = None  # Metronome click samples, loaded at startup
+        self.started = time.perf_counter()  # When the player started, for logging how long it took to be playable
+        self.loading_path = None  # Song JSON being loaded in the background, if any
+        self.loading_progress = (0, 0)  # (stems loaded, total) of that song, written by the loading thread
+        self.loading_pending = None  # (path, track or None, skip) loaded in the background, adopted by the refresh tick
+        self.previous_track = None  # Track of the song before the current one, prepared in the background
+        self.album_art_pending = None  # (song, resized PIL image) decoded in the background, shown by the refresh tick
 
         # Setup the user interface
         self.setup_ui()
-        self.load_song(SONG_FILE)  # Load the song
-        self.load_metronome_sounds()  # Load metronome sounds
+        stem_cache.set_budget(STEM_CACHE_BYTES)
+        self.refresh_ui()  # Start the GUI refresh tick
+        self.start_loading(SONG_JSON, scan_library=True)  # The window shows at once; the rest loads behind it
 
     def setup_ui(self):
         # Create a custom style for larger buttons
@@ -63,24 +110,24 @@ class MusicPlayerApp(ttk.Window):
         top_frame = ttk.Frame(main_frame)
         top_frame.pack(fill="x", pady=10)
 
-        # Album Art on the left
-        self.album_art_photo = self.load_image(ALBUM_ART_FILE, (400, 400))  # Load and resize album art
-        album_art_label = ttk.Label(top_frame, image=self.album_art_photo)  # Display album art
-        album_art_label.pack(side="left", padx=20)
+        # Album Art on the left (filled in when a song is loaded)
+        self.album_art_photo = None
+        self.album_art_label = ttk.Label(top_frame)  # Display album art
+        self.album_art_label.pack(side="left", padx=20)
 
         # Vertical Stack for Song Info (Song Title, Artist, Album, Year)
         info_frame = ttk.Frame(top_frame)
         info_frame.pack(side="left", padx=20, pady=10)
 
         # Song Title (left-aligned)
-        song_title = ttk.Label(info_frame, text="The Hand That Feeds", font=("Helvetica", 24, "bold"),
-                            background="#1C1C1E", foreground="white")
-        song_title.pack(anchor="w")  # Left-aligned
+        self.song_title_label = ttk.Label(info_frame, text="", font=("Helvetica", 24, "bold"),
+                                          background="#1C1C1E", foreground="white")
+        self.song_title_label.pack(anchor="w")  # Left-aligned
 
         # Artist, Album, Year (left-aligned)
-        artist_info = ttk.Label(info_frame, text="Nine Inch Nails • With Teeth (2005)",
-                                font=("Helvetica", 14), background="#1C1C1E", foreground="gray")
-        artist_info.pack(anchor="w")  # Left-aligned
+        self.artist_info_label = ttk.Label(info_frame, text="", font=("Helvetica", 14),
+                                           background="#1C1C1E", foreground="gray")
+        self.artist_info_label.pack(anchor="w")  # Left-aligned
 
         # Spacer to push the text higher relative to album art
         ttk.Frame(info_frame).pack(expand=True)
@@ -109,6 +156,11 @@ class MusicPlayerApp(ttk.Window):
                                                     font=("Helvetica", 12), background="#1C1C1E", foreground="gray")
         self.samples_until_next_beat_label.pack()
 
+        # Layers currently audible (follows the timeline and variant switches)
+        self.active_layers_label = ttk.Label(self.metronome_frame, text="Active Layers: ", font=("Helvetica", 12),
+                                             background="#1C1C1E", foreground="gray")
+        self.active_layers_label.pack()
+
         # Progress bar for beat progress
         self.samples_progress_bar = ttk.Progressbar(self.metronome_frame, orient="horizontal", length=300, mode="determinate")
         self.samples_progress_bar.pack(pady=5)
@@ -122,6 +174,28 @@ class MusicPlayerApp(ttk.Window):
         if not self.display_metronome_enabled:
             self.metronome_frame.pack_forget()
 
+        # Audio Metrics Debug Section (next to the metronome debug section)
+        self.metrics_frame = ttk.Frame(top_frame)
+
+        # Callback count and load (callback time / block duration)
+        self.metrics_load_label = ttk.Label(self.metrics_frame, text="Callbacks: 0", font=("Helvetica", 12),
+                                            background="#1C1C1E", foreground="white")
+        self.metrics_load_label.pack(anchor="w")
+
+        # Device underflows/overflows and blocks the mixer could not fill in time
+        self.metrics_xrun_label = ttk.Label(self.metrics_frame, text="Underflows: 0 Overflows: 0 Dropped: 0",
+                                            font=("Helvetica", 12), background="#1C1C1E", foreground="gray")
+        self.metrics_xrun_label.pack(anchor="w")
+
+        # Callback duration histogram, one line per bucket
+        self.metrics_histogram_label = ttk.Label(self.metrics_frame, text="", font=("Courier", 10), justify="left",
+                                                 background="#1C1C1E", foreground="gray")
+        self.metrics_histogram_label.pack(anchor="w")
+
+        # Dump the metrics as JSON for dashboards
+        ttk.Button(self.metrics_frame, text="Dump JSON", bootstyle="secondary-outline",
+                   command=self.dump_audio_metrics).pack(anchor="w", pady=5)
+
         # Horizontal Stack: Control Buttons (Previous, Play/Pause, Next) centered
         controls_frame = ttk.Frame(main_frame)
         controls_frame.pack(fill="x", pady=10)
@@ -142,6 +216,26 @@ class MusicPlayerApp(ttk.Window):
         next_button = ttk.Button(inner_controls_frame, text="⏭", width=3, command=self.next_song, style="Large.TButton")
         next_button.pack(side="left", padx=20)
 
+        # Horizontal Stack: Layer control toggles (e.g. Instrumental), built from the song's layerControls
+        layer_controls_frame = ttk.Frame(main_frame)
+        layer_controls_frame.pack(fill="x", pady=10)
+        self.layer_controls_inner = ttk.Frame(layer_controls_frame)
+        self.layer_controls_inner.pack(anchor="center")
+
+        # Horizontal Stack: Waveform of the song with bar and beat markers (click or drag to scrub, wheel to zoom)
+        waveform_frame = ttk.Frame(main_frame)
+        waveform_frame.pack(fill="x", pady=(10, 0))
+        self.waveform_canvas = tk.Canvas(waveform_frame, height=WAVEFORM_HEIGHT, background="#1C1C1E", highlightthickness=0)
+        self.waveform_canvas.pack(fill="x", expand=True, padx=70)  # Lined up with the progress bar
+        self.waveform_item = self.waveform_canvas.create_polygon(0, 0, 0, 0, fill="gray", outline="")  # Min/max outline
+        self.playhead_item = self.waveform_canvas.create_line(0, 0, 0, WAVEFORM_HEIGHT, fill="#4FC3F7", width=2)
+        self.waveform_canvas.bind("<Button-1>", self.start_waveform_scrub)
+        self.waveform_canvas.bind("<B1-Motion>", self.waveform_scrub)
+        self.waveform_canvas.bind("<ButtonRelease-1>", self.end_waveform_scrub)
+        self.waveform_canvas.bind("<MouseWheel>", lambda event: self.zoom_waveform(event, -event.delta))
+        self.waveform_canvas.bind("<Button-4>", lambda event: self.zoom_waveform(event, -1))  # X11 wheel up
+        self.waveform_canvas.bind("<Button-5>", lambda event: self.zoom_waveform(event, 1))  # X11 wheel down
+
         # Horizontal Stack: Playbar (Elapsed Time, Progress Bar, Total Time)
         playbar_frame = ttk.Frame(main_frame)
         playbar_frame.pack(fill="x", pady=10)
@@ -171,6 +265,16 @@ class MusicPlayerApp(ttk.Window):
                                                         bootstyle="info-round-toggle", command=self.toggle_display_metronome)
         self.display_metronome_toggle.pack(side="left", padx=20)
 
+        # Audio Metrics Display Toggle
+        self.display_metrics_toggle = ttk.Checkbutton(bottom_frame, text="Display Audio Metrics",
+                                                      bootstyle="info-round-toggle", command=self.toggle_display_metrics)
+        self.display_metrics_toggle.pack(side="left", padx=20)
+
+        # Loading status: the song being loaded in the background and how many of its stems are ready
+        self.loading_label = ttk.Label(bottom_frame, text="", font=("Helvetica", 12), background="#1C1C1E", foreground="gray")
+        self.loading_label.pack(side="right", padx=20)
+        self.loading_bar = ttk.Progressbar(bottom_frame, orient="horizontal", length=200, mode="determinate")
+
     def toggle_display_metronome(self):
         # Toggle the visibility of the metronome frame
         logging.debug(f"Toggling display metronome: currently {'enabled' if self.display_metronome_enabled else 'disabled'}")
@@ -180,18 +284,122 @@ class MusicPlayerApp(ttk.Window):
         else:
             self.metronome_frame.pack_forget()  # Hide the metronome info using pack_forget()
 
+    def toggle_display_metrics(self):
+        # Toggle the visibility of the audio metrics frame
+        self.display_metrics_enabled = not self.display_metrics_enabled
+        if self.display_metrics_enabled:
+            self.metrics_frame.pack(side="right", padx=20, pady=10)
+            self.update_metrics_labels()
+        else:
+            self.metrics_frame.pack_forget()
+
+    def update_metrics_labels(self):
+        # Show the latest audio callback metrics in the debug panel
+        if self.audio_metrics is None:
+            return
+        metrics = self.audio_metrics.snapshot()
+        self.show("metrics_load", f"Callbacks: {metrics['callbacks']}  Load: {metrics['last_load']:.0%} "
+                                  f"(mean {metrics['mean_load']:.0%}, peak {metrics['peak_load']:.0%})  "
+                                  f"Max: {metrics['max_callback_us']:.0f}us",
+                  lambda text: self.metrics_load_label.config(text=text))
+        self.show("metrics_xruns", f"Underflows: {metrics['output_underflows']} "
+                                   f"Overflows: {metrics['output_overflows']} Dropped: {metrics['dropped_blocks']}",
+                  lambda text: self.metrics_xrun_label.config(text=text))
+        self.show("metrics_histogram", "\n".join(f"{label:>9} {count}" for label, count in metrics["histogram_us"].items()),
+                  lambda text: self.metrics_histogram_label.config(text=text))
+
+    def dump_audio_metrics(self):
+        # Write the audio callback metrics to AUDIO_METRICS_JSON
+        if self.audio_metrics is None:
+            logging.warning("No audio metrics recorded yet")
+            return
+        try:
+            self.audio_metrics.dump(AUDIO_METRICS_JSON)
+            logging.info(f"Audio metrics written to {AUDIO_METRICS_JSON}")
+        except OSError as e:
+            logging.error(f"Error writing audio metrics: {e}")
+
+    def show_song_info(self):
+        # Fill in the song title, artist line, album art, BPM and layer control toggles of the loaded song
+        self.song_title_label.config(text=self.song.title)
+        self.artist_info_label.config(text=f"{self.song.artist} • {self.song.album} ({self.song.year})")
+        self.load_album_art(self.song)
+        self.bpm_label.config(text=f"BPM: {self.bpm}")
+
+        for widget in self.layer_controls_inner.winfo_children():
+            widget.destroy()
+        self.layer_button_vars = {}
+        for button in self.song.buttons:
+            var = tk.BooleanVar(value=button.default_position)
+            toggle = ttk.Checkbutton(self.layer_controls_inner, text=button.text, variable=var, bootstyle="warning-round-toggle",
+                                     command=lambda button=button: self.toggle_layer_button(button))
+            toggle.pack(side="left", padx=20)
+            self.layer_button_vars[button.name] = var
+
+        # Exclusive songs get one button per variant; only the selected one is heard
+        self.variant_var = None
+        if self.engine is not None and self.engine.exclusive:
+            self.variant_var = tk.StringVar(value=self.engine.layers[0].name)
+            for layer in self.engine.layers:
+                choice = ttk.Radiobutton(self.layer_controls_inner, text=layer.name, value=layer.name,
+                                         variable=self.variant_var, bootstyle="warning-toolbutton",
+                                         command=self.switch_variant)
+                choice.pack(side="left", padx=5)
+
+    def switch_variant(self):
+        # Crossfade to the selected variant on the next bar; every variant keeps playing in sync, so nothing reloads
+        name = self.variant_var.get()
+        logging.debug(f"Switching to variant {name}")
+        self.engine.switch_variant(name, quantize=VARIANT_QUANTIZE)
+
+    def toggle_layer_button(self, button):
+        # Fade the layers controlled by a layer control button in or out with their song JSON transition;
+        # the stream keeps running
+        position = self.layer_button_vars[button.name].get()
+        enabled = button.enables_layers(position)
+        logging.debug(f"Layer button {button.name} set to {position}: layers {'enabled' if enabled else 'disabled'}")
+        if self.engine is None:
+            return
+        if self.engine.scheduler is not None:
+            # Timeline events that replay (e.g. after a seek back to the start) keep the button's layers as it has them
+            self.engine.post(self.engine.scheduler.set_button, button.name, enabled)
+        for layer in self.engine.layers:
+            if layer.button == button.name:
+                self.engine.transition_layer(layer.name, enabled)
+
     def load_image(self, filepath, size):
-        # Load and resize the image for album art
+        # Load and resize the image for album art (on a worker thread; only the refresh tick makes Tk images)
         logging.debug(f"Loading image from {filepath} with size {size}")
         try:
-            return ImageTk.PhotoImage(Image.open(filepath).resize(size))
+            from PIL import Image  # Imported on first use, so it does not hold up the window
+            return Image.open(filepath).resize(size)
         except Exception as e:
             logging.error(f"Error loading image: {e}")
             return None
 
+    def load_album_art(self, song):
+        # Decode and resize a song's album art in the background; the refresh tick shows it once it is ready
+        def load():
+            image = self.load_image(song.album_art, (400, 400))
+            if image is not None:
+                self.album_art_pending = (song, image)
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def show_album_art(self):
+        # (Refresh tick) Show album art decoded in the background, if it belongs to the song still shown
+        song, image = self.album_art_pending
+        self.album_art_pending = None
+        if song is self.song:
+            from PIL import ImageTk
+            self.album_art_photo = ImageTk.PhotoImage(image)
+            self.album_art_label.config(image=self.album_art_photo)
+
     def toggle_clicks(self):
         # Toggle the metronome click sounds
         self.metronome_clicks_enabled = not self.metronome_clicks_enabled
+        if self.engine is not None:
+            self.engine.clicks_enabled = self.metronome_clicks_enabled  # Clicks are mixed by the audio callback
         logging.debug(f"Metronome clicks {'enabled' if self.metronome_clicks_enabled else 'disabled'}")
 
     def play_pause_song(self):
@@ -208,114 +416,228 @@ class MusicPlayerApp(ttk.Window):
     def start_song(self):
         # Start playing the song
         logging.debug("Starting song")
-        if self.stream is not None and self.stream.active:
-            logging.debug("Stream is already active. No need to start again.")
-        else:
-            self.play_audio()  # Start the audio stream
-
-        self.song_start_time = time.time()  # Set the start time to the current time
+        self.play_audio()
         self.metronome_running = True  # Set metronome to running
-        self.stop_threads = False  # Reset thread stop flag
         self.play_pause_button.config(text="⏸")  # Update button to pause icon
         self.update_time_labels()  # Update time labels
-        self.update_progress_bar()  # Start updating the progress bar
-
-        # Ensure sync during scrubbing
-        value = self.progress_bar.get()
-        total_length = self.get_total_length()
-        self.paused_position = (value / 100) * total_length
-        self.current_position = int(self.paused_position * self.sample_rate * 2)
-        self.update_time_labels()
-
-        # Start metronome thread
-        self.run_metronome()
 
     def pause_song(self):
-        # Pause the song and stop the audio stream
+        # Pause the song. The output fades out and renders silence; the audio stream keeps running.
         logging.debug("Pausing song")
-        if self.stream and self.stream.active:
-            try:
-                self.stream.stop()  # Stop playback
-                logging.debug("Audio stream stopped successfully")
-            except Exception as e:
-                logging.error(f"Failed to stop audio stream: {e}")
-        self.paused_position += (time.time() - self.song_start_time)  # Update paused position
+        self.output.post(self.output.pause)
+        self.paused_position = self.engine.clock.seconds()  # Update paused position from the audible sample
         logging.debug(f"Song paused at position: {self.paused_position}")
-        self.song_start_time = None
         self.metronome_running = False
-        self.stop_threads = True  # Signal threads to stop
         self.play_pause_button.config(text="▶")  # Update button to play icon
 
-        # Cancel the metronome loop if it's running
-        if self.metronome_id is not None:
+    def seek_to(self, seconds):
+        # Move playback to a position of the song. While playing, the engine crossfades there inside the running
+        # stream (on the next SEEK_QUANTIZE boundary); while paused, the output moves it before rendering it again.
+        self.paused_position = max(0.0, seconds)
+        frame = self.paused_position * self.sample_rate
+        if self.metronome_running:
+            self.engine.crossfade_seek(frame, SEEK_QUANTIZE)
+        else:
+            self.output.post(self.engine.seek, frame)  # The refresh tick shows the new position
+            if self.stream is None or not self.stream.active:
+                self.output.run_commands()
+
+    def start_loading(self, filepath, skip=False, scan_library=False):
+        # Load the metronome clicks and a song JSON on a worker thread. The refresh tick shows the progress (with
+        # Play disabled if nothing is loaded yet) until the first seconds of every stem are in memory; the rest
+        # keeps loading behind. skip switches to the song like next/previous once it is ready, instead of loading
+        # it in place of the current one. scan_library then scans (and compiles, if need be) the song library on
+        # the same thread, so the first song is not kept waiting by the others.
+        def progress(done, total):
+            self.loading_progress = (done, total)
+
+        def load():
+            if self.bar_sound_data is None:
+                self.load_metronome_sounds()
             try:
-                self.after_cancel(self.metronome_id)
-                self.metronome_id = None  # Reset after canceling
-            except ValueError:
-                logging.warning("Metronome ID was invalid when trying to cancel")
-                self.metronome_id = None
-
-    def load_song(self, filepath):
-        # Load song from file
+                track = prepare_track(filepath, quick=True, progress=progress)
+                self.configure_engine(track.engine)
+            except Exception as e:
+                logging.error(f"Error loading song: {e}")
+                track = None
+            self.loading_pending = (filepath, track, skip)
+            if scan_library:
+                self.library_pending = Playlist.from_directory(SONG_DIR)
+
+        self.loading_path = filepath
+        self.loading_progress = (0, 0)
+        if self.track is None:
+            self.play_pause_button.config(state="disabled")
+        self.loading_bar.pack(side="right")
+        threading.Thread(target=load, name="song-loader", daemon=True).start()
+
+    def update_loading(self):
+        # (Refresh tick) Show how far the background load got, and make its track current once it is playable
+        done, total = self.loading_progress
+        name = os.path.splitext(os.path.basename(self.loading_path))[0]
+        self.show("loading", f"Loading {name}: {done}/{total} stems", lambda text: self.loading_label.config(text=text))
+        self.show("loading_progress", round(done / total * 100) if total else 0,
+                  lambda value: self.loading_bar.config(value=value))
+        pending = self.loading_pending
+        if pending is None:
+            return
+        self.loading_pending = self.loading_path = None
+        self.loading_bar.pack_forget()
+        self.play_pause_button.config(state="normal")
+        path, track, skip = pending
+        if track is None:
+            self.show("loading", f"Could not load {name}", lambda text: self.loading_label.config(text=text))
+            return
+        self.show("loading", "", lambda text: self.loading_label.config(text=text))
+        if skip:
+            self.switch_track(track)
+            return
+        self.load_song(path, track)
+        logging.info(f"Ready to play {path} {time.perf_counter() - self.started:.2f}s after startup")
+
+    def adopt_library(self):
+        # (Refresh tick) Make the scanned library the playlist, with the loaded song current, and start preparing
+        # the songs around it
+        self.playlist, self.library_pending = self.library_pending, None
+        self.library_scanned = True
+        if self.track is not None:
+            self.playlist.select(self.track.path)
+            self.prefetch_upcoming_songs()
+            self.prepare_upcoming_track()
+
+    def load_song(self, filepath, track=None):
+        # Load a song JSON (or adopt the track already prepared from it), make it the current track and start
+        # preparing the one after it
         logging.debug(f"Loading song from {filepath}")
         try:
-            with wave.open(filepath, 'rb') as wf:
-                self.sample_rate = wf.getframerate()
-                self.samples_per_beat = int((60 / self.bpm) * self.sample_rate)  # Calculate samples per beat
-                self.audio_data = wf.readframes(wf.getnframes())
-                self.audio_data = np.frombuffer(self.audio_data, dtype=np.int16)  # Convert audio data to numpy array
-            self.song_loaded = True
-            self.update_time_labels()  # Update time labels after loading the song
+            if track is None:
+                track = prepare_track(filepath)  # Normalized and validated, from the cached plan when it is fresh
+                self.configure_engine(track.engine)
+            if self.output is None or not self.output.accepts(track):
+                self.stop_audio_stream()  # Only a different sample rate or channel count needs a new device stream
+                self.output = PlaylistOutput(track.song.sample_rate, track.engine.channels)
+            self.output.post(self.output.set_current, track)
+            if self.stream is None or not self.stream.active:
+                self.output.run_commands()
+            self.show_track(track)
             logging.debug("Song loaded successfully")
         except Exception as e:
             logging.error(f"Error loading song: {e}")
 
+    def configure_engine(self, engine):
+        # Give a new track's engine the player's metronome clicks
+        if self.bar_sound_data is not None:
+            engine.set_click_sounds(self.bar_sound_data, self.bar_sound_rate, self.beat_sound_data, self.beat_sound_rate)
+        engine.clicks_enabled = self.metronome_clicks_enabled
+
+    def show_track(self, track):
+        # Point the UI at a track that is now current (loaded, skipped to, or reached after the previous one ended)
+        self.track = track
+        self.song = track.song
+        self.engine = track.engine
+        self.engine.clicks_enabled = self.metronome_clicks_enabled
+        self.bpm = self.song.bpm
+        self.sample_rate = self.song.sample_rate
+        self.song_metadata = max((layer.metadata for layer in self.song.segments[0].layers), key=lambda metadata: metadata.frames)
+        self.current_song_path = track.path
+        self.playlist.select(track.path)
+        self.show_song_info()
+        self.song_loaded = True
+        self.update_time_labels()  # Update time labels for the new song
+        self.load_waveforms(track)
+        if self.library_scanned:
+            self.prefetch_upcoming_songs()
+            self.prepare_upcoming_track()
+        logging.debug(f"Stem cache: {stem_cache.stats()}")
+
+    def prepare_upcoming_track(self):
+        # Build the next song's engine in the background and queue it behind the current track, so it starts on
+        # the sample after the current one ends. The previous song's engine is built after it, for "previous".
+        path, previous, current = self.playlist.peek(1), self.playlist.peek(-1), self.track
+        output = self.output
+        self.previous_track = None
+
+        def prepare():
+            try:
+                track = prepare_track(path)
+                self.configure_engine(track.engine)
+                if output.accepts(track):
+                    output.post(output.set_upcoming, track, current)
+            except Exception as e:
+                logging.error(f"Error preparing {path}: {e}")
+            if previous in (path, current.path):
+                return  # Next is also previous (or the only song)
+            try:
+                track = prepare_track(previous)
+                self.configure_engine(track.engine)
+                if self.track is current:
+                    self.previous_track = track
+            except Exception as e:
+                logging.error(f"Error preparing {previous}: {e}")
+
+        if path is not None:
+            threading.Thread(target=prepare, daemon=True).start()
+
+    def check_track_change(self):
+        # Follow a track change made by the audio thread (the previous song ended or a skip took over). While
+        # commands are queued, the output may not have taken on the track the UI already shows.
+        if self.output is None or self.output.commands:
+            return
+        if self.output.current is not None and self.output.current is not self.track:
+            if TRACING:
+                tracer.instant(TRACE_TRACK_CHANGE)
+            logging.debug(f"Now playing {self.output.current.path}")
+            self.show_track(self.output.current)
+
     def play_audio(self):
-        # Play audio through a callback function to handle chunks of audio data
+        # Resume the output, opening the audio stream the first time anything plays. Resuming is posted before the
+        # stream opens, so the mix worker's first block is already music rather than silence.
+        self.output.post(self.output.resume)
+        if self.stream is None:
+            self.open_audio_stream()
+
+    def open_audio_stream(self):
+        # Open the audio stream the output plays through. It stays open (rendering silence while paused) until the
+        # sample rate or channel count changes, so playing, pausing and seeking never wait for the device.
         def audio_callback(outdata, frames, time, status):
-            if self.current_position >= len(self.audio_data):
-                # Stop the stream and reset position when the end of the song is reached
-                logging.debug("End of song reached. Stopping audio stream.")
-                self.stop_audio_stream()
-                self.current_position = 0
-                self.paused_position = 0.0
-                self.song_start_time = None
-                self.metronome_running = False
-                self.stop_threads = True  # Signal threads to stop
-                self.play_pause_button.config(text="▶")
-                self.after(0, lambda: self.progress_bar.set(0))  # Reset progress bar to zero
-                self.update_time_labels()
-                return
-
-            # Calculate how much data to play in this chunk
-            start_idx = max(0, self.current_position)
-            end_idx = min(start_idx + frames * 2, len(self.audio_data))
-
-            # Slice the available data and reshape it
-            audio_chunk = self.audio_data[start_idx:end_idx]
-
-            # Zero-pad if needed
-            if len(audio_chunk) < frames * 2:
-                audio_chunk = np.pad(audio_chunk, (0, frames * 2 - len(audio_chunk)), 'constant')
-
-            outdata[:] = np.reshape(audio_chunk, (frames, 2)) / 32768.0  # Normalize audio output
-            self.current_position += frames * 2
-
-        # Stop any existing stream before starting a new one
-        logging.debug("Stopping any existing audio stream before starting a new one")
-        self.stop_audio_stream()
+            # Copy the next block out of the mix worker's ring buffer. The worker mixes the playlist output ahead
+            # of time, which hands over to the next track on the exact frame the current one ends (the engines use
+            # the same code path as offline_render.py). The DAC timestamp tells the transport clock when the
+            # block will actually be heard.
+            # The callback times itself, so the metrics show how close each block comes to its deadline.
+            started = perf_counter_ns()
+            output_latency = time.outputBufferDacTime - time.currentTime
+            underruns = self.mix_worker.ring.underruns
+            produced = self.mix_worker.render(outdata, frames, output_latency)
+            self.audio_metrics.record((perf_counter_ns() - started) * 1e-9, frames, status,
+                                      self.mix_worker.ring.underruns != underruns)
+            if TRACING:
+                tracer.complete(TRACE_CALLBACK, started, frames)
+            if not produced and not self.playlist_ended:
+                # The playlist has nothing left to play. The refresh tick rewinds it and resets the UI, so the
+                # audio thread never touches Tk; the stream keeps running on silence.
+                if TRACING:
+                    tracer.instant(TRACE_PLAYLIST_END)
+                self.playlist_ended = True
+
+        if self.audio_metrics is None or self.audio_metrics.sample_rate != self.output.sample_rate:
+            self.audio_metrics = AudioMetrics(self.output.sample_rate)
 
         try:
-            # Start a new audio output stream
-            self.stream = sd.OutputStream(callback=audio_callback, channels=2, samplerate=self.sample_rate)
+            import sounddevice as sd  # Imported on first play: loading PortAudio would hold up the window
+            # Start mixing ahead, then a new audio output stream that only copies the mixed frames out
+            self.mix_worker = MixWorker(self.output, self.output.sample_rate, self.output.channels, MIX_BUFFER_FRAMES)
+            self.mix_worker.start()
+            self.stream = sd.OutputStream(callback=audio_callback, channels=self.output.channels,
+                                          samplerate=self.output.sample_rate)
             self.stream.start()
             logging.debug("Audio stream started successfully")
         except Exception as e:
             logging.error(f"Error starting audio stream: {e}")
 
     def stop_audio_stream(self):
-        # Stop the current audio stream
-        if self.stream is not None and self.stream.active:
+        # Stop and close the current audio stream (only needed when the sample rate or channel count changes)
+        if self.stream is not None:
             try:
                 self.stream.stop()
                 self.stream.close()
@@ -323,180 +645,307 @@ class MusicPlayerApp(ttk.Window):
             except Exception as e:
                 logging.error(f"Error stopping or closing audio stream: {e}")
             self.stream = None
+        self.stop_mix_worker()
+
+    def stop_mix_worker(self):
+        # Stop rendering ahead (the stream must already be stopped) and log how the buffer coped
+        if self.mix_worker is not None:
+            self.mix_worker.stop()
+            logging.debug(f"Mix buffer: {self.mix_worker.stats()}")
+            self.mix_worker = None
 
     def load_metronome_sounds(self):
         # Load metronome sound files for bar and beat sounds
         logging.debug("Loading metronome sounds")
         try:
-            with wave.open(BAR_SOUND_FILE, 'rb') as wf:
-                self.bar_sound_data = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
-                self.bar_sound_rate = wf.getframerate()
-
-            with wave.open(BEAT_SOUND_FILE, 'rb') as wf:
-                self.beat_sound_data = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
-                self.beat_sound_rate = wf.getframerate()
+            # Any WAV format the songs accept, as float (frames, channels)
+            bar_info, beat_info = read_wav_header(BAR_SOUND_FILE), read_wav_header(BEAT_SOUND_FILE)
+            self.bar_sound_data, self.bar_sound_rate = decode_wav(BAR_SOUND_FILE, bar_info), bar_info.sample_rate
+            self.beat_sound_data, self.beat_sound_rate = decode_wav(BEAT_SOUND_FILE, beat_info), beat_info.sample_rate
+
+            # Resample once so the audio callback can mix the clicks on the exact sample of each beat
+            if self.engine is not None:
+                self.configure_engine(self.engine)
             logging.debug("Metronome sounds loaded successfully")
         except Exception as e:
             logging.error(f"Error loading metronome sounds: {e}")
 
-    def run_metronome(self):
-        # Start the metronome in a separate thread
-        logging.debug("Starting metronome")
-        if not self.metronome_running:
-            return
-
-        def metronome_loop():
-            logging.debug("Metronome loop started")
-            while self.metronome_running and not self.stop_threads:
-                try:
-                    # Calculate the current sample position and beats
-                    current_position = self.paused_position + (time.time() - self.song_start_time)
-                    current_sample = current_position * self.sample_rate
-                    beat_position = int((current_sample // self.samples_per_beat) % 4) + 1
-                    bar_number = int((current_sample // self.samples_per_beat) // 4) + 1
-
-                    # Safely update the metronome debug labels using self.after()
-                    self.after(0, lambda: self.current_sample_label.config(text=f"Current Sample Position: {int(current_sample)}"))
-                    samples_until_next_beat = self.samples_per_beat - (current_sample % self.samples_per_beat)
-                    self.after(0, lambda: self.samples_until_next_beat_label.config(text=f"Samples Until Next Beat: {int(samples_until_next_beat)}"))
-
-                    # Update the progress bar for the current beat
-                    progress = ((self.samples_per_beat - samples_until_next_beat) / self.samples_per_beat) * 100
-                    self.after(0, lambda: self.samples_progress_bar.config(value=progress))
-
-                    if beat_position != self.current_beat:
-                        logging.debug(f"Beat change detected: Bar {bar_number}, Beat {beat_position}")
-                        self.current_beat = beat_position
-                        self.after(0, lambda: self.bpm_indicator.config(text=f"Bar: {bar_number} Beat: {self.current_beat}"))
-
-                        # Play metronome sounds if enabled
-                        if self.metronome_clicks_enabled:
-                            if self.current_beat == 1:
-                                logging.debug("Playing bar sound")
-                                sd.play(self.bar_sound_data, samplerate=self.bar_sound_rate)  # Play bar sound
-                            else:
-                                logging.debug("Playing beat sound")
-                                sd.play(self.beat_sound_data, samplerate=self.beat_sound_rate)  # Play beat sound
-
-                    time.sleep(0.01)  # Sleep for 10 ms to not overload the CPU
-                except Exception as e:
-                    logging.error(f"Exception in metronome thread: {e}")
-
-        # Start the metronome thread
-        metronome_thread = threading.Thread(target=metronome_loop, daemon=True)
-        metronome_thread.start()
-
-    def update_progress_bar(self):
-        # Update the progress bar based on current playback position
-        logging.debug("Updating progress bar")
+    def refresh_ui(self):
+        # GUI refresh tick, run by Tk about REFRESH_INTERVAL_MS apart: read one snapshot of the engine and only
+        # touch the widgets whose displayed value changed. This is the only place playback state reaches Tk.
+        self.after(REFRESH_INTERVAL_MS, self.refresh_ui)
+        started = time.perf_counter_ns() if TRACING else 0
+        changed = 0
+        if self.playlist_ended:
+            self.finish_playlist()
+        if self.loading_path is not None:
+            self.update_loading()
+        if self.library_pending is not None:
+            self.adopt_library()
+        if self.album_art_pending is not None:
+            self.show_album_art()
         if not self.song_loaded:
             return
+        self.check_track_change()
+        state = self.engine.snapshot()
+        changed += self.draw_waveform(state)
 
-        current_position = self.paused_position if self.song_start_time is None else (self.paused_position + (time.time() - self.song_start_time))
-        total_length = self.get_total_length()
-        progress = (current_position / total_length) * 100
+        # Audible position from the transport clock, mapped back into the song file when it loops
+        current_position = state.song_position / self.sample_rate
+        if not self.is_scrubbing:
+            total_length = self.get_total_length()
+            progress = round((current_position / total_length) * 100, 1) if total_length else 0
+            changed += self.show("progress", progress, self.progress_bar.set)
+        changed += self.show("elapsed", time.strftime('%M:%S', time.gmtime(current_position)),
+                             lambda text: self.time_start_label.config(text=text))
 
-        # Use self.after to safely update the GUI
-        self.after(0, lambda: self.progress_bar.set(progress))
-        self.after(0, lambda: self.time_start_label.config(text=time.strftime('%M:%S', time.gmtime(current_position))))
+        if self.display_metronome_enabled:
+            changed += self.show("beat", f"Bar: {state.bar} Beat: {state.beat}",
+                                 lambda text: self.bpm_indicator.config(text=text))
+            changed += self.show("sample", f"Current Sample Position: {state.position}",
+                                 lambda text: self.current_sample_label.config(text=text))
+            changed += self.show("until_beat", f"Samples Until Next Beat: {state.samples_to_next_beat}",
+                                 lambda text: self.samples_until_next_beat_label.config(text=text))
+            grid = self.song.beat_grid
+            beat = grid.beat_index(state.position)
+            length = grid.frame(beat + 1) - grid.frame(beat)  # This beat's frames (the grid's period, rounded)
+            beat_progress = round((length - state.samples_to_next_beat) / length * 100)
+            changed += self.show("beat_progress", beat_progress, lambda value: self.samples_progress_bar.config(value=value))
+            changed += self.show("layers", f"Active Layers: {', '.join(state.active_layers)}",
+                                 lambda text: self.active_layers_label.config(text=text))
+        if self.display_metrics_enabled:
+            self.update_metrics_labels()
+
+        self.report_late_events()
+        if TRACING:
+            tracer.complete(TRACE_REFRESH, started, changed)
+
+    def show(self, key, value, apply):
+        # Pass value to apply (a widget update) only if it differs from what the widget shows; returns 1 if it did
+        if self.displayed.get(key) == value:
+            return 0
+        self.displayed[key] = value
+        apply(value)
+        return 1
+
+    def finish_playlist(self):
+        # The audio thread reached the end of the playlist: pause and rewind (the stream stays open)
+        logging.debug("End of playlist reached. Rewinding.")
+        self.output.post(self.output.pause, False)
+        self.output.post(self.engine.seek, 0)
+        if self.mix_worker is not None:
+            self.mix_worker.resume()  # The mix worker applies both commands and renders silence from then on
+        self.playlist_ended = False
+        self.paused_position = 0.0
+        self.metronome_running = False
+        self.play_pause_button.config(text="▶")
+        self.update_time_labels()
 
-        # Schedule the next call to update_progress_bar after 500 ms
-        if not self.is_scrubbing and not self.stop_threads:
-            self.after(500, self.update_progress_bar)
+    def load_waveforms(self, track):
+        # Load (or build and cache, the first time) the waveform pyramid of every layer of the track's first
+        # segment in the background; the refresh tick draws them once they are ready
+        def load():
+            try:
+                song = track.song
+                pyramids = {layer.name: load_pyramid(layer.file_name, layer.info, song.sample_rate)
+                            for layer in song.segments[0].layers}
+                self.waveform_pending = (track, pyramids)
+            except Exception as e:
+                logging.error(f"Error loading the waveform of {track.path}: {e}")
+
+        self.waveform_pyramids = {}
+        self.waveform_view = (0, self.song_metadata.frames)
+        threading.Thread(target=load, daemon=True).start()
+
+    def draw_waveform(self, state):
+        # Redraw the waveform and its markers if the view, the canvas size or the audible layers changed, and
+        # move the playhead. Returns how many canvas updates were made.
+        pending = self.waveform_pending
+        if pending is not None:
+            self.waveform_pending = None
+            if pending[0] is self.track:
+                self.waveform_pyramids = pending[1]
+        canvas = self.waveform_canvas
+        width = canvas.winfo_width()
+        start, end = self.waveform_view
+        if width <= 1 or end <= start:
+            return 0
+        frames_per_pixel = (end - start) / width
+
+        # Page along with the playhead while zoomed in
+        position = state.song_position
+        if self.metronome_running and not self.is_scrubbing and not start <= position < end:
+            span = end - start
+            start = max(0, min(position - span // 10, self.song_metadata.frames - span))
+            self.waveform_view = (start, start + span)
+            end = start + span
+
+        changed = self.show("playhead", round((position - start) / frames_per_pixel),
+                            lambda x: canvas.coords(self.playhead_item, x, 0, x, WAVEFORM_HEIGHT))
+        drawn = (self.waveform_view, width, state.active_layers, id(self.waveform_pyramids))
+        if drawn == self.waveform_drawn:
+            return changed
+        self.waveform_drawn = drawn
+
+        # One polygon: the maxima left to right, then the minima back
+        pyramids = [self.waveform_pyramids[name] for name in state.active_layers if name in self.waveform_pyramids]
+        pyramids = pyramids or list(self.waveform_pyramids.values())  # Nothing audible yet: show the whole song
+        mins, maxs = song_envelope(pyramids, start, end, width)
+        middle = WAVEFORM_HEIGHT / 2
+        x = np.arange(width, dtype=np.float32)
+        top = np.column_stack((x, middle - maxs * middle))
+        bottom = np.column_stack((x[::-1], middle - mins[::-1] * middle))
+        canvas.coords(self.waveform_item, *np.concatenate((top, bottom)).ravel().tolist())
+
+        # Beat and bar markers from the song's beat grid, as dense as the zoom allows
+        canvas.delete("marker")
+        grid = self.engine.grid
+        beat_pixels = grid.period / frames_per_pixel
+        if beat_pixels * BEATS_PER_BAR >= MARKER_SPACING:
+            every = 1 if beat_pixels >= MARKER_SPACING else BEATS_PER_BAR
+            first = grid.next_beat(start, every)[1]
+            beats = np.arange(first, grid.beat_index(end) + 1, every)
+            for beat, frame in zip(beats.tolist(), grid.frames_of(beats).tolist()):
+                marker_x = (frame - start) / frames_per_pixel
+                bar = beat % BEATS_PER_BAR == 0
+                canvas.create_line(marker_x, 0, marker_x, WAVEFORM_HEIGHT if bar else WAVEFORM_HEIGHT / 4,
+                                   fill="#8E8E93" if bar else "#48484A", tags="marker")
+        canvas.tag_raise(self.playhead_item)
+        return changed + 1
+
+    def zoom_waveform(self, event, direction):
+        # Zoom the waveform in (direction < 0) or out around the frame under the mouse
+        start, end = self.waveform_view
+        width = self.waveform_canvas.winfo_width()
+        total = self.song_metadata.frames if self.song_metadata is not None else 0
+        if width <= 1 or end <= start or not total:
+            return
+        anchor = start + (end - start) * event.x / width
+        span = (end - start) * (WAVEFORM_ZOOM_STEP if direction > 0 else 1 / WAVEFORM_ZOOM_STEP)
+        span = int(min(total, max(WAVEFORM_MIN_SECONDS * self.sample_rate, span)))
+        start = int(min(max(0, anchor - span * event.x / width), total - span))
+        self.waveform_view = (start, start + span)
+
+    def waveform_scrub(self, event):
+        # Move the progress bar to the frame under the mouse and seek there, as if it had been dragged
+        start, end = self.waveform_view
+        width = self.waveform_canvas.winfo_width()
+        total = self.get_total_length() * self.sample_rate if self.song_loaded else 0
+        if width <= 1 or not total:
+            return
+        frame = start + (end - start) * min(max(event.x, 0), width) / width
+        self.progress_bar.set(min(100, frame / total * 100))
+        self.update_position_during_drag(event)
+
+    def start_waveform_scrub(self, event):
+        # Clicking the waveform starts scrubbing like the progress bar does
+        self.start_scrubbing()
+        self.waveform_scrub(event)
+
+    def end_waveform_scrub(self, event):
+        # Releasing the mouse seeks to the scrubbed position (and resumes if the song was playing)
+        self.waveform_scrub(event)
+        self.seek_song(event)
+
+    def report_late_events(self):
+        # Log timeline events the audio callback could not apply on their exact sample (e.g. after a seek)
+        scheduler = self.engine.scheduler
+        while scheduler is not None and scheduler.late:
+            event, frames_late = scheduler.late.popleft()
+            logging.warning(f"Timeline instruction {event.index} ({event.action}) was applied {frames_late} frames late")
 
     def update_position_during_drag(self, event):
         # Update the song position while scrubbing (dragging the progress bar)
-        logging.debug("Updating position during drag")
         if self.song_loaded:
             value = self.progress_bar.get()
             total_length = self.get_total_length()
-            self.paused_position = max(0, (value / 100) * total_length)
-            self.current_position = max(0, int(self.paused_position * self.sample_rate * 2))
-            self.update_time_labels()
-
-            # Update metronome debug labels while scrubbing
-            current_sample = self.paused_position * self.sample_rate
-            self.after(0, lambda: self.current_sample_label.config(text=f"Current Sample Position: {int(current_sample)}"))
-            samples_until_next_beat = self.samples_per_beat - (current_sample % self.samples_per_beat)
-            self.after(0, lambda: self.samples_until_next_beat_label.config(text=f"Samples Until Next Beat: {int(samples_until_next_beat)}"))
-            progress = ((self.samples_per_beat - samples_until_next_beat) / self.samples_per_beat) * 100
-            self.after(0, lambda: self.samples_progress_bar.config(value=progress))
+            position = max(0, (value / 100) * total_length)
+            if TRACING:
+                tracer.instant(TRACE_DRAG, position)
+            if not self.metronome_running:
+                self.seek_to(position)  # While playing, the song plays on until the bar is released
 
     def start_scrubbing(self):
-        # Start scrubbing (user starts dragging the progress bar)
+        # Start scrubbing (user starts dragging the progress bar); playback carries on
         logging.debug("Started scrubbing")
         self.is_scrubbing = True
-        self.was_playing_before_scrub = self.metronome_running  # Set if the song is playing or not before scrubbing
-        self.pause_song()
-
 
     def seek_song(self, event):
-        # Seek the song to the new position after scrubbing is complete
+        # Seek the song to the new position after scrubbing is complete, crossfading there if it is playing
         logging.debug("Seeking song to new position")
         if self.song_loaded:
             self.is_scrubbing = False
-
             value = self.progress_bar.get()
             total_length = self.get_total_length()
-            self.paused_position = max(0, (value / 100) * total_length)
-            self.current_position = max(0, int(self.paused_position * self.sample_rate * 2))
-            self.update_time_labels()
-            self.time_start_label.config(text=time.strftime('%M:%S', time.gmtime(self.paused_position)))
-
-            # Cancel the metronome loop if it's running and has a valid ID
-            if self.metronome_id is not None:
-                try:
-                    self.after_cancel(self.metronome_id)
-                    self.metronome_id = None  # Reset after canceling
-                except ValueError:
-                    logging.warning("Metronome ID was invalid when trying to cancel")
-                    self.metronome_id = None
-
-            # Only resume playback if the song was playing before scrubbing started
-            if self.was_playing_before_scrub:
-                logging.debug("Restarting audio stream after seek")
-                self.song_start_time = time.time()  # Reset start time
-                self.metronome_running = True
-                self.stop_threads = False  # Reset thread stop flag
-                self.play_pause_button.config(text="⏸")
-                self.play_audio()  # Start playback
-                self.update_progress_bar()
-                self.run_metronome()  # Start metronome again
-            else:
-                logging.debug("Keeping the song paused after seek")
-                self.metronome_running = False
-                self.stop_threads = True
-                self.play_pause_button.config(text="▶")
+            self.seek_to((value / 100) * total_length)
 
 
     def update_time_labels(self):
         # Update the time labels for song duration
-        logging.debug("Updating time labels")
         total_length = self.get_total_length()
-        self.after(0, lambda: self.time_end_label.config(text=time.strftime('%M:%S', time.gmtime(total_length))))
+        self.show("total", time.strftime('%M:%S', time.gmtime(total_length)), lambda text: self.time_end_label.config(text=text))
 
     def get_total_length(self):
-        # Get the total length of the loaded song in seconds
-        logging.debug("Getting total length of the song")
-        try:
-            with contextlib.closing(wave.open(SONG_FILE, 'r')) as f:
-                frames = f.getnframes()
-                rate = f.getframerate()
-                return frames / float(rate)
-        except Exception as e:
-            logging.error(f"Error getting total length: {e}")
+        # Get the total length of the loaded song in seconds (from the metadata cached at load time)
+        if self.song_metadata is None:
             return 0
+        return self.song_metadata.duration
+
+    def prefetch_upcoming_songs(self):
+        # Start reading the stems of the songs that follow the current one, and of the one before it, into memory
+        # in the background
+        upcoming = [self.playlist.peek(step) for step in range(1, PREFETCH_SONGS + 1)] + [self.playlist.peek(-1)]
+        upcoming = [path for path in dict.fromkeys(upcoming) if path not in (None, self.current_song_path)]
+        threading.Thread(target=prefetch_songs, args=(upcoming, OUTPUT_CHANNELS), daemon=True).start()  # Plans may need compiling
 
     def prev_song(self):
-        # Placeholder function for the previous song button
+        # Go to the previous song of the playlist
         logging.info("Previous button pressed")
+        self.change_song(-1)
 
     def next_song(self):
-        # Placeholder function for the next song button
+        # Go to the next song of the playlist
         logging.info("Next button pressed")
+        self.change_song(1)
+
+    def change_song(self, step):
+        # Switch to the song step places away in the playlist. The next and previous songs are usually prepared
+        # already; any other song is built on the loader thread first, so the GUI never waits for it.
+        path = self.playlist.peek(step)
+        if path is None or self.output is None or self.loading_path is not None or not self.library_scanned:
+            return
+        upcoming, previous = self.output.upcoming, self.previous_track
+        if upcoming is not None and upcoming.path == path and not self.output.incoming_started:
+            self.switch_track(upcoming)  # Already prepared in the background
+        elif previous is not None and previous.path == path:
+            self.switch_track(previous)
+        else:
+            self.start_loading(path, skip=True)  # update_loading() switches to it once it is playable
+
+    def switch_track(self, track):
+        # Make a prepared track current. While playing, it takes over inside the running stream on the next
+        # beat; the output device is never reopened.
+        if not self.output.accepts(track):
+            # Different sample rate or channel count: this is the one case that needs a new stream
+            self.load_song(track.path, track)
+            if self.metronome_running:
+                self.play_audio()
+            return
+        self.playlist.select(track.path)
+        if self.metronome_running:
+            crossfade = self.engine.beats_to_frames(SKIP_CROSSFADE_BEATS)
+            self.output.post(self.output.skip, track, SKIP_QUANTIZE, crossfade)  # The UI follows in check_track_change()
+        else:
+            self.output.post(self.output.set_current, track)
+            if self.stream is None or not self.stream.active:
+                self.output.run_commands()
+            self.show_track(track)  # The refresh tick moves the progress bar back to the start of the new song
 
 
 if __name__ == "__main__":
     logging.debug("Starting Music Player App")
     app = MusicPlayerApp()
     app.mainloop()
+    if TRACING:
+        tracer.export_chrome(TRACE_FILE)
+        logging.info(f"Trace written to {TRACE_FILE}")
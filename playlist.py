@@ -0,0 +1,275 @@
+import collections
+import glob
+import logging
+import os
+
+import numpy as np
+
+from engine import PlaybackEngine, DECLICK_SECONDS
+from mixer import DEFAULT_BLOCK_SIZE, touch_frames
+from scheduler import TimelineScheduler
+from song_loader import load_song, load_segments
+from transitions import CURVE_LINEAR, curve_values
+
+# Constants
+SONG_DIR = "MusicJSONs"  # Library of song descriptions
+OUTPUT_CHANNELS = 2  # Channels of the output stream, which every track's stems are fitted to
+READY_SECONDS = 3.0  # Audio of every first-segment layer read in before a quickly prepared track counts as playable
+
+
+class Playlist:
+    def __init__(self, paths):
+        # Ordered song JSONs with a current position; stepping past either end wraps around
+        self.paths = list(paths)
+        self.index = 0
+
+    @classmethod
+    def from_directory(cls, directory=SONG_DIR):
+        # Every song JSON of a directory in file name order, skipping (and logging) those that do not compile
+        paths = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            try:
+                load_song(path)  # Cached after the first run, so scanning the library stays cheap
+                paths.append(path)
+            except Exception as e:
+                logging.warning(f"Leaving {path} out of the playlist: {e}")
+        return cls(paths)
+
+    @property
+    def current(self):
+        # Path of the current song, or None if the playlist is empty
+        return self.paths[self.index] if self.paths else None
+
+    def peek(self, step=1):
+        # Path of the song step places away from the current one
+        if not self.paths:
+            return None
+        return self.paths[(self.index + step) % len(self.paths)]
+
+    def move(self, step=1):
+        # Make the song step places away the current one and return its path
+        if self.paths:
+            self.index = (self.index + step) % len(self.paths)
+        return self.current
+
+    def select(self, path):
+        # Make a song the current one (added to the end if it is not in the playlist yet)
+        if path not in self.paths:
+            self.paths.append(path)
+        self.index = self.paths.index(path)
+
+
+class Track:
+    __slots__ = ("path", "song", "engine")
+
+    def __init__(self, path, song, engine):
+        # A song ready to be played: its compiled SongSpec and an engine with its first segment loaded
+        self.path = path
+        self.song = song
+        self.engine = engine
+
+
+def build_engine(song, segments, channels=OUTPUT_CHANNELS):
+    # Engine of a compiled song, as live playback and offline rendering both start it: the first segment on its
+    # default layers and the timeline armed, so the first block can be mixed at once. segments are the song's
+    # loaded layers (from load_segments(song, channels)).
+    first_segment = song.segments[0]
+    layers = segments[first_segment.name]
+    engine = PlaybackEngine(song.sample_rate, channels=channels, bpm=song.bpm, grid=song.beat_grid)
+    engine.load_segment(layers, exclusive=first_segment.exclusive)
+
+    if engine.exclusive:
+        engine.set_active_layers([layers[0].name], immediate=True)  # Start on the first variant
+    else:
+        # Every layer plays, except those switched off by the default position of their layer control button
+        for layer in layers:
+            button = song.button(layer.button)
+            enabled = button is None or button.enables_layers(button.default_position)
+            engine.set_layer_enabled(layer.name, enabled, immediate=True)
+
+    if song.timeline:
+        # The audio callback runs the timeline on exact samples; layer buttons still act on top of it, from
+        # their default positions on
+        disabled = [button.name for button in song.buttons if not button.enables_layers(button.default_position)]
+        engine.set_timeline(TimelineScheduler(song.timeline, segments, song.exclusive_segments,
+                                              current_segment=first_segment.name, disabled_buttons=disabled))
+    return engine
+
+
+def prepare_track(path, channels=OUTPUT_CHANNELS, quick=False, progress=None):
+    # Compile a song and build its engine with build_engine(); stems come from the stem cache (usually
+    # prefetched). quick returns once the first READY_SECONDS of each first-segment layer are in memory, however
+    # long the stems are: stems not cached yet play from their mapped files while the cache copies them in the
+    # background. progress is passed on to load_segments().
+    song = load_song(path)
+    segments = load_segments(song, channels, mapped=quick, progress=progress)
+    engine = build_engine(song, segments, channels)
+    if quick:
+        for layer in segments[song.segments[0].name]:
+            touch_frames(layer, 0, int(READY_SECONDS * song.sample_rate))
+    return Track(path, song, engine)
+
+
+class PlaylistOutput:
+    def __init__(self, sample_rate, channels=2):
+        # What the output stream plays: the current track, followed by the upcoming one on the very next sample
+        # when it ends, or crossfaded into it on a skip. Track changes, pausing and resuming only change what the
+        # audio callback renders, so the device stream stays open for the whole session.
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.paused = True  # Rendering silence with every track standing still, until resume()
+        self.ramp = None  # De-click ramp of a pause (falling) or resume (rising) being rendered, or None
+        self.ramp_offset = 0  # Frames of that ramp already rendered
+        # Linear de-click ramps, (frames, channels) so applying them never broadcasts
+        rising, falling = curve_values(CURVE_LINEAR, max(1, int(DECLICK_SECONDS * sample_rate)))
+        self.rising = np.repeat(rising[:, np.newaxis], channels, axis=1).astype(np.float32)
+        self.falling = np.repeat(falling[:, np.newaxis], channels, axis=1).astype(np.float32)
+        self.current = None  # Track playing
+        self.upcoming = None  # Track that follows the current one
+        self.incoming_at = None  # Output frame at which a skip starts upcoming (None = when current ends)
+        self.incoming_started = False  # upcoming is already playing (overlapping the end of current)
+        self.frame = 0  # Frames output so far
+        self.commands = collections.deque()  # (function, args) posted by other threads, run before a block
+        self.allocate(DEFAULT_BLOCK_SIZE)
+
+    def allocate(self, block_size):
+        # Preallocate the buffer the upcoming track is rendered into while it overlaps the current one
+        self.block_capacity = block_size
+        self.scratch = np.zeros((block_size, self.channels), dtype=np.float32)
+
+    def accepts(self, track):
+        # Whether a track can play through this output without reopening the stream
+        return track.song.sample_rate == self.sample_rate and track.engine.channels == self.channels
+
+    def post(self, function, *args):
+        # Run function(*args) on the audio thread just before the next block
+        self.commands.append((function, args))
+
+    def run_commands(self):
+        # Apply every posted command (called by render(), or directly while no stream is open)
+        while self.commands:
+            function, args = self.commands.popleft()
+            function(*args)
+
+    def set_current(self, track):
+        # Play a track from where its engine is, dropping whatever was playing or about to
+        self.current = track
+        self.upcoming = None
+        self.incoming_at = None
+        self.incoming_started = False
+
+    def set_upcoming(self, track, after=None):
+        # Queue the track to follow the current one, unless a skip is already on its way or (if after is given)
+        # the current track is no longer the one it was prepared to follow
+        if after is not None and self.current is not after:
+            return
+        if self.incoming_at is None and not self.incoming_started:
+            self.upcoming = track
+
+    def skip(self, track, quantize=None, crossfade_frames=0):
+        # Start a track on the next beat or bar of the current one (or on the next block), crossfading from that
+        # point over crossfade_frames (at least a de-click ramp): the current one fades out as the new one fades in
+        if self.incoming_started:
+            self.promote()  # A skip was already crossfading; finish it at once
+        if self.current is None or self.current.engine.finished:
+            self.set_current(track)
+            return
+        engine = self.current.engine
+        lead = engine.next_boundary(quantize) - engine.mixer.frame
+        length = max(engine.declick_frames, int(crossfade_frames))
+        engine.fade_out(length, engine.position + lead)
+        track.engine.fade_in(length)  # It renders nothing until the skip point, so its fade starts there too
+        self.upcoming = track
+        self.incoming_at = self.frame + lead
+        self.incoming_started = False
+
+    def promote(self):
+        # The upcoming track becomes the current one
+        self.current = self.upcoming
+        self.upcoming = None
+        self.incoming_at = None
+        self.incoming_started = False
+
+    def pause(self, fade=True):
+        # Stop moving the tracks, after a de-click fade-out (unless fade is False); the output renders silence
+        if self.paused or self.ramp is self.falling:
+            return
+        if not fade:
+            self.paused, self.ramp = True, None
+            return
+        # A resume still fading in turns around from the gain it reached
+        self.ramp_offset = len(self.falling) - self.ramp_offset if self.ramp is self.rising else 0
+        self.ramp = self.falling
+
+    def resume(self):
+        # Move the tracks again from where they stopped, fading in from silence
+        if self.ramp is self.falling:
+            self.ramp, self.ramp_offset = self.rising, len(self.rising) - self.ramp_offset
+        elif self.paused:
+            self.paused = False
+            self.ramp, self.ramp_offset = self.rising, 0
+
+    def render(self, outdata, frames, output_latency=0.0):
+        # Fill outdata with the next block: silence while paused, otherwise the tracks (see render_tracks()),
+        # faded in or out where a resume or pause starts. Returns the number of frames with music (silence while
+        # paused counts), so 0 means the playlist has run out.
+        self.run_commands()
+        if self.paused:
+            outdata.fill(0)
+            return frames
+        size = frames
+        if self.ramp is self.falling:
+            size = min(frames, len(self.falling) - self.ramp_offset)  # The tracks stop where the fade-out ends
+        produced = self.render_tracks(outdata, size, output_latency)
+
+        if self.ramp is not None:
+            length = min(size, len(self.ramp) - self.ramp_offset)
+            target = outdata[:length]
+            np.multiply(target, self.ramp[self.ramp_offset:self.ramp_offset + length], out=target)
+            self.ramp_offset += length
+            if self.ramp_offset >= len(self.ramp):
+                self.paused = self.ramp is self.falling
+                self.ramp = None
+        if size < frames:
+            outdata[size:frames] = 0
+            if produced == size:
+                produced = frames  # Paused, not run out
+        return produced
+
+    def render_tracks(self, outdata, frames, output_latency):
+        # Render the tracks. The upcoming track starts on the exact frame the current one ends (or at the skip
+        # point) and is summed in from there. Returns the number of frames with music.
+        if frames > self.block_capacity:
+            self.allocate(frames)
+        start = self.frame
+        self.frame += frames
+
+        produced = 0
+        if self.current is not None:
+            produced = self.current.engine.render(outdata, frames, output_latency)
+        else:
+            outdata.fill(0)
+
+        upcoming = self.upcoming
+        if upcoming is None:
+            return produced
+        offset = None
+        if self.incoming_started:
+            offset = 0
+        else:
+            if self.incoming_at is not None and self.incoming_at < start + frames:
+                offset = max(0, self.incoming_at - start)
+            if produced < frames:
+                offset = produced if offset is None else min(offset, produced)  # Never leave a gap
+        if offset is None:
+            return produced
+
+        self.incoming_started = True
+        size = frames - offset
+        piece = self.scratch[:size]
+        upcoming_produced = upcoming.engine.render(piece, size, output_latency + offset / self.sample_rate)
+        target = outdata[offset:frames]
+        np.add(target, piece, out=target)
+        if produced < frames:
+            self.promote()  # The current track has ended
+        return max(produced, offset + upcoming_produced)
@@ -0,0 +1,56 @@
+import functools
+import math
+
+import numpy as np
+
+# Constants
+ZERO_CROSSINGS = 32  # Sinc lobes kept on each side of the interpolation filter
+KAISER_BETA = 8.6  # Shape of the Kaiser window (sidelobes below -87 dB; stopband tones alias at about -95 to -100 dB)
+ROLLOFF = 0.95  # Filter cutoff as a fraction of the lower of the two Nyquist frequencies
+
+
+def ratio(from_rate, to_rate):
+    # (up, down): the rate change as a fraction in lowest terms
+    divisor = math.gcd(int(from_rate), int(to_rate))
+    return int(to_rate) // divisor, int(from_rate) // divisor
+
+
+def resampled_length(frames, from_rate, to_rate):
+    # Number of frames resample() produces from the given number of frames
+    up, down = ratio(from_rate, to_rate)
+    return -(-frames * up // down)
+
+
+@functools.lru_cache(maxsize=16)
+def polyphase_filter(up, down):
+    # Windowed-sinc interpolation filter split into its up phases: output frame n lies phase / up of a frame past
+    # input frame base = n * down // up (phase = n * down % up) and is the dot product of row phase with the
+    # input frames base - half + 1 .. base + half. Every row sums to 1, so DC passes unchanged.
+    cutoff = ROLLOFF * min(1.0, up / down)  # In cycles per input frame (times two): below both Nyquist frequencies
+    half = int(math.ceil(ZERO_CROSSINGS / cutoff))
+    phases = np.arange(up, dtype=np.float64)[:, np.newaxis] / up
+    distance = phases + (half - 1) - np.arange(2 * half, dtype=np.float64)[np.newaxis, :]  # Output minus input time
+    window = np.i0(KAISER_BETA * np.sqrt(np.clip(1.0 - (distance / half) ** 2, 0.0, 1.0))) / np.i0(KAISER_BETA)
+    table = cutoff * np.sinc(cutoff * distance) * window
+    table /= table.sum(axis=1, keepdims=True)
+    return table.astype(np.float32), half
+
+
+def resample(data, from_rate, to_rate):
+    # Band-limited polyphase resampling of a (frames, channels) array to another sample rate, as float32
+    data = np.asarray(data)
+    if from_rate == to_rate:
+        return data.astype(np.float32, copy=False)
+    up, down = ratio(from_rate, to_rate)
+    table, half = polyphase_filter(up, down)
+    padded = np.zeros((len(data) + 2 * half, data.shape[1]), dtype=np.float32)  # Silence before and after
+    padded[half:half + len(data)] = data
+    # Outputs n, n + up, n + 2 * up, ... share a phase and step down input frames at a time, so each of those
+    # runs is one matrix-vector product over a strided view of the input (no per-sample work, no gathered copy)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half, axis=0)  # (frames, channels, taps)
+    output = np.empty((resampled_length(len(data), from_rate, to_rate), data.shape[1]), dtype=np.float32)
+    for first in range(min(up, len(output))):
+        position = first * down
+        targets = output[first::up]
+        np.matmul(windows[position // up + 1::down][:len(targets)], table[position % up], out=targets)
+    return output
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from event_trace import tracer, TRACING
+from mixer import DEFAULT_BLOCK_SIZE
+
+# Constants
+DEFAULT_BUFFER_FRAMES = 8192  # Frames mixed ahead of the audio callback (more survives busier machines, but adds latency)
+PRIME_TIMEOUT = 1.0  # Seconds start() waits for the first block before letting the stream open anyway
+TRACE_MIX = tracer.event("mix_block")  # arg: frames produced
+TRACE_BUFFERED = tracer.event("buffered_frames")  # Counter: ring fill level after each block
+TRACE_UNDERRUN = tracer.event("underrun")  # arg: frames missing
+
+
+class RingBuffer:
+    def __init__(self, capacity, channels=2):
+        # Preallocated single-producer/single-consumer FIFO of float32 frames. The producer only moves
+        # write_index and the consumer only moves read_index; both only ever grow, and each is moved after the
+        # frames it covers have been copied, so neither side needs a lock.
+        self.capacity = int(capacity)
+        self.channels = channels
+        self.buffer = np.zeros((self.capacity, channels), dtype=np.float32)
+        self.write_index = 0  # Frames written so far
+        self.read_index = 0  # Frames read so far
+        self.underruns = 0  # Reads that found fewer frames than asked for
+        self.overruns = 0  # Writes that found less room than they needed (the frames that did not fit are dropped)
+
+    def available(self):
+        # Frames ready to be read
+        return self.write_index - self.read_index
+
+    def space(self):
+        # Frames that can be written without overwriting unread ones
+        return self.capacity - self.available()
+
+    def write(self, block):
+        # (Producer) Append a block of frames; returns how many fit
+        frames = min(len(block), self.space())
+        if frames < len(block):
+            self.overruns += 1
+        start = self.write_index % self.capacity
+        first = min(frames, self.capacity - start)
+        np.copyto(self.buffer[start:start + first], block[:first])
+        np.copyto(self.buffer[:frames - first], block[first:frames])
+        self.write_index += frames
+        return frames
+
+    def read(self, outdata, frames):
+        # (Consumer) Copy the oldest frames into outdata, silencing whatever is missing; returns how many were read
+        available = min(frames, self.available())
+        start = self.read_index % self.capacity
+        first = min(available, self.capacity - start)
+        np.copyto(outdata[:first], self.buffer[start:start + first])
+        np.copyto(outdata[first:available], self.buffer[:available - first])
+        if available < frames:
+            outdata[available:frames] = 0
+        self.read_index += available
+        return available
+
+    def clear(self):
+        # Drop every unread frame (only while neither side is running)
+        self.read_index = self.write_index = 0
+
+
+class MixWorker:
+    def __init__(self, source, sample_rate, channels=2, buffer_frames=DEFAULT_BUFFER_FRAMES, block_size=DEFAULT_BLOCK_SIZE):
+        # Renders source (anything with render(outdata, frames, output_latency), e.g. a PlaylistOutput) ahead of
+        # the audio callback on its own thread, into a ring buffer the callback only copies out of. Mixing,
+        # fades and loops can then take longer than one device block without the device running dry, as long as
+        # they keep up on average. buffer_frames trades added latency for robustness.
+        self.source = source
+        self.sample_rate = sample_rate
+        self.ring = RingBuffer(buffer_frames, channels)
+        self.block_size = min(block_size, self.ring.capacity)
+        self.block = np.zeros((self.block_size, channels), dtype=np.float32)  # Where the worker renders
+        self.device_latency = 0.0  # Seconds from the callback to the DAC, as last reported by the callback
+        self.finished = False  # The source ran out; whatever is left in the ring is the end of the music
+        self.running = False
+        self.thread = None
+        self.wake = threading.Event()  # Set by the callback whenever it frees room
+        self.primed = threading.Event()  # Set once the first block is in the ring (or the source ran out)
+
+    def start(self):
+        # Start rendering ahead and wait (briefly) for the first block, so the stream does not open on an underrun
+        if self.running:
+            return
+        self.running = True
+        self.finished = False
+        self.primed.clear()
+        self.thread = threading.Thread(target=self.run, name="mix-worker", daemon=True)
+        self.thread.start()
+        self.primed.wait(PRIME_TIMEOUT)
+
+    def stop(self):
+        # Stop the worker and drop the frames it rendered ahead (call only while the stream is stopped)
+        self.running = False
+        self.wake.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        self.ring.clear()
+        self.finished = False
+
+    def resume(self):
+        # Render again after the source ran out (once it has been given something new to play)
+        self.finished = False
+        self.wake.set()
+
+    def run(self):
+        # (Worker thread) Keep the ring topped up, one block at a time
+        ring = self.ring
+        while self.running:
+            if self.finished or ring.space() < self.block_size:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            # Frames already queued play before this block, so the transport clock hears it that much later
+            latency = ring.available() / self.sample_rate + self.device_latency
+            started = time.perf_counter_ns() if TRACING else 0
+            try:
+                produced = self.source.render(self.block, self.block_size, latency)
+            except Exception as e:
+                logging.error(f"Mix worker stopped: {e}")
+                produced = 0
+            ring.write(self.block[:produced])
+            if TRACING:
+                tracer.complete(TRACE_MIX, started, produced)
+                tracer.counter_value(TRACE_BUFFERED, ring.available())
+            if produced < self.block_size:
+                self.finished = True
+            self.primed.set()
+
+    def render(self, outdata, frames, output_latency=0.0):
+        # (Audio callback) Copy the next frames out of the ring. Returns how many frames of music the block
+        # holds, so 0 means the source has run out; a short read while the worker is still going is an underrun.
+        self.device_latency = output_latency
+        finished = self.finished  # Checked before reading: once set, every remaining frame is already in the ring
+        read = self.ring.read(outdata, frames)
+        if read < frames and not finished:
+            self.ring.underruns += 1
+            if TRACING:
+                tracer.instant(TRACE_UNDERRUN, frames - read)
+        self.wake.set()
+        return read if finished else frames
+
+    def stats(self):
+        # Counters for logging: buffer depth, fill level, underruns and overruns
+        ring = self.ring
+        return {"buffer_frames": ring.capacity, "buffered_frames": ring.available(),
+                "underruns": ring.underruns, "overruns": ring.overruns}
@@ -0,0 +1,151 @@
+import bisect
+import collections
+import logging
+
+from transitions import CURVE_CUT
+
+# Constants
+PLAY_SEGMENT = "PLAY_SEGMENT"  # Play a segment with the given layers (a transition if it is already playing)
+ENABLE_LAYER = "ENABLE_LAYER"  # Fade a layer of the current segment in
+END_SONG = "END_SONG"  # Fade out ("fadeoutAfter") or jump to the ending segment ("jumpToSegment")
+TIMELINE_ACTIONS = (PLAY_SEGMENT, ENABLE_LAYER, END_SONG)
+LATE_EVENT_HISTORY = 32  # Late events kept for reporting
+
+
+class TimelineEvent:
+    __slots__ = ("index", "action", "frame", "due", "fade", "segment", "layers", "method", "duration")
+
+    def __init__(self, index, action, frame, due, fade, instruction):
+        # One linearPlaybackTimeline instruction at an absolute timeline frame
+        self.index = index  # Position of the instruction in the song JSON
+        self.action = action  # PLAY_SEGMENT, ENABLE_LAYER or END_SONG
+        self.frame = frame  # Timeline frame on which the action is heard
+        self.due = due  # Timeline frame at which the scheduler applies it (earlier for fades with a lead-in)
+        self.fade = fade  # Layers change with their transitions rather than instantly
+        if action == ENABLE_LAYER:
+            self.segment = None
+            self.layers = [instruction.get("layer")]
+        elif action == END_SONG:
+            self.segment = instruction.get("endSegment")
+            self.layers = []
+        else:
+            self.segment = instruction.get("segment")
+            self.layers = list(instruction.get("layers", []))
+        self.method = instruction.get("method")  # END_SONG method
+        self.duration = float(instruction.get("duration") or 0.0)  # END_SONG fade-out length in beats
+
+
+def compile_timeline(timeline, grid, lookahead=0):
+    # Turn a linearPlaybackTimeline into TimelineEvents sorted by frame. beatsUntilNextInstruction accumulates
+    # in beats and each event's frame comes from the song's BeatGrid period, so rounding never adds up. Fades of
+    # the segment already playing are due lookahead frames early, so a lead-in can start before the event;
+    # segment changes and the ending are due exactly on their frame.
+    events = []
+    frame = due = 0
+    beats = 0.0
+    segment = None
+    for index, instruction in enumerate(timeline):
+        action = instruction.get("action")
+        if action not in TIMELINE_ACTIONS:
+            logging.warning(f"Unknown timeline action: {action}")
+            continue
+        fade = action == ENABLE_LAYER or (action == PLAY_SEGMENT and bool(events) and instruction.get("segment") == segment)
+        due = max(due, frame - lookahead) if fade else frame  # Never before an earlier event
+        events.append(TimelineEvent(index, action, frame, due, fade, instruction))
+        if action == PLAY_SEGMENT:
+            segment = instruction.get("segment")
+        elif action == END_SONG:
+            break
+        beats += instruction.get("beatsUntilNextInstruction", 0)
+        frame = grid.frames(beats)
+    return events
+
+
+class TimelineScheduler:
+    def __init__(self, events, segments, exclusive=(), current_segment=None, disabled_buttons=()):
+        # Runs compiled timeline events from the audio thread. The engine asks run() before every piece of a block;
+        # it applies whatever is due and says how many frames may be rendered before the next event, so render()
+        # splits the block there and every action lands on its exact sample. Only the next event is ever looked
+        # at, so the cost per block does not depend on the length of the timeline.
+        # disabled_buttons names the layer control buttons whose position switches their layers off: events
+        # never enable those layers, so a button keeps working on top of the timeline (also when it replays).
+        self.events = events
+        self.dues = [event.due for event in events]  # For seeking
+        self.segments = segments  # Segment name -> [Layer, ...]
+        self.exclusive = exclusive  # Names of segments whose layers are variants played one at a time
+        self.current_segment = current_segment  # Segment the engine is playing
+        self.disabled_buttons = set(disabled_buttons)  # Buttons whose layers stay off whatever the events say
+        self.next_event = 0  # Index of the next event to apply
+        self.origin = 0  # Timeline frame at which the current segment was at playback position 0
+        self.late_count = 0  # Events applied after their due frame
+        self.late = collections.deque(maxlen=LATE_EVENT_HISTORY)  # (TimelineEvent, frames late), for reporting
+
+    @property
+    def done(self):
+        # True once every event has been applied
+        return self.next_event >= len(self.events)
+
+    def seek(self, frame):
+        # Continue from a timeline frame. Seeking back re-arms the events due from there on; seeking forward
+        # keeps the skipped events pending, so they are applied (late) on the next block and no layer is missed.
+        self.next_event = min(self.next_event, bisect.bisect_left(self.dues, frame))
+
+    def set_button(self, name, enabled):
+        # (Audio thread) Follow a layer control button, so later events leave its layers as it has them
+        if enabled:
+            self.disabled_buttons.discard(name)
+        else:
+            self.disabled_buttons.add(name)
+
+    def allows(self, layer):
+        # Whether events may enable a layer (its layer control button, if any, does not switch it off)
+        return layer is not None and layer.button not in self.disabled_buttons
+
+    def run(self, engine, frames):
+        # (Audio thread) Apply every event due at the engine's position, then return how many of the next
+        # frames can be rendered before another event is due
+        while self.next_event < len(self.events):
+            now = self.origin + engine.position
+            event = self.events[self.next_event]
+            if event.due > now:
+                return min(frames, event.due - now)
+            if event.due < now:
+                self.late_count += 1
+                self.late.append((event, now - event.due))
+            self.next_event += 1
+            self.apply(engine, event, now)
+        return frames
+
+    def apply(self, engine, event, now):
+        # Carry out one event. Fades are scheduled on the mixer frame that corresponds to the event's frame.
+        at_frame = engine.mixer.frame + max(0, event.frame - now)
+        if event.action == ENABLE_LAYER:
+            for name in event.layers:
+                if self.allows(engine.get_layer(name)):
+                    engine.apply_transition(name, True, None, at_frame)
+        elif event.action == PLAY_SEGMENT:
+            loaded = event.segment != self.current_segment
+            if loaded:
+                self.load(engine, event.segment, now)
+            if loaded or not event.fade:
+                # The first action starts from silence and a new segment starts at full level: no transition
+                for layer in engine.layers:
+                    enabled = layer.name in event.layers and self.allows(layer)
+                    engine.apply_layer_fade(layer.name, enabled, None, 0, CURVE_CUT)
+            else:
+                for layer in engine.layers:
+                    enabled = layer.name in event.layers and self.allows(layer)
+                    engine.apply_transition(layer.name, enabled, None, at_frame)
+        elif event.method == "jumpToSegment":
+            self.load(engine, event.segment, now)
+            layers = engine.layers[:1] if engine.exclusive else engine.layers  # One variant of an exclusive segment
+            for layer in engine.layers:
+                engine.apply_layer_fade(layer.name, layer in layers and self.allows(layer), None, 0, CURVE_CUT)
+        else:
+            engine.fade_out(engine.beats_to_frames(event.duration))
+
+    def load(self, engine, segment, now):
+        # Switch the engine to another segment from its start; the timeline carries on from now
+        engine.load_segment(self.segments[segment], exclusive=segment in self.exclusive)
+        self.current_segment = segment
+        self.origin = now
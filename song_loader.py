@@ -0,0 +1,107 @@
+import json
+import logging
+
+from beat_grid import BeatGrid, load_beat_grid
+from disk_cache import load_cached, save_cached
+from engine import LayerMetadata
+from mixer import Layer, LayerLoop
+from scheduler import compile_timeline
+from song_model import SongFormatError, parse_song
+from stem_cache import stem_cache
+from stem_format import read_audio_header
+from stream_reader import StreamingStem
+
+# Constants
+PLAN_SUFFIX = ".plan.pickle"  # Sidecar holding a song's compiled SongSpec
+PLAN_VERSION = 6  # Bump whenever SongSpec or the compiler changes, so older cached plans are recompiled
+
+
+def load_song_json(filepath):
+    # Read a song description from MusicJSONs/
+    logging.debug(f"Loading song JSON from {filepath}")
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def compile_song(filepath, grid=None):
+    # Parse, normalize and validate a song JSON, then work out everything that depends on its audio files:
+    # stem headers, layer metadata, loops in frames and the timeline events.
+    # grid is the song's refined BeatGrid, if it has been analysed; otherwise beats follow the declared bpm.
+    # The song plays at the rate of its first stem; stems at other rates are resampled to it when loaded.
+    spec = parse_song(load_song_json(filepath), filepath)
+    for segment in spec.segments:
+        for layer in segment.layers:
+            try:
+                layer.info = read_audio_header(layer.file_name)
+            except (OSError, ValueError) as e:
+                raise SongFormatError(f"{filepath}: layer {layer.name} of segment {segment.name}: {e}") from e
+            if spec.sample_rate is None:
+                spec.sample_rate = layer.info.sample_rate
+                spec.beat_grid = grid or BeatGrid.from_bpm(spec.bpm, spec.sample_rate)
+                spec.grid_refined = grid is not None
+            layer.metadata = LayerMetadata.from_wav_info(layer.info, spec.beat_grid, spec.sample_rate)
+            if layer.forever:
+                try:
+                    layer.loop = LayerLoop.from_beats(layer.loop_start_beat, layer.loop_end_beat, layer.loop_curve,
+                                                      layer.loop_fade_beats, layer.metadata.frames, spec.beat_grid.period)
+                except ValueError as e:
+                    raise SongFormatError(f"{filepath}: layer {layer.name} of segment {segment.name}: {e}") from e
+
+    lead_in = max(layer.transition.lead_in for segment in spec.segments for layer in segment.layers)
+    spec.timeline = compile_timeline(spec.instructions, spec.beat_grid, spec.beat_grid.frames(lead_in))
+    return spec
+
+
+def load_song(filepath, use_cache=True):
+    # Compiled SongSpec of a song JSON. The plan is cached in a sidecar that stays valid until the JSON or
+    # any of its audio files changes, so a library opens without parsing and validating every song again.
+    # A plan is also rebuilt when beat_analysis.py stores (or drops) a refined beat grid for the song.
+    grid = load_beat_grid(filepath)
+    if use_cache:
+        spec = load_cached(filepath, PLAN_SUFFIX, PLAN_VERSION)
+        if spec is not None and spec.grid_refined == (grid is not None) and (grid is None or spec.beat_grid == grid):
+            logging.debug(f"Using the cached plan of {filepath}")
+            return spec
+    spec = compile_song(filepath, grid)
+    if use_cache:
+        save_cached(filepath, PLAN_SUFFIX, PLAN_VERSION, [filepath] + song_files(spec), spec)
+    return spec
+
+
+def song_files(spec):
+    # Paths of every stem a compiled song uses, without duplicates
+    return list(dict.fromkeys(layer.file_name for segment in spec.segments for layer in segment.layers))
+
+
+def prefetch_songs(filepaths, channels=None):
+    # Read the stems of songs that may play next into the stem cache on its background pool, in the format
+    # load_segments(spec, channels) asks for. Runs on the caller's thread only long enough to load the (usually
+    # cached) song plans.
+    for filepath in filepaths:
+        try:
+            spec = load_song(filepath)
+            stem_cache.prefetch(song_files(spec), spec.sample_rate, channels)
+        except Exception as e:
+            logging.warning(f"Not prefetching {filepath}: {e}")
+
+
+def load_segments(spec, channels=None, mapped=False, progress=None):
+    # Every layer of every segment of a compiled song, disabled, with the stems from the process-wide
+    # stem cache at the song's sample rate, fitted to channels output channels (None keeps each stem's own).
+    # Streamed stems keep the chunks at their loop points decoded. mapped hands out stems that are not cached
+    # yet as their mapped files (see StemCache.get()); progress, if given, is called with (stems loaded, total)
+    # after each one.
+    # Returns {segment name: [Layer, ...]}
+    segments = {}
+    total = sum(len(segment.layers) for segment in spec.segments)
+    for segment in spec.segments:
+        segments[segment.name] = []
+        for layer in segment.layers:
+            data = stem_cache.get(layer.file_name, layer.info, spec.sample_rate, channels, mapped)
+            if isinstance(data, StreamingStem) and layer.loop is not None:
+                data.pin_loop(layer.loop)
+            segments[segment.name].append(Layer(layer.name, data, enabled=False, metadata=layer.metadata,
+                                                button=layer.button, transition=layer.transition, loop=layer.loop))
+            if progress is not None:
+                progress(sum(len(layers) for layers in segments.values()), total)
+    return segments
@@ -0,0 +1,270 @@
+import logging
+
+from scheduler import TIMELINE_ACTIONS, PLAY_SEGMENT, ENABLE_LAYER, END_SONG
+from transitions import LayerTransition, CURVE_CUT, parse_curve
+
+
+class SongFormatError(ValueError):
+    # Raised when a song JSON is malformed or refers to layers, buttons or segments that do not exist
+    pass
+
+
+def get_field(info, name, default=None):
+    # Read a key regardless of its capitalization ("albumArt" and "albumart" are both used)
+    if name in info:
+        return info[name]
+    lowered = name.lower()
+    for key, value in info.items():
+        if key.lower() == lowered:
+            return value
+    return default
+
+
+def parse_flag(value):
+    # JSON booleans, also accepting "true"/"false" strings
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+
+def parse_name(value):
+    # Optional reference to another object; null, "" and "None" all mean no reference
+    if value is None or str(value).strip().lower() in ("", "none", "null"):
+        return None
+    return str(value)
+
+
+class ButtonSpec:
+    __slots__ = ("name", "text", "default_position", "invert_position")
+
+    def __init__(self, name, text, default_position=False, invert_position=False):
+        # A layer control button shown in the player
+        self.name = name  # Internal name, referenced by layers
+        self.text = text  # Label shown to the user
+        self.default_position = default_position  # Displayed position when the song loads
+        self.invert_position = invert_position  # Displayed position is the opposite of the layers' state
+
+    def enables_layers(self, position):
+        # Whether the button in the given (displayed) position means its layers play. invertPosition lets a
+        # "vocals" button be shown to the user as an "Instrumental" toggle.
+        return position != self.invert_position
+
+
+class LayerSpec:
+    __slots__ = ("name", "file_name", "forever", "button", "transition", "loop_start_beat", "loop_end_beat",
+                 "loop_curve", "loop_fade_beats", "also_enables", "also_disables", "info", "metadata", "loop")
+
+    def __init__(self, name, file_name, forever, button, transition, loop_start_beat=0.0, loop_end_beat=0.0,
+                 loop_curve=CURVE_CUT, loop_fade_beats=0.0, also_enables=(), also_disables=()):
+        # A layer of a segment as described by the song JSON
+        self.name = name
+        self.file_name = file_name  # Path of the WAV file
+        self.forever = forever  # playMode "Forever": loops between loop_start_beat and loop_end_beat
+        self.button = button  # Name of the layer control button that toggles this layer, or None
+        self.transition = transition  # LayerTransition used when the layer is enabled or disabled
+        self.loop_start_beat = loop_start_beat
+        self.loop_end_beat = loop_end_beat  # 0 loops the whole file
+        self.loop_curve = loop_curve  # Crossfade curve at the loop seam
+        self.loop_fade_beats = loop_fade_beats  # Crossfade length at the loop seam
+        self.also_enables = list(also_enables)  # Layers switched on together with this one
+        self.also_disables = list(also_disables)  # Layers switched off when this one is switched on
+        self.info = None  # WavInfo of the file, filled in when the song is compiled
+        self.metadata = None  # LayerMetadata, filled in when the song is compiled
+        self.loop = None  # LayerLoop in frames, filled in when the song is compiled
+
+
+class SegmentSpec:
+    __slots__ = ("name", "mixing_type", "loop_type", "bar_count", "layers")
+
+    def __init__(self, name, mixing_type, loop_type, bar_count, layers):
+        # A segment of a song: layers that play together
+        self.name = name
+        self.mixing_type = mixing_type  # "na", "vertical" or "exclusive" (lower case)
+        self.loop_type = loop_type  # "na", "loop" or "jump" (lower case)
+        self.bar_count = bar_count  # segmentBarCount, or None if not given
+        self.layers = layers  # [LayerSpec, ...]; the first one is the base layer
+
+    @property
+    def exclusive(self):
+        # True if the layers are variants played one at a time
+        return self.mixing_type == "exclusive"
+
+    def layer(self, name):
+        # Find a layer of the segment by name
+        for layer in self.layers:
+            if layer.name == name:
+                return layer
+        return None
+
+
+class SongSpec:
+    __slots__ = ("path", "title", "artist", "album", "year", "genre", "album_art", "bpm", "song_type",
+                 "buttons", "segments", "instructions", "sample_rate", "beat_grid", "grid_refined", "timeline")
+
+    def __init__(self, path, title, artist, album, year, genre, album_art, bpm, song_type, buttons, segments, instructions):
+        # A song JSON normalized into one shape, whatever spelling and nesting the file used
+        self.path = path  # Song JSON the spec was read from
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.year = year
+        self.genre = genre
+        self.album_art = album_art  # Path of the album art image, or None
+        self.bpm = bpm
+        self.song_type = song_type  # Shown for debugging only
+        self.buttons = buttons  # [ButtonSpec, ...] (empty without layer controls)
+        self.segments = segments  # [SegmentSpec, ...] in file order
+        self.instructions = instructions  # Normalized linearPlaybackTimeline instructions
+        self.sample_rate = None  # Filled in when the song is compiled
+        self.beat_grid = None  # BeatGrid: exact frame of every beat
+        self.grid_refined = False  # beat_grid was measured by beat_analysis.py rather than taken from bpm
+        self.timeline = []  # Compiled TimelineEvents
+
+    def segment(self, name):
+        # Find a segment by name
+        for segment in self.segments:
+            if segment.name == name:
+                return segment
+        return None
+
+    def button(self, name):
+        # Find a layer control button by name
+        for button in self.buttons:
+            if button.name == name:
+                return button
+        return None
+
+    @property
+    def exclusive_segments(self):
+        # Names of the segments whose layers are variants played one at a time
+        return {segment.name for segment in self.segments if segment.exclusive}
+
+
+def parse_layer(info):
+    # Normalize a layer: flat or nested transition/loop fields, and flat or layerCombinations also* lists
+    also_enables, also_disables = list(get_field(info, "alsoEnables") or []), list(get_field(info, "alsoDisables") or [])
+    for combination in get_field(info, "layerCombinations") or []:
+        also_enables += get_field(combination, "alsoEnables") or []
+        also_disables += get_field(combination, "alsoDisables") or []
+    transition_info = get_field(info, "transition") or info
+    transition = LayerTransition(parse_curve(get_field(transition_info, "transitionInType")),
+                                 parse_curve(get_field(transition_info, "transitionOutType")),
+                                 float(get_field(transition_info, "transitionDuration") or 0.0),
+                                 float(get_field(transition_info, "leadInDuration") or 0.0))
+    layer = LayerSpec(str(get_field(info, "layerName")), get_field(info, "fileName"),
+                      str(get_field(info, "playMode", "once")).lower() == "forever",
+                      parse_name(get_field(info, "button")), transition,
+                      also_enables=also_enables, also_disables=also_disables)
+    if layer.forever:  # Loop fields are ignored for layers that play once
+        loop_info = get_field(info, "loop") or info
+        layer.loop_start_beat = float(get_field(loop_info, "loopStartBeat") or 0.0)
+        layer.loop_end_beat = float(get_field(loop_info, "loopEndBeat") or 0.0)
+        layer.loop_curve = parse_curve(get_field(loop_info, "loopTransitionType"))
+        layer.loop_fade_beats = float(get_field(loop_info, "loopTransitionDuration") or 0.0)
+    return layer
+
+
+def parse_instruction(info):
+    # Normalize a timeline instruction into the keys the scheduler reads
+    action = str(get_field(info, "action", "")).upper()
+    instruction = {"action": action, "beatsUntilNextInstruction": float(get_field(info, "beatsUntilNextInstruction") or 0.0)}
+    if action == PLAY_SEGMENT:
+        instruction["segment"] = get_field(info, "segment")
+        instruction["layers"] = list(get_field(info, "layers") or [])
+    elif action == ENABLE_LAYER:
+        instruction["segment"] = parse_name(get_field(info, "segment"))  # Optional; should name the playing segment
+        instruction["layer"] = get_field(info, "layer")
+    elif action == END_SONG:
+        instruction["method"] = get_field(info, "method")
+        instruction["endSegment"] = parse_name(get_field(info, "endSegment"))
+        instruction["duration"] = float(get_field(info, "duration") or 0.0)
+    return instruction
+
+
+def parse_song(song, path=None):
+    # Normalize a song JSON (already parsed into dicts) into a SongSpec and validate it
+    try:
+        controls = get_field(song, "layerControls") or {}
+        buttons = []
+        if parse_flag(get_field(controls, "hasLayerControls", False)):
+            for info in get_field(controls, "buttons") or []:
+                name = str(get_field(info, "buttonName"))
+                buttons.append(ButtonSpec(name, str(get_field(info, "buttonText", name)),
+                                          parse_flag(get_field(info, "defaultPosition", False)),
+                                          parse_flag(get_field(info, "invertPosition", False))))
+        segments = []
+        for info in get_field(song, "segments") or []:
+            layers = [parse_layer(layer) for layer in get_field(info, "layers") or [] if layer]
+            bar_count = get_field(info, "segmentBarCount")
+            segments.append(SegmentSpec(str(get_field(info, "segmentName")), str(get_field(info, "mixingType", "na")).lower(),
+                                        str(get_field(info, "loopType", "na")).lower(),
+                                        None if bar_count is None else int(bar_count), layers))
+        spec = SongSpec(path, get_field(song, "title", ""), get_field(song, "artist", ""), get_field(song, "album", ""),
+                        get_field(song, "year", ""), get_field(song, "genre", ""), get_field(song, "albumArt"),
+                        get_field(song, "bpm"), get_field(song, "songType", ""), buttons, segments,
+                        [parse_instruction(info) for info in get_field(song, "linearPlaybackTimeline") or []])
+    except (TypeError, ValueError) as e:
+        raise SongFormatError(f"{path}: {e}") from e
+    validate_song(spec)
+    return spec
+
+
+def validate_song(spec):
+    # Check every cross-reference of a song, so nothing fails halfway through playback
+    def fail(message):
+        raise SongFormatError(f"{spec.path}: {message}")
+
+    if isinstance(spec.bpm, bool) or not isinstance(spec.bpm, (int, float)) or spec.bpm <= 0:
+        fail(f"bpm must be positive, not {spec.bpm}")
+    if not spec.segments:
+        fail("the song has no segments")
+    if len({button.name for button in spec.buttons}) != len(spec.buttons):
+        fail("layer control button names are not unique")
+    if len({segment.name for segment in spec.segments}) != len(spec.segments):
+        fail("segment names are not unique")
+
+    for segment in spec.segments:
+        names = [layer.name for layer in segment.layers]
+        if not names:
+            fail(f"segment {segment.name} has no layers")
+        if len(set(names)) != len(names):
+            fail(f"layer names of segment {segment.name} are not unique")
+        for layer in segment.layers:
+            if not layer.file_name:
+                fail(f"layer {layer.name} of segment {segment.name} has no fileName")
+            if layer.button is not None and spec.button(layer.button) is None:
+                fail(f"layer {layer.name} refers to unknown button {layer.button}")
+            for name in layer.also_enables + layer.also_disables:
+                if name not in names:
+                    fail(f"layer {layer.name} refers to unknown layer {name} of segment {segment.name}")
+            if layer.forever and layer.loop_end_beat and layer.loop_end_beat <= layer.loop_start_beat:
+                fail(f"layer {layer.name} has an empty loop ({layer.loop_start_beat} to {layer.loop_end_beat} beats)")
+
+    current = None
+    for index, instruction in enumerate(spec.instructions):
+        action = instruction["action"]
+        if action not in TIMELINE_ACTIONS:
+            fail(f"timeline instruction {index} has unknown action {action}")
+        if action == PLAY_SEGMENT:
+            current = spec.segment(instruction["segment"])
+            if current is None:
+                fail(f"timeline instruction {index} plays unknown segment {instruction['segment']}")
+            for name in instruction["layers"]:
+                if current.layer(name) is None:
+                    fail(f"timeline instruction {index} enables unknown layer {name} of segment {current.name}")
+        elif action == ENABLE_LAYER:
+            if current is None:
+                fail(f"timeline instruction {index} enables a layer before any segment plays")
+            # Shipped songs have these mixed up; the scheduler skips a layer the playing segment lacks, so they
+            # only cost the one fade, not the whole song
+            if instruction["segment"] not in (None, current.name):
+                logging.warning(f"{spec.path}: timeline instruction {index} names segment {instruction['segment']} "
+                                f"but {current.name} is playing")
+            if current.layer(instruction["layer"]) is None:
+                logging.warning(f"{spec.path}: timeline instruction {index} enables unknown layer "
+                                f"{instruction['layer']} of segment {current.name}; it is skipped")
+        elif instruction["method"] == "jumpToSegment":
+            if spec.segment(instruction["endSegment"]) is None:
+                fail(f"timeline instruction {index} jumps to unknown segment {instruction['endSegment']}")
+        elif instruction["method"] != "fadeoutAfter":
+            fail(f"timeline instruction {index} has unknown END_SONG method {instruction['method']}")
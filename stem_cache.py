@@ -0,0 +1,137 @@
+import collections
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from stem_format import conversion_target, load_stem, read_audio_header
+from stream_reader import StreamInfo
+
+# Constants
+DEFAULT_BUDGET_BYTES = 1024 * 1024 * 1024  # Decoded stems kept in memory across songs
+PREFETCH_WORKERS = 2  # Background threads reading stems ahead of time
+
+
+class StemCache:
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_BYTES, workers=PREFETCH_WORKERS):
+        # Process-wide cache of stems read into memory, keyed by path, mtime and the format they were converted to
+        # (if any), so an edited file is read again.
+        # The least recently used stems are dropped once the cached total would exceed budget_bytes. A thread
+        # pool reads the stems of songs that are likely to play next, so switching songs costs no disk reads.
+        self.budget_bytes = budget_bytes
+        self.entries = collections.OrderedDict()  # key -> (frames, channels) array, least recently used first
+        self.used_bytes = 0
+        self.loading = {}  # key -> Future of a read in progress, so a stem is never read twice at once
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stem-prefetch")
+        self.hits = 0  # Stems served from memory
+        self.misses = 0  # Stems that had to be read from disk (including prefetches)
+        self.evictions = 0  # Stems dropped to stay within the budget
+
+    @staticmethod
+    def key(path, target=None):
+        # Cache key of a file: its absolute path plus mtime and size, and the (sample rate, channels) it was
+        # converted to (None if it plays as it is)
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size, target
+
+    def get(self, path, info=None, sample_rate=None, channels=None, mapped=False):
+        # (frames, channels) samples of a stem at sample_rate fitted to channels output channels (see
+        # load_stem()), read from disk only if they are not cached yet. info is the file's WavInfo if it is
+        # already known (e.g. from a compiled song plan). Streamed (compressed) stems are never cached: each
+        # layer gets a StreamingStem of its own, holding only the window around its own read head.
+        # With mapped set, a stem that is not cached yet is handed out as its mapped file at once (paged in as it
+        # plays) and copied into the cache on the background pool, so the caller never waits for the whole file.
+        if info is None:
+            info = read_audio_header(path)
+        target = conversion_target(info, sample_rate, channels)
+        if target is None and isinstance(info, StreamInfo):
+            return load_stem(path, info, sample_rate, channels)
+        key = self.key(path, target)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+            future = self.loading.get(key)
+            owner = future is None and not mapped
+            if owner:
+                future = self.loading[key] = Future()
+                self.misses += 1
+        if mapped:
+            data = load_stem(path, info, sample_rate, channels)
+            if future is None:
+                self.executor.submit(self.prefetch_one, path, sample_rate, channels)  # In memory for the next load
+            return data
+        if not owner:
+            return future.result()  # Another thread (e.g. a prefetch) is already reading it
+
+        try:
+            data = np.array(load_stem(path, info, sample_rate, channels))  # Copy the mapped file into memory
+        except Exception as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self.insert(key, data)
+        future.set_result(data)
+        return data
+
+    def insert(self, key, data):
+        # Add a stem and evict the least recently used ones beyond the budget (call with the lock held)
+        if data.nbytes > self.budget_bytes:
+            return  # Would evict everything else; hand it out uncached
+        self.entries[key] = data
+        self.used_bytes += data.nbytes
+        self.evict()
+
+    def evict(self):
+        # Drop least recently used stems until the cache fits its budget (call with the lock held). Layers that
+        # still play an evicted stem keep their reference to it.
+        while self.used_bytes > self.budget_bytes and self.entries:
+            _, data = self.entries.popitem(last=False)
+            self.used_bytes -= data.nbytes
+            self.evictions += 1
+
+    def set_budget(self, budget_bytes):
+        # Change the memory budget, evicting stems if it shrank
+        with self.lock:
+            self.budget_bytes = budget_bytes
+            self.evict()
+
+    def prefetch(self, paths, sample_rate=None, channels=None):
+        # Read stems into the cache on the background pool, in the format get() would be asked for; returns
+        # their futures
+        futures = []
+        for path in paths:
+            futures.append(self.executor.submit(self.prefetch_one, path, sample_rate, channels))
+        return futures
+
+    def prefetch_one(self, path, sample_rate=None, channels=None):
+        # Pool task: read one stem, logging instead of raising since nobody waits on prefetches
+        try:
+            info = read_audio_header(path)
+            target = conversion_target(info, sample_rate, channels)
+            if target is None and isinstance(info, StreamInfo):
+                return  # Streamed as it plays
+            key = self.key(path, target)
+            with self.lock:
+                if key in self.entries or key in self.loading:
+                    return  # Nothing to do, and not a hit: no song asked for it
+            self.get(path, info, sample_rate, channels)
+        except Exception as e:
+            logging.warning(f"Could not prefetch {path}: {e}")
+
+    def stats(self):
+        # Counters for sizing the budget against a library
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "stems": len(self.entries),
+                    "used_bytes": self.used_bytes, "budget_bytes": self.budget_bytes}
+
+
+stem_cache = StemCache()  # Shared by every song loaded in this process
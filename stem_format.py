@@ -0,0 +1,103 @@
+import logging
+import os
+
+import numpy as np
+
+from disk_cache import load_cached, save_cached, sidecar_path
+from resampler import resample
+from stream_reader import StreamInfo, StreamingStem, decode_stream, is_streamed, read_stream_header
+from wav_reader import decode_wav, open_wav, read_wav_header, stored_dtype
+
+# Constants
+CONVERTED_SUFFIX = ".npy"  # Sidecar holding a converted stem (after ".<rate>hz<channels>ch"), mapped when played
+STAMP_SUFFIX = ".stamp.pickle"  # Sidecar recording which file (and version) a converted stem was made from
+CONVERTED_VERSION = 1  # Bump whenever the conversion changes, so older converted stems are made again
+PLAYABLE_DTYPES = ("<i2", "<i4", "<f4")  # Stored sample types the mixer plays straight from the mapped file
+
+
+def read_audio_header(filepath):
+    # WavInfo of a WAV stem, or StreamInfo of a compressed (FLAC/Ogg) one
+    return read_stream_header(filepath) if is_streamed(filepath) else read_wav_header(filepath)
+
+
+def channel_layout(info, channels=None):
+    # Channels a stem plays with through channels output channels (None keeps its own). Mono stems never need
+    # remixing, since the mixer spreads them over every channel.
+    return info.channels if channels is None or info.channels in (1, channels) else channels
+
+
+def conversion_target(info, sample_rate=None, channels=None):
+    # (sample rate, channels) a stem has to be converted to before it can play at sample_rate through channels
+    # output channels, or None if the mixer can play it as it is. None keeps the file's own rate or channels.
+    # Compressed stems at the right rate are streamed, and remixed chunk by chunk as they are decoded.
+    rate = sample_rate or info.sample_rate
+    layout = channel_layout(info, channels)
+    if isinstance(info, StreamInfo):
+        return None if rate == info.sample_rate else (rate, layout)
+    if rate == info.sample_rate and layout == info.channels and stored_dtype(info) in PLAYABLE_DTYPES:
+        return None
+    return rate, layout
+
+
+def remix(data, channels):
+    # Fit float (frames, channels) samples to another channel count: fewer channels average the source channels
+    # that fold onto them (stereo pairs stay left and right), more channels repeat the source ones in turn
+    count = data.shape[1]
+    if count == channels:
+        return data
+    if count < channels:
+        return data[:, np.arange(channels) % count]
+    mixed = np.zeros((len(data), channels), dtype=np.float32)
+    for channel in range(count):
+        target = mixed[:, channel % channels]
+        np.add(target, data[:, channel], out=target)
+    folds = np.bincount(np.arange(count) % channels, minlength=channels).astype(np.float32)
+    return np.divide(mixed, folds, out=mixed)
+
+
+def convert_stem(filepath, info, sample_rate, channels):
+    # Decode a stem to float32 and convert it to the given sample rate and channel count. Channels are dropped
+    # before resampling and added after it, so the resampler never works on more channels than it must.
+    data = decode_stream(filepath) if isinstance(info, StreamInfo) else decode_wav(filepath, info)
+    if channels < data.shape[1]:
+        data = remix(data, channels)
+    data = resample(data, info.sample_rate, sample_rate)
+    return remix(data, channels)
+
+
+def load_stem(filepath, info=None, sample_rate=None, channels=None):
+    # (frames, channels) samples of a stem the mixer can play at sample_rate through channels output channels
+    # (None keeps the file's own). WAV files that already fit are mapped as they are and compressed ones at the
+    # right rate are streamed (a StreamingStem); any other format, rate or layout is converted once and kept as
+    # a sidecar next to the file, mapped the same way on every later load.
+    if info is None:
+        info = read_audio_header(filepath)
+    target = conversion_target(info, sample_rate, channels)
+    if target is None and isinstance(info, StreamInfo):
+        layout = channel_layout(info, channels)
+        return StreamingStem(filepath, info, layout, None if layout == info.channels else lambda block: remix(block, layout))
+    if target is None:
+        return open_wav(filepath, info)[0]
+
+    suffix = f".{target[0]}hz{target[1]}ch{CONVERTED_SUFFIX}"
+    path = sidecar_path(filepath, suffix)
+    if load_cached(filepath, suffix + STAMP_SUFFIX, CONVERTED_VERSION) is not None:
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logging.warning(f"Converting {filepath} again, its converted copy is unreadable: {e}")
+
+    logging.info(f"Converting {filepath} ({info.sample_rate} Hz, {info.channels} channels, "
+                 f"{info.sample_width * 8}-bit) to {target[0]} Hz, {target[1]} channels")
+    data = convert_stem(filepath, info, *target)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            np.save(f, data)
+        os.replace(temporary, path)  # Readers never see a half-written file
+    except OSError as e:
+        logging.warning(f"Could not write converted stem {path}: {e}")
+        return data
+    save_cached(filepath, suffix + STAMP_SUFFIX, CONVERTED_VERSION, [filepath], data.shape)
+    return data
@@ -0,0 +1,259 @@
+import collections
+import logging
+import threading
+import weakref
+
+import numpy as np
+
+from event_trace import tracer, TRACING
+
+# Constants
+STREAMED_EXTENSIONS = (".flac", ".ogg", ".oga", ".opus")  # Stems decoded in chunks as they play instead of mapped
+CHUNK_FRAMES = 16384  # Frames decoded at a time; the decoded window of a stem is kept in chunks of this size
+AHEAD_CHUNKS = 8  # Chunks kept decoded ahead of the read head (about 3 s at 44.1 kHz)
+BEHIND_CHUNKS = 2  # Chunks kept behind it, for blocks that straddle two chunks and short jumps back
+LOOP_CHUNKS = 2  # Chunks kept decoded for good at each loop point, so a wrap never waits for the decoder
+SUBTYPE_WIDTHS = {"PCM_S8": 1, "PCM_U8": 1, "PCM_16": 2, "PCM_24": 3, "PCM_32": 4}  # Bytes per sample (lossy: float)
+TRACE_STREAM_MISS = tracer.event("stream_miss")  # arg: chunk decoded by the reader because it was not ready
+
+
+class StreamFormatError(ValueError):
+    # Raised when a compressed stem cannot be read
+    pass
+
+
+class StreamInfo:
+    __slots__ = ("channels", "sample_rate", "sample_width", "frames", "format")
+
+    def __init__(self, channels, sample_rate, sample_width, frames, format):
+        # Header information of a compressed stem (the fields LayerMetadata reads from a WavInfo)
+        self.channels = channels  # Number of channels
+        self.sample_rate = sample_rate  # Frames per second
+        self.sample_width = sample_width  # Bytes per sample before compression (4 for lossy formats)
+        self.frames = frames  # Number of frames
+        self.format = format  # Container, e.g. "FLAC" or "OGG"
+
+
+def is_streamed(filepath):
+    # True for stems in a compressed format, which are streamed rather than mapped
+    return filepath.lower().endswith(STREAMED_EXTENSIONS)
+
+
+def require_soundfile(filepath):
+    # The soundfile package, which decodes compressed stems through libsndfile. Imported on first use, since
+    # loading libsndfile slows down the startup of players whose songs only use WAVs.
+    try:
+        import soundfile
+    except ImportError:
+        raise StreamFormatError(f"{filepath} is compressed; install the soundfile package to play FLAC and Ogg stems") from None
+    return soundfile
+
+
+def read_stream_header(filepath):
+    # StreamInfo of a compressed stem, without decoding any audio
+    soundfile = require_soundfile(filepath)
+    try:
+        info = soundfile.info(filepath)
+    except RuntimeError as e:
+        raise StreamFormatError(f"{filepath} cannot be decoded: {e}") from e
+    return StreamInfo(info.channels, info.samplerate, SUBTYPE_WIDTHS.get(info.subtype, 4), info.frames, info.format)
+
+
+def decode_stream(filepath):
+    # Every frame of a compressed stem as a float32 (frames, channels) array (only for one-off conversions)
+    soundfile = require_soundfile(filepath)
+    data, _ = soundfile.read(filepath, dtype='float32', always_2d=True)
+    return data
+
+
+class StreamingStem:
+    def __init__(self, filepath, info, channels=None, fit=None):
+        # A compressed stem that reads like a read-only (frames, channels) float32 array, for the slices the mixer
+        # takes. Only a window of chunks around the read head is kept decoded (plus a few at loop points), so the
+        # memory a layer holds does not depend on its length. The shared stream_decoder thread decodes ahead of
+        # the head; a read it has not caught up with (e.g. right after a seek) decodes on the reading thread.
+        # fit, if given, is applied to every decoded chunk (e.g. to remix it to channels channels).
+        soundfile = require_soundfile(filepath)
+        self.filepath = filepath
+        self.frames = info.frames
+        self.shape = (info.frames, channels or info.channels)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+        self.fit = fit
+        self.chunk_count = -(-info.frames // CHUNK_FRAMES)
+        self.file = soundfile.SoundFile(filepath)
+        self.file_position = 0  # Frame the decoder reads next, so sequential chunks need no seek
+        self.chunks = collections.OrderedDict()  # Chunk index -> decoded (frames, channels), least recently used first
+        self.pinned = {}  # Chunk index -> decoded chunk kept for good (loop points)
+        self.head = 0  # Chunk the reader is in; the decoder keeps AHEAD_CHUNKS from here decoded
+        self.lock = threading.Lock()  # Guards chunks and pinned (held only for dictionary updates)
+        self.decode_lock = threading.Lock()  # Serializes use of the file
+        self.misses = 0  # Chunks the reader had to decode itself
+        if self.chunk_count:
+            with self.decode_lock:
+                self.store(0, self.decode(0))  # The first block is ready before anything plays
+        stream_decoder.add(self)
+
+    def __len__(self):
+        return self.frames
+
+    @property
+    def nbytes(self):
+        # Memory held by the decoded chunks
+        with self.lock:
+            return sum(block.nbytes for block in self.chunks.values()) + sum(block.nbytes for block in self.pinned.values())
+
+    def __getitem__(self, key):
+        # Frames of a slice (optionally with a channel index, like data[start:end, 0]) as a float32 array
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None),) + key[1:]]
+        if not isinstance(key, slice):
+            raise TypeError("StreamingStem can only be sliced")
+        start, stop, step = key.indices(self.frames)
+        data = self.read(start, max(start, stop))
+        return data if step == 1 else data[::step]
+
+    def read(self, start, stop):
+        # Frames start to stop; a block inside one chunk is a view of it, a block straddling chunks a copy
+        if stop <= start:
+            return np.zeros((0, self.shape[1]), dtype=np.float32)
+        first, last = start // CHUNK_FRAMES, (stop - 1) // CHUNK_FRAMES
+        self.move_head(first)
+        if first == last:
+            offset = first * CHUNK_FRAMES
+            return self.chunk(first)[start - offset:stop - offset]
+        output = np.empty((stop - start, self.shape[1]), dtype=np.float32)
+        for index in range(first, last + 1):
+            offset = index * CHUNK_FRAMES
+            low, high = max(start, offset), min(stop, offset + CHUNK_FRAMES)
+            output[low - start:high - start] = self.chunk(index)[low - offset:high - offset]
+        return output
+
+    def move_head(self, index):
+        # Point the read-ahead at a chunk, waking the decoder if it moved
+        if index != self.head:
+            self.head = index
+            stream_decoder.wake.set()
+
+    def prefetch(self, frame):
+        # Start decoding ahead from a frame the reader is about to jump to (e.g. a variant about to be switched to)
+        self.move_head(min(frame, max(0, self.frames - 1)) // CHUNK_FRAMES)
+
+    def pin_loop(self, loop):
+        # Keep the chunks at a LayerLoop's start (where every wrap jumps) and past its end (the crossfaded tail)
+        # decoded for good; a preroll loop crossfades with the frames before its start instead
+        self.pin(loop.start, LOOP_CHUNKS * CHUNK_FRAMES)
+        if loop.fade_frames and loop.preroll:
+            self.pin(loop.start - loop.fade_frames, loop.fade_frames)
+        elif loop.fade_frames:
+            self.pin(loop.end, loop.fade_frames)
+
+    def pin(self, frame, frames):
+        # Decode up to LOOP_CHUNKS chunks covering frames from frame and never evict them
+        first = frame // CHUNK_FRAMES
+        last = min(self.chunk_count, (frame + frames - 1) // CHUNK_FRAMES + 1, first + LOOP_CHUNKS)
+        for index in range(first, last):
+            with self.lock:
+                if index in self.pinned:
+                    continue
+                block = self.chunks.pop(index, None)
+            if block is None:
+                with self.decode_lock:
+                    block = self.decode(index)
+            with self.lock:
+                self.pinned[index] = block
+
+    def chunk(self, index):
+        # Decoded chunk index, decoding it on this thread if the decoder thread has not got to it yet
+        with self.lock:
+            block = self.pinned.get(index)
+            if block is None:
+                block = self.chunks.get(index)
+                if block is not None:
+                    self.chunks.move_to_end(index)
+        if block is not None:
+            return block
+        with self.decode_lock:
+            with self.lock:
+                block = self.chunks.get(index)  # The decoder may have finished it while this thread waited
+            if block is None:
+                self.misses += 1
+                if TRACING:
+                    tracer.instant(TRACE_STREAM_MISS, index)
+                block = self.decode(index)
+                self.store(index, block)
+        return block
+
+    def fill_ahead(self):
+        # (Decoder thread) Decode the first missing chunk of the read-ahead window; returns False if there is none
+        head = self.head
+        for index in range(head, min(head + AHEAD_CHUNKS, self.chunk_count)):
+            with self.lock:
+                if index in self.chunks or index in self.pinned:
+                    continue
+            with self.decode_lock:
+                with self.lock:
+                    if index in self.chunks:
+                        continue
+                self.store(index, self.decode(index))
+            return True
+        return False
+
+    def decode(self, index):
+        # Decode one chunk from the file (call with decode_lock held). libsndfile seeks with the FLAC seek table
+        # (or by bisecting Ogg pages), and sequential chunks are read without seeking at all.
+        start = index * CHUNK_FRAMES
+        frames = min(CHUNK_FRAMES, self.frames - start)
+        if self.file_position != start:
+            self.file.seek(start)
+        block = self.file.read(frames, dtype='float32', always_2d=True)
+        self.file_position = start + len(block)
+        if len(block) < frames:
+            block = np.concatenate([block, np.zeros((frames - len(block), block.shape[1]), dtype=np.float32)])  # Truncated file
+        return block if self.fit is None else self.fit(block)
+
+    def store(self, index, block):
+        # Add a decoded chunk, dropping the least recently read ones beyond the window
+        with self.lock:
+            self.chunks[index] = block
+            while len(self.chunks) > AHEAD_CHUNKS + BEHIND_CHUNKS:
+                self.chunks.popitem(last=False)
+
+
+class StreamDecoder:
+    def __init__(self):
+        # One background thread keeping every open StreamingStem decoded ahead of its read head, a chunk per stem
+        # in turn so no stem starves the others. Stems are held weakly and drop out once their layers are gone.
+        self.streams = weakref.WeakSet()
+        self.lock = threading.Lock()  # Guards streams
+        self.wake = threading.Event()  # Set whenever a read head moves or a stem opens
+        self.thread = None
+
+    def add(self, stream):
+        # Start keeping a stem decoded ahead (starting the thread on first use)
+        with self.lock:
+            self.streams.add(stream)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="stream-decoder", daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def run(self):
+        # Fill every stem's window round-robin until all are full, then sleep until a head moves
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            busy = True
+            while busy:
+                busy = False
+                with self.lock:
+                    streams = list(self.streams)
+                for stream in streams:
+                    try:
+                        busy = stream.fill_ahead() or busy
+                    except Exception as e:
+                        logging.error(f"Error decoding {stream.filepath}: {e}")
+                del streams  # Hold no stem longer than a round
+
+
+stream_decoder = StreamDecoder()  # Shared by every streamed stem in this process
@@ -0,0 +1,38 @@
+import json
+import wave
+
+import numpy as np
+import pytest
+
+# Constants
+SAMPLE_RATE = 8000  # Low rate keeps the synthetic stems small
+BPM = 120  # Tempo of the synthetic songs (4000 frames per beat at SAMPLE_RATE)
+
+
+def write_wav(path, data, sample_rate=SAMPLE_RATE):
+    # Write float (frames, channels) samples as a 16-bit WAV
+    data = np.asarray(data, dtype=np.float64).reshape(len(data), -1)
+    with wave.open(str(path), 'wb') as wf:
+        wf.setnchannels(data.shape[1])
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes((np.clip(data, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+    return str(path)
+
+
+@pytest.fixture
+def constant_stem(tmp_path):
+    # Factory for stereo stems holding one constant level, so gains can be read straight off the mix
+    def make(name, level, frames):
+        return write_wav(tmp_path / f"{name}.wav", np.full((frames, 2), level))
+    return make
+
+
+@pytest.fixture
+def song_file(tmp_path):
+    # Factory writing a song JSON and returning its path
+    def make(song, name="song"):
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps(song))
+        return str(path)
+    return make
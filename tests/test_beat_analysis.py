@@ -0,0 +1,30 @@
+import numpy as np
+
+from beat_analysis import analyze_song
+from tests.conftest import write_wav
+
+ANALYSIS_RATE = 44100  # Rate the onset detector's window and hop sizes are tuned for
+FIRST_BEAT = 12345.0  # Frame of the first click
+TOLERANCE_MS = 2.0  # The onset detector on its own is about 10 ms early
+
+
+def click_track(bpm, seconds):
+    # Mono clicks (short decaying noise bursts) on every beat from FIRST_BEAT, over a faint noise floor
+    rng = np.random.default_rng(0)
+    period = 60.0 * ANALYSIS_RATE / bpm
+    mono = rng.standard_normal(int(seconds * ANALYSIS_RATE)) * 0.001
+    click = rng.standard_normal(200) * np.exp(-np.arange(200) / 40.0) * 0.5
+    for beat in range(int((len(mono) - FIRST_BEAT - len(click)) // period) + 1):
+        start = int(round(FIRST_BEAT + beat * period))
+        mono[start:start + len(click)] += click
+    return mono
+
+
+def test_click_track_grid_lands_on_the_clicks(tmp_path, song_file):
+    stem = write_wav(tmp_path / "clicks.wav", click_track(128, 30), ANALYSIS_RATE)
+    path = song_file({"bpm": 128, "segments": [{"segmentName": "CLICKS", "layers": [
+        {"layerName": "Clicks", "fileName": stem, "playMode": "once"}]}]})
+    grid = analyze_song(path)["grid"]
+    assert grid is not None
+    assert abs(grid.offset - FIRST_BEAT) / ANALYSIS_RATE * 1000 < TOLERANCE_MS
+    assert abs(grid.period - 60.0 * ANALYSIS_RATE / 128) < 0.5
@@ -0,0 +1,47 @@
+import numpy as np
+
+from playlist import prepare_track
+from tests.conftest import BPM, write_wav
+
+FRAMES = 16000  # Four beats at the test tempo
+
+
+def loop_song(song_file, stem, loop_start_beat, fade_beats):
+    # A song playing one Forever layer that loops from loop_start_beat to the end of its file
+    layers = [{"layerName": "Pad", "fileName": stem, "playMode": "Forever", "loopStartBeat": loop_start_beat,
+               "loopEndBeat": 0, "loopTransitionType": "Linear", "loopTransitionDuration": fade_beats}]
+    return song_file({
+        "bpm": BPM,
+        "segments": [{"segmentName": "PAD", "layers": layers}],
+        "linearPlaybackTimeline": [{"action": "PLAY_SEGMENT", "segment": "PAD", "layers": ["Pad"],
+                                    "beatsUntilNextInstruction": 64}],
+    })
+
+
+def render(engine, frames):
+    block = np.zeros((frames, engine.channels), dtype=np.float32)
+    engine.render(block, frames)
+    return block
+
+
+def test_whole_file_loop_never_fades_from_silence(constant_stem, song_file):
+    # A whole-file loop has no audio around it to crossfade with, so its seam is a splice rather than a fade
+    # in from silence
+    engine = prepare_track(loop_song(song_file, constant_stem("pad", 0.5, FRAMES), 0, 1)).engine
+    layer = engine.get_layer("Pad")
+    assert layer.loop.fade_frames == 0
+    block = render(engine, 3 * FRAMES + 1000)
+    assert np.allclose(block, 0.5, atol=1e-3)
+
+
+def test_loop_without_tail_crossfades_before_its_end(tmp_path, song_file):
+    # With no audio past the loop end, the last beat fades into the beat leading up to the loop start, so the
+    # output runs on without a jump at each wrap
+    ramp = np.linspace(0.0, 0.5, FRAMES)[:, None].repeat(2, axis=1)
+    engine = prepare_track(loop_song(song_file, write_wav(tmp_path / "ramp.wav", ramp), 2, 1)).engine
+    loop = engine.get_layer("Pad").loop
+    assert loop.preroll and loop.fade_frames == FRAMES // 4
+    block = render(engine, 3 * FRAMES)
+    assert np.abs(np.diff(block[:, 0])).max() < 1e-3
+    wrap = loop.end + (loop.end - loop.start)  # Second wrap: the loop start plays untouched
+    assert np.allclose(block[wrap:wrap + 100, 0], ramp[loop.start:loop.start + 100, 0], atol=1e-3)
@@ -0,0 +1,56 @@
+import wave
+
+import numpy as np
+
+from offline_render import render_song
+from playlist import prepare_track
+from tests.conftest import BPM
+
+FRAMES = 16000  # Length of every stem (four beats)
+
+
+def read_render(path):
+    # Samples of a rendered 16-bit WAV as float (frames, channels)
+    with wave.open(str(path), 'rb') as wf:
+        data = np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2').reshape(-1, wf.getnchannels())
+    return data / 32767.0
+
+
+def render_live(path, frames):
+    # What live playback mixes for the first frames of a song, block by block as the audio thread does
+    engine = prepare_track(path).engine
+    output = np.zeros((frames, engine.channels), dtype=np.float32)
+    for start in range(0, frames, 1024):
+        engine.render(output[start:start + 1024], min(1024, frames - start))
+    return output
+
+
+def test_song_without_timeline_renders_every_default_layer(tmp_path, constant_stem, song_file):
+    layers = [{"layerName": "Bed", "fileName": constant_stem("bed", 0.25, FRAMES), "playMode": "once"},
+              {"layerName": "Lead", "fileName": constant_stem("lead", 0.5, FRAMES), "playMode": "once"}]
+    path = song_file({"bpm": BPM, "segments": [{"segmentName": "MAIN", "layers": layers}]})
+    render_song(path, str(tmp_path / "render.wav"))
+    offline = read_render(tmp_path / "render.wav")
+    assert offline.shape == (FRAMES, 2)
+    assert np.allclose(offline[1000:], 0.75, atol=1e-3)
+    assert np.allclose(offline, render_live(path, FRAMES), atol=1e-3)
+
+
+def test_default_button_position_mutes_the_layer_offline_too(tmp_path, constant_stem, song_file):
+    # The Instrumental toggle starts switched on, so the timeline's first event must not bring the vocals in
+    instrumental, vocals = constant_stem("instrumental", 0.25, FRAMES), constant_stem("vocals", 0.5, FRAMES)
+    layers = [{"layerName": "Instrumental", "fileName": instrumental, "playMode": "once"},
+              {"layerName": "Lyrics", "fileName": vocals, "playMode": "once", "button": "instrumentalToggle"}]
+    path = song_file({
+        "bpm": BPM,
+        "layerControls": {"hasLayerControls": True, "buttons": [{"buttonName": "instrumentalToggle",
+                          "buttonText": "Instrumental", "defaultPosition": True, "invertPosition": True}]},
+        "segments": [{"segmentName": "FULLSONG", "layers": layers}],
+        "linearPlaybackTimeline": [{"action": "PLAY_SEGMENT", "segment": "FULLSONG",
+                                    "layers": ["Instrumental", "Lyrics"], "beatsUntilNextInstruction": 4}],
+    })
+    render_song(path, str(tmp_path / "render.wav"))
+    offline = read_render(tmp_path / "render.wav")
+    assert offline.shape == (FRAMES, 2)
+    assert np.allclose(offline[1000:], 0.25, atol=1e-3)
+    assert np.allclose(offline, render_live(path, len(offline)), atol=1e-3)
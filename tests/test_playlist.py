@@ -0,0 +1,32 @@
+import numpy as np
+
+from playlist import PlaylistOutput, prepare_track
+from tests.conftest import BPM, SAMPLE_RATE
+
+BEAT = 4000  # Frames per beat at BPM
+CROSSFADE = 2000  # Skip crossfade in frames (half a beat)
+
+
+def constant_song(constant_stem, song_file, name, level):
+    # A one-layer song holding one constant level for four beats
+    stem = constant_stem(name, level, 4 * BEAT)
+    return song_file({"bpm": BPM, "segments": [{"segmentName": "MAIN", "layers": [
+        {"layerName": name, "fileName": stem, "playMode": "once"}]}]}, name)
+
+
+def test_skip_crossfades_both_tracks_from_the_beat(constant_stem, song_file):
+    output = PlaylistOutput(SAMPLE_RATE)
+    output.set_current(prepare_track(constant_song(constant_stem, song_file, "current", 0.25)))
+    incoming = prepare_track(constant_song(constant_stem, song_file, "incoming", 0.5))
+    mixed = np.zeros((3 * BEAT, 2), dtype=np.float32)
+    output.render_tracks(mixed[:1024], 1024, 0.0)
+    output.skip(incoming, "beat", CROSSFADE)
+    for start in range(1024, len(mixed), 1024):
+        output.render_tracks(mixed[start:start + 1024], min(1024, len(mixed) - start), 0.0)
+
+    # The outgoing track fades out and the incoming one fades in over the same frames, from the beat on
+    ramp = np.arange(CROSSFADE) / CROSSFADE
+    assert np.allclose(mixed[:BEAT], 0.25, atol=1e-3)
+    assert np.allclose(mixed[BEAT:BEAT + CROSSFADE, 0], 0.25 * (1 - ramp) + 0.5 * ramp, atol=1e-3)
+    assert np.allclose(mixed[BEAT + CROSSFADE:], 0.5, atol=1e-3)
+    assert output.current is incoming
@@ -0,0 +1,87 @@
+import gc
+import os
+import tracemalloc
+
+import numpy as np
+
+from playlist import prepare_track
+from tests.conftest import BPM
+
+BLOCK_SIZES = (256, 4096)  # Device block sizes rendered at
+PLAY_FRAMES = 32768  # Four seconds of the song rendered per pass
+FADE_OUT_FRAME = 12288  # Where the lead starts fading out again (a whole number of blocks at every block size)
+PEAK_BYTES = 4096  # Python objects one block may create and free (views, floats); any block-sized array is larger
+REALTIME_MODULES = ("engine.py", "mixer.py", "transitions.py", "scheduler.py", "transport.py")  # Audio thread code
+
+
+def fading_loop_song(constant_stem, song_file):
+    # A two-beat pad looping with a crossfaded seam, and a lead that fades in and out over a beat
+    layers = [{"layerName": "Pad", "fileName": constant_stem("pad", 0.25, 12000), "playMode": "Forever",
+               "loopStartBeat": 0, "loopEndBeat": 2, "loopTransitionType": "Fade", "loopTransitionDuration": 0.5},
+              {"layerName": "Lead", "fileName": constant_stem("lead", 0.5, 40000), "playMode": "once",
+               "transitionInType": "Linear", "transitionOutType": "Fade", "transitionDuration": 1}]
+    return song_file({
+        "bpm": BPM,
+        "segments": [{"segmentName": "MAIN", "layers": layers}],
+        "linearPlaybackTimeline": [{"action": "PLAY_SEGMENT", "segment": "MAIN", "layers": ["Pad"],
+                                    "beatsUntilNextInstruction": 64}],
+    })
+
+
+def snapshot():
+    # Traced allocations, after a full collection empties CPython's freelists (a tuple parked on one still counts as
+    # allocated by the line that first made it)
+    gc.collect()
+    return tracemalloc.take_snapshot()
+
+
+def realtime_allocations(before, after):
+    # Bytes still held that were allocated by the audio thread's modules between two snapshots
+    filters = [tracemalloc.Filter(True, os.path.join("*", name)) for name in REALTIME_MODULES]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    return [stat for stat in stats if stat.size_diff > 0]
+
+
+def play(engine, block, peaks=None):
+    # Render PLAY_FRAMES in blocks of len(block) frames: the lead fades in and then out (posting what
+    # transition_layer posts) while the pad wraps several times. peaks, if given, collects the most memory
+    # traced while each block rendered, beyond what was held before it.
+    frames = len(block)
+    for start in range(0, PLAY_FRAMES, frames):
+        if start in (0, FADE_OUT_FRAME):
+            engine.post(engine.apply_transition, "Lead", start == 0, None, None)
+        if peaks is None:
+            engine.render(block, frames)
+            continue
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        engine.render(block, frames)
+        peaks.append(tracemalloc.get_traced_memory()[1] - held)
+
+
+def test_render_allocates_nothing(constant_stem, song_file):
+    largest = {}
+    for block_size in BLOCK_SIZES:
+        engine = prepare_track(fading_loop_song(constant_stem, song_file)).engine
+        block = np.zeros((block_size, engine.channels), dtype=np.float32)
+        lead = engine.get_layer("Lead")
+        for enabled in (True, False):
+            engine.mixer.curves.get(*engine.transition_fade(lead, enabled))  # Registered off the audio thread
+
+        peaks = []
+        tracemalloc.start()
+        try:
+            snapshot()  # Empty the freelists, so values the warm-up leaves in place are traced like their successors
+            play(engine, block)  # Warm up: sizes the buffers and fills numpy's caches for every block shape
+            before = snapshot()
+            play(engine, block, peaks)
+            after = snapshot()
+        finally:
+            tracemalloc.stop()
+        assert engine.mixer.frame > 6 * engine.get_layer("Pad").loop.end
+        assert realtime_allocations(before, after) == []
+        largest[block_size] = max(peaks)
+
+    # Nothing allocated inside a block beyond a few small objects, however long the block is
+    assert max(largest.values()) < PEAK_BYTES, largest
+    assert largest[max(BLOCK_SIZES)] <= largest[min(BLOCK_SIZES)] + 256, largest
@@ -0,0 +1,74 @@
+import numpy as np
+
+from playlist import prepare_track
+from tests.conftest import BPM
+
+BUTTON = "instrumentalToggle"
+
+
+def vocals_song(constant_stem, song_file):
+    # A DynVocals-style song: an instrumental bed and vocals behind an "Instrumental" toggle, both started by
+    # the first timeline event
+    frames = 40000
+    instrumental = constant_stem("instrumental", 0.25, frames)
+    vocals = constant_stem("vocals", 0.5, frames)
+    layers = [{"layerName": "Instrumental", "fileName": instrumental, "playMode": "once"},
+              {"layerName": "Lyrics", "fileName": vocals, "playMode": "once", "button": BUTTON}]
+    return song_file({
+        "bpm": BPM,
+        "layerControls": {"hasLayerControls": True, "buttons": [
+            {"buttonName": BUTTON, "buttonText": "Instrumental", "defaultPosition": False, "invertPosition": True}]},
+        "segments": [{"segmentName": "FULLSONG", "layers": layers}],
+        "linearPlaybackTimeline": [{"action": "PLAY_SEGMENT", "segment": "FULLSONG",
+                                    "layers": ["Instrumental", "Lyrics"], "beatsUntilNextInstruction": 64}],
+    })
+
+
+def toggle_instrumental(engine, instrumental):
+    # What the player does when the Instrumental toggle is switched (the button's position is inverted)
+    enabled = not instrumental
+    engine.post(engine.scheduler.set_button, BUTTON, enabled)
+    engine.transition_layer("Lyrics", enabled)
+
+
+def render(engine, frames=4096):
+    block = np.zeros((frames, engine.channels), dtype=np.float32)
+    engine.render(block, frames)
+    return block
+
+
+def test_button_survives_the_first_timeline_event(constant_stem, song_file):
+    engine = prepare_track(vocals_song(constant_stem, song_file)).engine
+    toggle_instrumental(engine, True)  # Before play: the first event has not fired yet
+    block = render(engine)
+    assert not engine.get_layer("Lyrics").enabled
+    assert np.allclose(block[-100:], 0.25, atol=1e-3)
+
+
+def test_button_survives_a_seek_back_to_the_start(constant_stem, song_file):
+    engine = prepare_track(vocals_song(constant_stem, song_file)).engine
+    block = render(engine)
+    assert np.allclose(block[-100:], 0.75, atol=1e-3)  # Both layers by default
+
+    toggle_instrumental(engine, True)
+    render(engine)
+    engine.post(engine.seek, 0)  # As the player seeks while paused, and finish_playlist rewinds
+    block = render(engine)
+    assert not engine.get_layer("Lyrics").enabled
+    assert np.allclose(block[-100:], 0.25, atol=1e-3)
+
+    toggle_instrumental(engine, False)
+    render(engine)
+    engine.post(engine.seek, 0)
+    block = render(engine)
+    assert np.allclose(block[-100:], 0.75, atol=1e-3)
+
+
+def test_default_button_position_masks_the_timeline(constant_stem, song_file):
+    path = vocals_song(constant_stem, song_file)
+    with open(path) as f:
+        text = f.read().replace('"defaultPosition": false', '"defaultPosition": true')
+    with open(path, 'w') as f:
+        f.write(text)
+    block = render(prepare_track(path).engine)
+    assert np.allclose(block[-100:], 0.25, atol=1e-3)
@@ -0,0 +1,83 @@
+import threading
+import numpy as np
+
+# Constants
+CURVE_CUT = "cut"  # Jump straight to the new gain
+CURVE_LINEAR = "linear"  # Gain moves in a straight line
+CURVE_EQUAL_POWER = "equal_power"  # Sine/cosine fade that keeps the summed power constant in a crossfade
+CURVE_NAMES = {  # Transition types accepted in song JSONs (case-insensitive)
+    "none": CURVE_CUT,
+    "cut": CURVE_CUT,
+    "fade": CURVE_EQUAL_POWER,
+    "equalpower": CURVE_EQUAL_POWER,
+    "linear": CURVE_LINEAR,
+}
+
+
+def parse_curve(name):
+    # Map a transition type from a song JSON ("None", "Fade", "Linear", ...) to a curve kind
+    if name is None:
+        return CURVE_CUT
+    kind = CURVE_NAMES.get(str(name).replace(" ", "").replace("_", "").lower())
+    if kind is None:
+        raise ValueError(f"Unknown transition type: {name}")
+    return kind
+
+
+def curve_values(kind, length):
+    # (rising, falling) gain curves of the given kind sampled at k / length for k = 0..length-1
+    t = np.arange(length, dtype=np.float64) / max(1, length)
+    if kind == CURVE_EQUAL_POWER:
+        return np.sin(t * np.pi / 2), np.cos(t * np.pi / 2)
+    if kind == CURVE_CUT:
+        return np.ones(length), np.zeros(length)
+    return t, 1.0 - t
+
+
+class LayerTransition:
+    __slots__ = ("in_curve", "out_curve", "duration", "lead_in")
+
+    def __init__(self, in_curve=CURVE_CUT, out_curve=CURVE_CUT, duration=0.0, lead_in=0.0):
+        # How a layer fades in and out, with durations in beats
+        self.in_curve = in_curve  # Curve used when the layer is enabled
+        self.out_curve = out_curve  # Curve used when the layer is disabled
+        self.duration = duration  # Fade length in beats
+        self.lead_in = lead_in  # Beats before the musical boundary at which the fade-in starts
+
+
+class CurveBank:
+    def __init__(self, pad):
+        # Precomputed gain curves, one per (kind, length), packed into two flat arenas. For a curve starting at
+        # base, curve_in[base + k] rises from 0 to 1 and curve_out[base + k] falls from 1 to 0 over k = 0..length.
+        # Every curve is surrounded by pad frames of its start/end values, so a whole block (up to pad frames) of
+        # any fade, however far before or after the fade it is, can be looked up with one np.take.
+        self.pad = pad
+        self.curves = {}  # (kind, length) -> base offset in the arenas
+        self.curve_in = np.zeros(0, dtype=np.float32)
+        self.curve_out = np.zeros(0, dtype=np.float32)
+        self.lock = threading.Lock()  # Serializes curve registration from control threads
+        self.get(CURVE_CUT, 0)  # Base `pad` is the cut used by layers that are not fading
+
+    def get(self, kind, length):
+        # Base offset of the curve of the given kind and length, computing it on first use
+        length = 0 if kind == CURVE_CUT else max(0, int(length))
+        key = (CURVE_CUT if length == 0 else kind, length)
+        base = self.curves.get(key)
+        if base is not None:
+            return base
+        with self.lock:
+            return self.curves.get(key) or self.add(key)
+
+    def add(self, key):
+        # Compute a curve and append it to the arenas
+        kind, length = key
+        rising, falling = curve_values(kind, length)
+        curve_in = np.concatenate([np.zeros(self.pad), rising, np.ones(self.pad)]).astype(np.float32)
+        curve_out = np.concatenate([np.ones(self.pad), falling, np.zeros(self.pad)]).astype(np.float32)
+
+        # Publish the grown arenas before the offset, so the audio thread never sees an offset past their end
+        base = len(self.curve_in) + self.pad
+        self.curve_in = np.concatenate([self.curve_in, curve_in])
+        self.curve_out = np.concatenate([self.curve_out, curve_out])
+        self.curves[key] = base
+        return base
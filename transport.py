@@ -0,0 +1,128 @@
+import time
+
+# Constants
+BEATS_PER_BAR = 4  # Songs are assumed to be in 4/4 time
+WAIT_POLL_SECONDS = 0.001  # How often wait_for_beat() looks for a new beat
+
+
+class BeatEvent:
+    __slots__ = ("frame", "bar", "beat", "audible_at")
+
+    def __init__(self, frame, bar, beat, audible_at):
+        # A beat boundary crossed by the audio callback
+        self.frame = frame  # Frame position of the beat
+        self.bar = bar  # 1-based bar number
+        self.beat = beat  # 1-based beat within the bar
+        self.audible_at = audible_at  # time.perf_counter() value at which the beat reaches the speakers
+
+    @property
+    def is_bar(self):
+        # True if this beat starts a new bar
+        return self.beat == 1
+
+
+class TransportClock:
+    def __init__(self, sample_rate, grid):
+        # Playback clock owned by the audio callback. Position comes from the engine's sample counter and the
+        # stream's DAC timestamps rather than from wall-clock time, so it can never drift from the audio.
+        # Beats and bars follow grid (a BeatGrid).
+        self.sample_rate = sample_rate
+        self.grid = grid
+        self.running = False  # True while the audio callback is advancing the clock
+        self.frame = 0  # Frame at the start of the most recently rendered block
+        self.block_frames = 0  # Size of the most recently rendered block
+        self.block_audible_at = 0.0  # perf_counter() time at which that block starts playing
+        self.beat_frame = 0  # Frame of the most recent beat crossed
+        self.beat_index = -1  # Number of that beat on the grid
+        self.beat_audible_at = 0.0  # perf_counter() time at which that beat reaches the speakers
+        self.beat_sequence = 0  # Twice the beats crossed; odd while advance() is writing the three fields above
+
+    def reset(self, frame):
+        # Jump to a new position (seek, load or pause); nothing is playing until the next advance()
+        self.running = False
+        self.frame = int(frame)
+        self.block_frames = 0
+
+    def advance(self, frame, frames, output_latency=0.0):
+        # Called by the audio callback for every block: frame is the first frame of the block and
+        # output_latency is how long (in seconds) until that block reaches the DAC
+        now = time.perf_counter()
+        self.frame = frame
+        self.block_frames = frames
+        self.block_audible_at = now + max(0.0, output_latency)
+        self.running = True
+
+        # Publish the first beat boundary inside this block (device blocks are far shorter than a beat). Only
+        # plain fields are written, bracketed by beat_sequence, so the audio thread neither builds a BeatEvent
+        # nor takes a lock a waiting thread could be holding; readers build the event themselves.
+        beat_frame, beat_index = self.grid.next_beat(frame)
+        offset = beat_frame - frame
+        if offset < frames:
+            self.beat_sequence += 1
+            self.beat_frame = beat_frame
+            self.beat_index = beat_index
+            self.beat_audible_at = self.block_audible_at + offset / self.sample_rate
+            self.beat_sequence += 1
+
+    def position(self):
+        # Frame currently coming out of the speakers, interpolated between callbacks
+        if not self.running:
+            return self.frame
+        elapsed = (time.perf_counter() - self.block_audible_at) * self.sample_rate
+        elapsed = min(max(elapsed, -self.block_frames), self.block_frames)  # Stay within the neighbouring blocks
+        return max(0, int(self.frame + elapsed))
+
+    def seconds(self):
+        # Audible position in seconds
+        return self.position() / self.sample_rate
+
+    def beat_position(self, frame=None):
+        # (bar, beat, samples until the next beat) for a frame position, 1-based like the metronome display
+        frame = self.position() if frame is None else frame
+        beat_index = self.grid.beat_index(frame)  # Before the first beat: bar 0, beat 4 (a pickup)
+        return (beat_index // BEATS_PER_BAR + 1, beat_index % BEATS_PER_BAR + 1,
+                self.grid.frame(beat_index + 1) - frame)
+
+    @property
+    def beat_count(self):
+        # Number of beats crossed since the clock was created
+        return self.beat_sequence // 2
+
+    @property
+    def last_beat(self):
+        # BeatEvent of the most recent beat crossed (None before the first), read consistently while the audio
+        # thread may be writing the next one
+        while True:
+            sequence = self.beat_sequence
+            if sequence % 2 == 0:
+                frame, index, audible_at = self.beat_frame, self.beat_index, self.beat_audible_at
+                if self.beat_sequence == sequence:
+                    break
+        if sequence == 0:
+            return None
+        return BeatEvent(frame, index // BEATS_PER_BAR + 1, index % BEATS_PER_BAR + 1, audible_at)
+
+    def wait_for_beat(self, timeout=None, bar_only=False):
+        # Block until the next beat (or bar) becomes audible and return its BeatEvent, or None on timeout.
+        # Polls every WAIT_POLL_SECONDS, since the audio thread does not signal waiters.
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        seen = self.beat_count
+        while True:
+            if self.beat_count != seen:
+                seen = self.beat_count
+                event = self.last_beat
+                if not bar_only or event.is_bar:
+                    break
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            time.sleep(WAIT_POLL_SECONDS)
+
+        # The beat has been rendered; sleep until it actually reaches the speakers
+        delay = event.audible_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return event
+
+    def wait_for_bar(self, timeout=None):
+        # Block until the next bar becomes audible and return its BeatEvent, or None on timeout
+        return self.wait_for_beat(timeout, bar_only=True)
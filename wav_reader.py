@@ -0,0 +1,126 @@
+import os
+import struct
+import numpy as np
+
+from mixer import sample_scale
+
+# Constants
+WAVE_FORMAT_PCM = 0x0001  # Integer PCM samples
+WAVE_FORMAT_IEEE_FLOAT = 0x0003  # Floating point samples
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE  # Real format is stored in the first two bytes of the SubFormat GUID
+SAMPLE_DTYPES = {  # (format tag, bytes per sample) -> dtype of the stored samples (None: 24-bit, unpacked on decode)
+    (WAVE_FORMAT_PCM, 1): "u1",  # 8-bit PCM is unsigned, centred on 128
+    (WAVE_FORMAT_PCM, 2): "<i2",
+    (WAVE_FORMAT_PCM, 3): None,
+    (WAVE_FORMAT_PCM, 4): "<i4",
+    (WAVE_FORMAT_IEEE_FLOAT, 4): "<f4",
+    (WAVE_FORMAT_IEEE_FLOAT, 8): "<f8",
+}
+DECODE_CHUNK = 1 << 18  # Frames converted to float at a time by decode_wav()
+
+
+class WavFormatError(ValueError):
+    # Raised when a file is not a WAV file the player can read
+    pass
+
+
+class WavInfo:
+    __slots__ = ("format_tag", "channels", "sample_rate", "sample_width", "data_offset", "frames")
+
+    def __init__(self, format_tag, channels, sample_rate, sample_width, data_offset, frames):
+        # Header information of a WAV file
+        self.format_tag = format_tag  # WAVE_FORMAT_PCM or WAVE_FORMAT_IEEE_FLOAT
+        self.channels = channels  # Number of interleaved channels
+        self.sample_rate = sample_rate  # Frames per second
+        self.sample_width = sample_width  # Bytes per sample
+        self.data_offset = data_offset  # Byte offset of the PCM data chunk
+        self.frames = frames  # Number of frames in the data chunk
+
+
+def read_wav_header(filepath):
+    # Walk the RIFF chunks of a WAV file and return its WavInfo without reading any audio
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise WavFormatError(f"{filepath} is not a RIFF/WAVE file")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise WavFormatError(f"{filepath} has no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    raise WavFormatError(f"{filepath} has a truncated fmt chunk")
+                f.seek(chunk_size % 2, os.SEEK_CUR)  # Chunks are padded to an even size
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise WavFormatError(f"{filepath} has a data chunk before its fmt chunk")
+                data_offset = f.tell()
+                data_size = min(chunk_size, file_size - data_offset)  # Streaming writers may leave the size unset
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    if channels == 0 or block_align == 0:
+        raise WavFormatError(f"{filepath} declares no channels")
+    sample_width = (bits + 7) // 8
+    if (format_tag, sample_width) not in SAMPLE_DTYPES or block_align != channels * sample_width:
+        raise WavFormatError(f"{filepath} has {bits}-bit samples of format 0x{format_tag:04x}, which are not supported")
+    return WavInfo(format_tag, channels, sample_rate, sample_width, data_offset, data_size // block_align)
+
+
+def stored_dtype(info):
+    # NumPy dtype of a WAV file's samples as stored, or None for 24-bit samples (which NumPy has no type for)
+    return SAMPLE_DTYPES[(info.format_tag, info.sample_width)]
+
+
+def open_wav(filepath, info=None):
+    # Map the samples of a WAV file as a read-only (frames, channels) array of their stored dtype without reading
+    # them. Pages are loaded by the OS on first access, so playback can start immediately. A WavInfo from an
+    # earlier read_wav_header() (e.g. a cached song plan) saves parsing the header again.
+    if info is None:
+        info = read_wav_header(filepath)
+    dtype = stored_dtype(info)
+    if dtype is None:
+        raise WavFormatError(f"{filepath} has 24-bit samples, which cannot be mapped (use decode_wav)")
+    if info.frames == 0:
+        return np.zeros((0, info.channels), dtype=dtype), info
+    data = np.memmap(filepath, dtype=dtype, mode='r', offset=info.data_offset, shape=(info.frames, info.channels))
+    return data, info
+
+
+def decode_wav(filepath, info=None):
+    # Read the samples of a WAV file of any supported format as a float32 (frames, channels) array in the
+    # -1.0..1.0 range, a chunk at a time so no full-length integer temporaries are made
+    if info is None:
+        info = read_wav_header(filepath)
+    output = np.empty((info.frames, info.channels), dtype=np.float32)
+    if info.frames == 0:
+        return output
+    dtype = stored_dtype(info)
+    if dtype is None:
+        # 24-bit: little-endian byte triplets go into the top three bytes of an int32, which keeps their sign
+        data = np.memmap(filepath, dtype=np.uint8, mode='r', offset=info.data_offset, shape=(info.frames, info.channels, 3))
+        scale, offset = np.float32(1.0 / (1 << 31)), 0
+    else:
+        data = open_wav(filepath, info)[0]
+        scale, offset = np.float32(sample_scale(dtype)), 128 if dtype == "u1" else 0
+    for start in range(0, info.frames, DECODE_CHUNK):
+        block = data[start:start + DECODE_CHUNK]
+        target = output[start:start + len(block)]
+        if dtype is None:
+            block = block.astype(np.int32)
+            block = (block[..., 0] << 8) | (block[..., 1] << 16) | (block[..., 2] << 24)
+        np.copyto(target, block, casting='unsafe')
+        if offset:
+            np.subtract(target, offset, out=target)
+        np.multiply(target, scale, out=target)
+    return output
@@ -0,0 +1,93 @@
+import numpy as np
+
+from disk_cache import load_cached, save_cached
+from mixer import sample_scale
+from stem_format import load_stem, read_audio_header
+
+# Constants
+PYRAMID_SUFFIX = ".waveform.pickle"  # Sidecar holding a stem's WaveformPyramid
+PYRAMID_VERSION = 1  # Bump whenever WaveformPyramid changes shape
+BASE_BUCKET = 256  # Frames summarised by each min/max pair of the finest level
+READ_CHUNK = BASE_BUCKET * 4096  # Frames of a stem reduced at a time while building
+
+
+class WaveformPyramid:
+    def __init__(self, frames, levels):
+        # Min/max mipmap of a stem: levels[0] holds the (mins, maxs) of every BASE_BUCKET frames (all channels
+        # together) as float32 in -1.0..1.0, and every further level halves the one before. Any zoom level then
+        # costs O(pixels), read from the level whose buckets are just finer than a pixel.
+        self.frames = frames
+        self.levels = levels  # [(mins, maxs), ...], finest first
+
+    @classmethod
+    def build(cls, data):
+        # Reduce (frames, channels) PCM samples into a pyramid, a chunk at a time so a long mapped stem is never
+        # converted to float in one piece
+        scale = np.float32(sample_scale(data.dtype))
+        buckets = -(-len(data) // BASE_BUCKET)
+        mins = np.zeros(buckets, dtype=np.float32)
+        maxs = np.zeros(buckets, dtype=np.float32)
+        for start in range(0, len(data), READ_CHUNK):
+            block = data[start:start + READ_CHUNK].reshape(-1)
+            per_bucket = BASE_BUCKET * data.shape[1]
+            first = start // BASE_BUCKET
+            count = -(-len(block) // per_bucket)
+            starts = np.arange(count) * per_bucket  # Bucket starts in the interleaved samples (the last may be short)
+            mins[first:first + count] = np.minimum.reduceat(block, starts) * scale
+            maxs[first:first + count] = np.maximum.reduceat(block, starts) * scale
+
+        levels = [(mins, maxs)]
+        while len(mins) > 1:
+            if len(mins) % 2:
+                mins, maxs = np.append(mins, mins[-1]), np.append(maxs, maxs[-1])
+            mins = np.minimum(mins[0::2], mins[1::2])
+            maxs = np.maximum(maxs[0::2], maxs[1::2])
+            levels.append((mins, maxs))
+        return cls(len(data), levels)
+
+    def envelope(self, start, end, pixels):
+        # (mins, maxs) float32 arrays of length pixels covering frames start to end
+        start, end = max(0, int(start)), min(self.frames, int(end))
+        if pixels <= 0 or end <= start:
+            return np.zeros(max(0, pixels), dtype=np.float32), np.zeros(max(0, pixels), dtype=np.float32)
+        frames_per_pixel = (end - start) / pixels
+        level = 0
+        while level + 1 < len(self.levels) and BASE_BUCKET << (level + 1) <= frames_per_pixel:
+            level += 1
+        mins, maxs = self.levels[level]
+        bucket = BASE_BUCKET << level
+
+        # Bucket range of every pixel: at least one bucket each, so zooming past the finest level repeats buckets
+        edges = np.linspace(start, end, pixels + 1) // bucket
+        first = np.minimum(edges[:-1].astype(np.int64), len(mins) - 1)
+        last = np.maximum(np.minimum(edges[1:].astype(np.int64), len(mins)), first + 1)
+        # Past the first level every pixel spans at most a few buckets: gather them as a (pixels x run) table,
+        # repeating each pixel's last bucket to fill its row, and reduce the rows
+        run = int((last - first).max())
+        indices = np.minimum(first[:, np.newaxis] + np.arange(run)[np.newaxis, :], (last - 1)[:, np.newaxis])
+        return mins[indices].min(axis=1), maxs[indices].max(axis=1)
+
+
+def load_pyramid(filepath, info=None, sample_rate=None):
+    # WaveformPyramid of a stem as played at sample_rate (default its own), built once and then read from a
+    # sidecar until the file changes
+    if info is None:
+        info = read_audio_header(filepath)
+    suffix = PYRAMID_SUFFIX if sample_rate in (None, info.sample_rate) else f".{sample_rate}hz{PYRAMID_SUFFIX}"
+    pyramid = load_cached(filepath, suffix, PYRAMID_VERSION)
+    if pyramid is None:
+        pyramid = WaveformPyramid.build(load_stem(filepath, info, sample_rate))
+        save_cached(filepath, suffix, PYRAMID_VERSION, [filepath], pyramid)
+    return pyramid
+
+
+def song_envelope(pyramids, start, end, pixels):
+    # Envelope of several time-aligned layers played together: per-pixel sums of their mins and maxs (the widest
+    # the mix can swing), clipped to the -1.0..1.0 range
+    mins = np.zeros(pixels, dtype=np.float32)
+    maxs = np.zeros(pixels, dtype=np.float32)
+    for pyramid in pyramids:
+        layer_mins, layer_maxs = pyramid.envelope(start, end, pixels)
+        mins += layer_mins
+        maxs += layer_maxs
+    return np.clip(mins, -1.0, 1.0), np.clip(maxs, -1.0, 1.0)